@@ -0,0 +1,263 @@
+"""
+Befehle an Aktoren mit Antwort über ein Reply-Topic.
+
+Ein Befehl wird als JSON auf das Actor-Topic (<root>/<device>/<actor>)
+publiziert und trägt eine Correlation-ID sowie das Reply-Topic:
+
+    {"id": "5f0c...", "command": "move", "args": {"angle": 90},
+     "replyTo": "au-u69/m5stackcore/servo/reply", "sent": 1737360000.123}
+
+Das Gerät bestätigt auf dem Reply-Topic mit derselben id:
+
+    {"id": "5f0c...", "status": "ok", "result": {...}}
+
+Offene Befehle liegen in einem Dict (id -> Command); kein Thread wartet pro
+Befehl. Ein einzelner Thread lässt abgelaufene Befehle über einen Heap der
+Deadlines mit "timeout" enden. Die Round-Trip-Zeit (Senden bis Antwort)
+geht pro Actor in ein Histogramm und in ein Fenster der letzten Werte für
+p50/p90/p99.
+
+Bei mehreren gunicorn-Workern kennt nur der sendende Worker einen offenen
+Befehl; mit state_dir legt er den Status zusätzlich als Datei ab, damit
+jeder Worker ihn beantworten kann (wie die Publish-Jobs).
+"""
+import heapq
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+
+from metrics import COMMAND_SECONDS, COMMANDS, COMMANDS_PENDING
+
+STATE_PENDING = "pending"
+STATE_OK = "ok"
+STATE_ERROR = "error"
+STATE_TIMEOUT = "timeout"
+STATE_FAILED = "failed"  # Publish nicht möglich
+
+REPLY_SUFFIX = "reply"
+
+
+def percentile(sorted_values: list, q: float):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(q * (len(sorted_values) - 1)))))
+    return sorted_values[index]
+
+
+class Command:
+
+    def __init__(self, actor: str, topic: str, command: str, args=None, timeout: float = 5.0, qos: int = 1):
+        if not command:
+            raise ValueError("command fehlt")
+        if timeout <= 0:
+            raise ValueError("timeout muss grösser als 0 sein")
+        self.id = uuid.uuid4().hex
+        self.actor = actor
+        self.topic = topic
+        self.reply_topic = f"{topic}/{REPLY_SUFFIX}"
+        self.command = command
+        self.args = args if args is not None else {}
+        self.timeout = float(timeout)
+        self.qos = qos
+        self.state = STATE_PENDING
+        self.reply = None
+        self.sent = None
+        self.completed = None
+        self._done = threading.Event()
+
+    def payload(self) -> str:
+        return json.dumps({
+            "id": self.id, "command": self.command, "args": self.args,
+            "replyTo": self.reply_topic, "sent": self.sent,
+        })
+
+    def wait(self, timeout: float) -> bool:
+        return self._done.wait(timeout)
+
+    def status(self) -> dict:
+        latency = self.completed - self.sent if self.completed is not None and self.state == STATE_OK else None
+        return {
+            "id": self.id,
+            "actor": self.actor,
+            "topic": self.topic,
+            "command": self.command,
+            "state": self.state,
+            "reply": self.reply,
+            "sent": self.sent,
+            "latency_ms": round(latency * 1000, 3) if latency is not None else None,
+            "timeout": self.timeout,
+        }
+
+
+class CommandChannel:
+    """Sendet Befehle über den MQTT-Client des UIs und ordnet die Antworten zu."""
+
+    def __init__(self, mqtt_client, history: int = 1000, window: int = 1000, state_dir: str = None):
+        self.mqtt_client = mqtt_client
+        self.history = history
+        self.window = window
+        self.state_dir = state_dir
+        self._pending = {}              # id -> Command
+        self._done = OrderedDict()      # id -> Command (letzte history)
+        self._deadlines = []            # Heap (Deadline, id)
+        self._latencies = {}            # Actor -> deque der letzten Round-Trip-Zeiten
+        self._reply_topics = set()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._thread = None
+        if state_dir:
+            os.makedirs(state_dir, exist_ok=True)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._expire, name="command-timeouts", daemon=True)
+            self._thread.start()
+
+    # --------------------------------------
+    # MQTT-Callbacks
+    # --------------------------------------
+    def on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            with self._lock:
+                topics = sorted(self._reply_topics)
+            for topic in topics:
+                client.subscribe(topic, 1)
+
+    def on_reply(self, client, userdata, msg):
+        received = time.time()
+        try:
+            reply = json.loads(msg.payload)
+            command_id = reply.get("id") if isinstance(reply, dict) else None
+        except ValueError:
+            return
+        with self._lock:
+            command = self._pending.pop(command_id, None)
+        if command is None:
+            return  # zu spät, Duplikat oder Befehl eines anderen Workers
+        state = STATE_OK if str(reply.get("status", STATE_OK)).lower() == STATE_OK else STATE_ERROR
+        self._complete(command, state, reply, received)
+
+    # --------------------------------------
+    # Befehle
+    # --------------------------------------
+    def send(self, command: Command) -> Command:
+        """Publiziert den Befehl und kehrt sofort zurück (Antwort über status/wait)."""
+        subscribe = False
+        with self._lock:
+            if command.reply_topic not in self._reply_topics:
+                self._reply_topics.add(command.reply_topic)
+                subscribe = True
+        if subscribe:
+            # Abo vor dem Befehl, sonst könnte die Antwort verloren gehen
+            self.mqtt_client.message_callback_add(command.reply_topic, self.on_reply)
+            self.mqtt_client.subscribe(command.reply_topic, 1)
+
+        command.sent = time.time()
+        with self._lock:
+            self._pending[command.id] = command
+            heapq.heappush(self._deadlines, (command.sent + command.timeout, command.id))
+            self._wakeup.notify()
+        COMMANDS_PENDING.inc()
+        # Status vor dem Publish schreiben, sonst überschreibt er eine schnelle Antwort
+        self._write_state(command)
+        info = self.mqtt_client.publish(command.topic, command.payload(), qos=command.qos)
+        if info.rc != 0:
+            with self._lock:
+                failed = self._pending.pop(command.id, None) is not None
+            if failed:
+                self._complete(command, STATE_FAILED, {"error": f"Publish fehlgeschlagen (rc={info.rc})"}, time.time())
+        return command
+
+    def status(self, command_id: str):
+        """Status eines Befehls dieses oder (über state_dir) eines anderen Workers, sonst None."""
+        with self._lock:
+            command = self._pending.get(command_id) or self._done.get(command_id)
+        if command is not None:
+            return command.status()
+        return self._read_state(command_id)
+
+    def get(self, command_id: str):
+        with self._lock:
+            return self._pending.get(command_id) or self._done.get(command_id)
+
+    def stats(self) -> dict:
+        """Offene Befehle und Round-Trip-Perzentile pro Actor (dieses Workers)."""
+        with self._lock:
+            pending = len(self._pending)
+            latencies = {actor: sorted(values) for actor, values in self._latencies.items()}
+        actors = {}
+        for actor, values in latencies.items():
+            actors[actor] = {
+                "count": len(values),
+                "p50_ms": round(percentile(values, 0.50) * 1000, 3),
+                "p90_ms": round(percentile(values, 0.90) * 1000, 3),
+                "p99_ms": round(percentile(values, 0.99) * 1000, 3),
+            }
+        return {"pending": pending, "actors": actors}
+
+    # --------------------------------------
+    # Interna
+    # --------------------------------------
+    def _complete(self, command: Command, state: str, reply, completed: float):
+        command.state = state
+        command.reply = reply
+        command.completed = completed
+        COMMANDS_PENDING.dec()
+        COMMANDS.labels(command.actor, state).inc()
+        if state == STATE_OK:
+            latency = completed - command.sent
+            COMMAND_SECONDS.labels(command.actor).observe(latency)
+        with self._lock:
+            if state == STATE_OK:
+                self._latencies.setdefault(command.actor, deque(maxlen=self.window)).append(completed - command.sent)
+            self._done[command.id] = command
+            while len(self._done) > self.history:
+                oldest, _ = self._done.popitem(last=False)
+                self._remove_state(oldest)
+        command._done.set()
+        self._write_state(command)
+
+    def _expire(self):
+        while True:
+            with self._lock:
+                while not self._deadlines:
+                    self._wakeup.wait()
+                deadline, command_id = self._deadlines[0]
+                now = time.time()
+                if deadline > now:
+                    self._wakeup.wait(deadline - now)
+                    continue
+                heapq.heappop(self._deadlines)
+                command = self._pending.pop(command_id, None)
+            if command is not None:
+                self._complete(command, STATE_TIMEOUT, None, now)
+
+    def _path(self, command_id: str) -> str:
+        return os.path.join(self.state_dir, f"{command_id}.json")
+
+    def _write_state(self, command: Command):
+        if not self.state_dir:
+            return
+        tmp = os.path.join(self.state_dir, f"{command.id}.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(command.status(), f)
+        os.replace(tmp, self._path(command.id))
+
+    def _read_state(self, command_id: str):
+        if not self.state_dir or not command_id.isalnum():
+            return None
+        try:
+            with open(self._path(command_id), encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _remove_state(self, command_id: str):
+        if self.state_dir:
+            try:
+                os.remove(self._path(command_id))
+            except OSError:
+                pass
@@ -0,0 +1,40 @@
+"""
+gunicorn-Konfiguration des UIs.
+
+Mehrere Worker-Prozesse mit je einem Thread-Pool (gthread). Jeder Worker
+hat seinen eigenen Kubernetes-Cache und MQTT-Client; sie werden nach dem
+fork() erzeugt, weil Threads einen fork() nicht überleben. SSE-Streams
+belegen je einen Thread, UI_THREADS also grosszügig wählen.
+"""
+import os
+import shutil
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+workers = int(os.environ.get("UI_WORKERS", "2"))
+threads = int(os.environ.get("UI_THREADS", "32"))
+worker_class = "gthread"
+timeout = int(os.environ.get("UI_TIMEOUT", "60"))
+keepalive = 5
+accesslog = None
+
+
+def on_starting(server):
+    # Metrik-Dateien der Worker (siehe metrics.py) bei jedem Start leeren
+    multiproc_dir = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if multiproc_dir:
+        shutil.rmtree(multiproc_dir, ignore_errors=True)
+        os.makedirs(multiproc_dir, exist_ok=True)
+
+
+def post_worker_init(worker):
+    # Cache und MQTT-Client gleich nach dem Start des Workers aufbauen
+    # (die App ist zu diesem Zeitpunkt bereits geladen)
+    import wsgi
+    wsgi.ui.init_services()
+
+
+def child_exit(server, worker):
+    # Gauges eines beendeten Workers nicht mehr mitzählen
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
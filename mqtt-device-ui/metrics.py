@@ -0,0 +1,43 @@
+"""
+Prometheus-Metriken des UIs, abrufbar über GET /metrics.
+
+Unter gunicorn hat jeder Worker eigene Zähler; ist PROMETHEUS_MULTIPROC_DIR
+gesetzt, schreiben die Worker ihre Werte dort hin und /metrics fasst alle
+Worker zusammen (siehe gunicorn.conf.py).
+"""
+import os
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest, multiprocess,
+)
+
+REQUEST_SECONDS = Histogram(
+    "mqtt_device_ui_request_seconds", "Dauer eines Requests bis zur Antwort (bei /stream bis zum Start)",
+    ["endpoint", "method", "status"])
+RENDER_SECONDS = Histogram(
+    "mqtt_device_ui_render_seconds", "Aufbau und Rendern der Hauptseite")
+INDEX_RESPONSES = Counter(
+    "mqtt_device_ui_index_responses_total", "Antworten der Hauptseite (result: rendered oder not_modified)",
+    ["result"])
+CACHE_LOOKUPS = Counter(
+    "mqtt_device_ui_cache_lookups_total", "Abfragen des Watch-Caches (result: hit oder miss)", ["plural", "result"])
+STREAM_CLIENTS = Gauge(
+    "mqtt_device_ui_stream_clients", "Offene Live-Streams (/stream)", multiprocess_mode="livesum")
+STREAM_DROPPED = Counter(
+    "mqtt_device_ui_stream_dropped_total", "Wegen vollem Puffer verworfene Live-Werte")
+COMMANDS = Counter(
+    "mqtt_device_ui_commands_total", "Befehle an Aktoren (result: ok, error, timeout, failed)", ["actor", "result"])
+COMMANDS_PENDING = Gauge(
+    "mqtt_device_ui_commands_pending", "Befehle, die auf eine Antwort warten", multiprocess_mode="livesum")
+COMMAND_SECONDS = Histogram(
+    "mqtt_device_ui_command_seconds", "Round-Trip-Zeit eines Befehls (Senden bis Antwort)", ["actor"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0))
+
+
+def metrics_response():
+    """(Body, Content-Type) für GET /metrics, bei mehreren Workern über alle zusammengefasst."""
+    registry = REGISTRY
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -1,44 +1,170 @@
 import os
+import gzip
+import logging
+import threading
+import time
 import flask
-from flask import Flask, request, redirect
+from flask import Flask, request, redirect, make_response, render_template, stream_with_context, jsonify
 from kubernetes import client, config
 import paho.mqtt.client as mqtt
 import uuid
 
+from watch_cache import ResourceCache
+from stream import TelemetryHub
+from publisher import JobManager, PublishJob
+from commands import STATE_PENDING, Command, CommandChannel
+from logs import setup_logging
+from metrics import INDEX_RESPONSES, RENDER_SECONDS, REQUEST_SECONDS, metrics_response
+
+# LOG_LEVEL und LOG_FORMAT (text oder json), wie beim Listener
+setup_logging()
+log = logging.getLogger("mqtt-device-ui")
+
 app = Flask(__name__)
 
-# --------------------------------------
-# A) Kubernetes-Client vorbereiten
-# --------------------------------------
-try:
-    # Versuche die In-Cluster-Config (Operator / Pod in K8s)
-    config.load_incluster_config()
-except:
-    # Fallback: Lokal (z. B. ~/.kube/config)
-    config.load_kube_config()
+# Kubernetes-Cache, MQTT-Client, Live-Stream und Publish-Jobs werden pro
+# Prozess (bzw. gunicorn-Worker) beim ersten Request erzeugt, nicht beim
+# Import: Threads überleben kein fork() und der Broker-Connect blockiert
+# so den Start nicht.
+custom_api = None
+resource_cache = None
+mqtt_client = None
+telemetry_hub = None
+publish_jobs = None
+command_channel = None
+_init_lock = threading.Lock()
+
+def init_services():
+    global custom_api, resource_cache, mqtt_client, telemetry_hub, publish_jobs, command_channel
+    with _init_lock:
+        if mqtt_client is not None:
+            return
+
+        # --------------------------------------
+        # A) Kubernetes-Client vorbereiten
+        # --------------------------------------
+        try:
+            # Versuche die In-Cluster-Config (Operator / Pod in K8s)
+            config.load_incluster_config()
+        except:
+            # Fallback: Lokal (z. B. ~/.kube/config)
+            config.load_kube_config()
+
+        custom_api = client.CustomObjectsApi()
+
+        # Watch-basierter Cache: die Seite wird ohne API-Aufrufe pro Objekt gerendert
+        resource_cache = ResourceCache(
+            custom_api,
+            sync_timeout=float(os.environ.get("CACHE_SYNC_TIMEOUT", "10")),
+            max_namespaces=int(os.environ.get("CACHE_MAX_NAMESPACES", "20")),
+            idle_timeout=float(os.environ.get("CACHE_NAMESPACE_IDLE", "600")),
+        )
+
+        # --------------------------------------
+        # B) MQTT-Client vorbereiten
+        # --------------------------------------
+        mqtt_broker_url = os.environ.get("MQTT_BROKER_URL", "mqtt://localhost:1883")
+
+        # Aus MQTT-URL Host & Port extrahieren (z. B. "mqtt://test-broker:1883")
+        if mqtt_broker_url.startswith("mqtt://"):
+            mqtt_broker_url = mqtt_broker_url.replace("mqtt://", "")
+        broker_parts = mqtt_broker_url.split(":")
+        broker_host = broker_parts[0]
+        broker_port = int(broker_parts[1]) if len(broker_parts) > 1 else 1883
+
+        # Generiere eine eindeutige UUID als Client-ID (eine pro Worker)
+        unique_id = f"mqtt-device-ui-{uuid.uuid4()}"  # Beispiel: mqtt-550e8400-e29b-41d4-a716-446655440000
+        log.info(f"MQTT-Client-ID: {unique_id} (PID {os.getpid()})")  # Zur Überprüfung
+
+        client_ = mqtt.Client(client_id=unique_id)
+        # Falls nötig: client_.username_pw_set("user", "password")
+
+        # Live-Telemetrie (/stream): teilt die Abos dieses Clients auf alle Browser auf
+        telemetry_hub = TelemetryHub(
+            client_,
+            interval=float(os.environ.get("STREAM_INTERVAL_MS", "500")) / 1000.0,
+            buffer_size=int(os.environ.get("STREAM_BUFFER_SIZE", "256")),
+        )
+        client_.on_message = telemetry_hub.on_message
+        telemetry_hub.start()
 
-custom_api = client.CustomObjectsApi()
+        # Befehle an Aktoren (/api/commands): Antworten kommen über <Actor-Topic>/reply
+        # auf diesem Client an; Status in COMMAND_STATE_DIR für alle Worker
+        command_channel = CommandChannel(
+            client_,
+            history=int(os.environ.get("COMMAND_HISTORY", "1000")),
+            state_dir=os.environ.get("COMMAND_STATE_DIR", "/tmp/mqtt-device-ui-commands"),
+        )
+        command_channel.start()
+
+        def on_connect(client, userdata, flags, rc):
+            telemetry_hub.on_connect(client, userdata, flags, rc)
+            command_channel.on_connect(client, userdata, flags, rc)
+        client_.on_connect = on_connect
+
+        # Asynchrone Publish-Jobs (/api/publish) über denselben Client; der Status
+        # liegt zusätzlich in PUBLISH_STATE_DIR, damit jeder Worker ihn kennt
+        publish_jobs = JobManager(
+            client_,
+            max_running=int(os.environ.get("PUBLISH_MAX_JOBS", "4")),
+            state_dir=os.environ.get("PUBLISH_STATE_DIR", "/tmp/mqtt-device-ui-jobs"),
+            max_inflight=int(os.environ.get("PUBLISH_MAX_INFLIGHT", "100")),
+        )
+        client_.on_publish = publish_jobs.on_publish
+
+        # Nicht blockierend verbinden; der Hintergrund-Thread verbindet (neu), sobald der Broker erreichbar ist
+        client_.connect_async(broker_host, broker_port, 60)
+        client_.loop_start()  # Startet den Hintergrund-Thread für MQTT
+        mqtt_client = client_
+
+@app.before_request
+def ensure_services():
+    flask.g.request_start = time.perf_counter()
+    # /metrics soll auch ohne API-Server und Broker antworten
+    if mqtt_client is None and request.endpoint != "metrics":
+        init_services()
 
 # --------------------------------------
-# B) MQTT-Client vorbereiten
+# Metriken: Dauer pro Route und GET /metrics
 # --------------------------------------
-mqtt_broker_url = os.environ.get("MQTT_BROKER_URL", "mqtt://localhost:1883")
+@app.after_request
+def observe_request(response):
+    start = flask.g.get("request_start")
+    if start is not None:
+        REQUEST_SECONDS.labels(
+            request.endpoint or "unknown", request.method, str(response.status_code)
+        ).observe(time.perf_counter() - start)
+    return response
 
-# Aus MQTT-URL Host & Port extrahieren (z. B. "mqtt://test-broker:1883")
-if mqtt_broker_url.startswith("mqtt://"):
-    mqtt_broker_url = mqtt_broker_url.replace("mqtt://", "")
-broker_parts = mqtt_broker_url.split(":")
-broker_host = broker_parts[0]
-broker_port = int(broker_parts[1]) if len(broker_parts) > 1 else 1883
+@app.route("/metrics")
+def metrics():
+    body, content_type = metrics_response()
+    return flask.Response(body, content_type=content_type)
 
-# Generiere eine eindeutige UUID als Client-ID
-unique_id = f"mqtt-device-ui-{uuid.uuid4()}"  # Beispiel: mqtt-550e8400-e29b-41d4-a716-446655440000
-print(f"MQTT-Client-ID: {unique_id}")  # Zur Überprüfung
+# --------------------------------------
+# Komprimierung: gzip für HTML/JSON (nicht für den SSE-Stream)
+# --------------------------------------
+GZIP_MIN_SIZE = int(os.environ.get("GZIP_MIN_SIZE", "500"))
+GZIP_MIMETYPES = ("text/html", "application/json")
 
-mqtt_client = mqtt.Client(client_id=unique_id)
-# Falls nötig: mqtt_client.username_pw_set("user", "password")
-mqtt_client.connect(broker_host, broker_port, 60)
-mqtt_client.loop_start()  # Startet den Hintergrund-Thread für MQTT
+@app.after_request
+def gzip_response(response):
+    if (
+        response.direct_passthrough
+        or response.is_streamed
+        or response.status_code < 200 or response.status_code >= 300
+        or response.mimetype not in GZIP_MIMETYPES
+        or "Content-Encoding" in response.headers
+        or "gzip" not in request.headers.get("Accept-Encoding", "").lower()
+    ):
+        return response
+    data = response.get_data()
+    if len(data) < GZIP_MIN_SIZE:
+        return response
+    response.set_data(gzip.compress(data, compresslevel=6))
+    response.headers["Content-Encoding"] = "gzip"
+    response.vary.add("Accept-Encoding")
+    return response
 
 # --------------------------------------
 # C) Flask-Route: /
@@ -49,195 +175,159 @@ def index():
     # Namespace per Query-Param, Default 'default'
     namespace = request.args.get("namespace", "default")
 
-    # Einfaches HTML + Minimal-CSS
-    html = """
-    <html>
-    <head>
-        <title>mqtt-device-ui UI</title>
-        <style>
-            body {
-                font-family: Arial, sans-serif;
-                margin: 20px;
-            }
-            h1, h2 {
-                color: #333;
-            }
-            .device-card {
-                border: 1px solid #ccc;
-                border-radius: 6px;
-                padding: 10px;
-                margin-bottom: 20px;
-            }
-            table {
-                border-collapse: collapse;
-                width: 100%;
-                margin: 10px 0;
-            }
-            th, td {
-                text-align: left;
-                padding: 8px;
-                border-bottom: 1px solid #ddd;
-            }
-            th {
-                background-color: #f9f9f9;
-            }
-            .sensor-button {
-                background-color: #0284c7;
-                color: white;
-                border: none;
-                padding: 6px 12px;
-                cursor: pointer;
-                border-radius: 4px;
-            }
-            .sensor-button:hover {
-                background-color: #0369a1;
-            }
-            .error {
-                color: red;
-            }
-        </style>
-    </head>
-    <body>
-        <h1>mqtt-device-ui UI</h1>
-    """
+    # Unveränderter Cache => 304 Not Modified (ETag / Last-Modified)
+    etag, last_modified = resource_cache.version(namespace)
+    if request.if_none_match.contains_weak(etag) or (
+        not request.if_none_match
+        and request.if_modified_since is not None
+        and last_modified.replace(microsecond=0) <= request.if_modified_since
+    ):
+        INDEX_RESPONSES.labels("not_modified").inc()
+        return flask.Response(status=304, headers={"ETag": f'W/"{etag}"'})
+
+    INDEX_RESPONSES.labels("rendered").inc()
+    with RENDER_SECONDS.time():
+        context = index_context(namespace)
+        response = make_response(render_template("index.html", **context))
+    if context["error"] is None:
+        # Schwacher ETag: gilt für die gzip- und die unkomprimierte Variante
+        response.set_etag(etag, weak=True)
+        response.last_modified = last_modified
+        response.headers["Cache-Control"] = "no-cache"  # Browser fragt immer nach, erhält aber meist 304
+    return response
 
-    # 1) Alle mqtt_device_uis im Namespace laden
+def index_context(namespace):
+    """Daten der Seite aus dem Cache (MQTTDevices mit Device, Sensoren und Aktoren)."""
+    context = {"namespace": namespace, "error": None, "cards": []}
+
+    # 1) Alle mqtt_device_uis im Namespace aus dem Cache
     try:
-        mqtt_device_uis = custom_api.list_namespaced_custom_object(
-            group="iiot.mc-b.ch",
-            version="v1alpha1",
-            namespace=namespace,
-            plural="mqttdevices",
-        )
-        items = mqtt_device_uis.get("items", [])
+        items = resource_cache.mqttdevices(namespace)
     except Exception as e:
-        html += f"<p class='error'>Fehler beim Laden der mqttdevices: {e}</p>"
-        html += "</body></html>"
-        return html
+        context["error"] = e
+        return context
 
-    if not items:
-        html += f"<p>Keine mqttdevices im Namespace '{namespace}' gefunden.</p>"
-        html += "</body></html>"
-        return html
-
-    # 2) Für jedes mqttdevices: ausgeben + zugehörige Device-Infos
+    # 2) Für jedes mqttdevices: zugehörige Device-Infos
     for mqttdev in items:
-        mqttdev_name = mqttdev["metadata"]["name"]
         spec = mqttdev.get("spec", {})
 
         # mqttSettings
         mqtt_settings = spec.get("mqttSettings", {})
         mqtt_root_topic = mqtt_settings.get("topic", "devices")
-        broker = mqtt_settings.get("broker", "n/a")
 
         # deviceRef: link zur Device-Ressource (clusterweit)
-        device_ref = spec.get("deviceRef", None)
-
-        html += f"<div class='device-card'>"
-        html += f"<h2>mqtt-device-ui: {mqttdev_name}</h2>"
-        html += "<table>"
-        html += f"<tr><th>deviceRef</th><td>{device_ref}</td></tr>"
-        html += f"<tr><th>Broker</th><td>{broker}</td></tr>"
-        html += f"<tr><th>Root Topic</th><td>{mqtt_root_topic}</td></tr>"
-        html += "</table>"
-
-        # --- Device laden (clusterweit) ---
-        if not device_ref:
-            html += "<p class='error'>Kein deviceRef angegeben.</p>"
-            html += "</div>"
+        card = {
+            "name": mqttdev["metadata"]["name"],
+            "device_ref": spec.get("deviceRef", None),
+            "broker": mqtt_settings.get("broker", "n/a"),
+            "root_topic": mqtt_root_topic,
+            "device_error": None,
+            "sensors": [],
+            "actors": [],
+        }
+        context["cards"].append(card)
+        # Letzte Werte, die der Listener in status.lastValues schreibt (bis der Live-Stream übernimmt)
+        last_values = (mqttdev.get("status") or {}).get("lastValues") or {}
+        if not card["device_ref"]:
             continue
 
-        try:
-            device_cr = custom_api.get_cluster_custom_object(
-                group="iiot.mc-b.ch",
-                version="v1alpha1",
-                plural="devices",  # Device ist clusterweit
-                name=device_ref
-            )
-            device_spec = device_cr.get("spec", {})
-            device_topic = device_spec.get("topic", device_ref)
-
-            html += f"<h3>Device: {device_ref} (topic={device_topic})</h3>"
-
-            # --- Sensors bearbeiten ---
-            sensors = device_spec.get("sensors", [])
-            if sensors:
-                html += "<table>"
-                html += "<tr><th>Sensor Ref</th><th>Full Topic</th><th>Aktion</th></tr>"
-                for sensor_entry in sensors:
-                    sensor_ref = sensor_entry.get("sensorRef")
-                    if not sensor_ref:
-                        continue
-
-                    try:
-                        sensor_cr = custom_api.get_cluster_custom_object(
-                            group="iiot.mc-b.ch",
-                            version="v1alpha1",
-                            plural="sensors",
-                            name=sensor_ref
-                        )
-                        sensor_spec = sensor_cr.get("spec", {})
-                        sensor_topic = sensor_spec.get("topic", sensor_ref)
-
-                        # Baue das *volle* Topic zusammen:
-                        # z.B. devices/m5stackcore/env
-                        full_topic = f"{mqtt_root_topic}/{device_topic}/{sensor_topic}"
-
-                        # Button: POST /publish
-                        # => übergibt "topic"=full_topic & "sensorRef"=sensor_ref
-                        html += "<tr>"
-                        html += f"<td>{sensor_ref}</td>"
-                        html += f"<td>{full_topic}</td>"
-                        html += f"""
-                            <td>
-                              <form action="/publish" method="POST" style="display:inline;">
-                                  <input type="hidden" name="topic" value="{full_topic}">
-                                  <input type="hidden" name="sensorRef" value="{sensor_ref}">
-                                  <button type="submit" class="sensor-button">Send Data</button>
-                              </form>
-                            </td>
-                        """
-                        html += "</tr>"
-
-                    except Exception as e_s:
-                        html += f"<tr><td colspan='3' class='error'>Fehler beim Laden von Sensor {sensor_ref}: {e_s}</td></tr>"
-                html += "</table>"
-            else:
-                html += "<p>Keine Sensoren vorhanden.</p>"
-
-            # --- Actors bearbeiten ---
-            actors = device_spec.get("actors", [])
-            if actors:
-                html += "<h4>Actors</h4>"
-                html += "<table>"
-                html += "<tr><th>Actor Ref</th><th>Topic</th></tr>"
-                for actor_entry in actors:
-                    actor_ref = actor_entry.get("actorRef")
-                    if not actor_ref:
-                        continue
-                    try:
-                        actor_cr = custom_api.get_cluster_custom_object(
-                            group="iiot.mc-b.ch",
-                            version="v1alpha1",
-                            plural="actors",
-                            name=actor_ref
-                        )
-                        actor_spec = actor_cr.get("spec", {})
-                        actor_topic = actor_spec.get("topic", actor_ref)
-                        # Hier könnte man auch das Full-Topic bauen (wenn relevant)
-                        # full_topic = f"{mqtt_root_topic}/{device_topic}/{actor_topic}"
-
-                        html += f"<tr><td>{actor_ref}</td><td>{actor_topic}</td></tr>"
-                    except Exception as e_a:
-                        html += f"<tr><td colspan='2' class='error'>Fehler beim Laden von Actor {actor_ref}: {e_a}</td></tr>"
-                html += "</table>"
-            html += "</div>"  # Ende device-card
-        except Exception as e_d:
-            html += f"<p class='error'>Fehler beim Laden der Device-Ressource '{device_ref}': {e_d}</p>"
-            html += "</div>"
-
-    html += "</body></html>"
-    return html
+        device_cr = resource_cache.get("devices", card["device_ref"])
+        if device_cr is None:
+            card["device_error"] = f"devices/{card['device_ref']} nicht gefunden"
+            continue
+        device_spec = device_cr.get("spec", {})
+        card["device_topic"] = device_topic = device_spec.get("topic", card["device_ref"])
+
+        # --- Sensors: volles Topic, z.B. devices/m5stackcore/env ---
+        for sensor_entry in device_spec.get("sensors", []):
+            sensor_ref = sensor_entry.get("sensorRef")
+            if not sensor_ref:
+                continue
+            sensor_cr = resource_cache.get("sensors", sensor_ref)
+            if sensor_cr is None:
+                card["sensors"].append({"ref": sensor_ref, "error": f"sensors/{sensor_ref} nicht gefunden"})
+                continue
+            sensor_topic = sensor_cr.get("spec", {}).get("topic", sensor_ref)
+            card["sensors"].append({
+                "ref": sensor_ref,
+                "topic": f"{mqtt_root_topic}/{device_topic}/{sensor_topic}",
+                "last": format_last_value(last_values.get(sensor_ref)),
+            })
+
+        # --- Actors ---
+        for actor_entry in device_spec.get("actors", []):
+            actor_ref = actor_entry.get("actorRef")
+            if not actor_ref:
+                continue
+            actor_cr = resource_cache.get("actors", actor_ref)
+            if actor_cr is None:
+                card["actors"].append({"ref": actor_ref, "error": f"actors/{actor_ref} nicht gefunden"})
+                continue
+            actor_topic = actor_cr.get("spec", {}).get("topic", actor_ref)
+            card["actors"].append({"ref": actor_ref, "topic": f"{mqtt_root_topic}/{device_topic}/{actor_topic}"})
+    return context
+
+def format_last_value(last):
+    """status.lastValues eines Sensors als (Text, Zeitpunkt), z.B. ("Temperature=25.4, Humidity=51.6", "...Z")."""
+    if not last:
+        return None
+    values = last.get("values") or {}
+    text = values["raw"] if set(values) == {"raw"} else ", ".join(
+        f"{name}={value}" for name, value in values.items() if value is not None)
+    return text, last.get("time", "")
+
+def sensor_topics(namespace):
+    """Volle Sensor-Topics aller MQTTDevices eines Namespaces (aus dem Cache)."""
+    topics = []
+    for mqttdev in resource_cache.mqttdevices(namespace):
+        topics += mqttdevice_sensor_topics(mqttdev)
+    return topics
+
+def mqttdevice_sensor_topics(mqttdev):
+    """Volle Sensor-Topics eines MQTTDevices, z.B. devices/m5stackcore/env."""
+    spec = mqttdev.get("spec", {})
+    mqtt_root_topic = spec.get("mqttSettings", {}).get("topic", "devices")
+    device = resource_cache.get("devices", spec.get("deviceRef") or "")
+    if device is None:
+        return []
+    device_topic = device.get("spec", {}).get("topic", spec["deviceRef"])
+    topics = []
+    for sensor_entry in device.get("spec", {}).get("sensors", []):
+        sensor_ref = sensor_entry.get("sensorRef")
+        sensor = resource_cache.get("sensors", sensor_ref or "")
+        if sensor is not None:
+            topics.append(f"{mqtt_root_topic}/{device_topic}/{sensor.get('spec', {}).get('topic', sensor_ref)}")
+    return topics
+
+def mqttdevice_actor_topics(mqttdev):
+    """Volle Actor-Topics eines MQTTDevices (actorRef -> Topic), z.B. devices/m5stackcore/servo."""
+    spec = mqttdev.get("spec", {})
+    mqtt_root_topic = spec.get("mqttSettings", {}).get("topic", "devices")
+    device = resource_cache.get("devices", spec.get("deviceRef") or "")
+    if device is None:
+        return {}
+    device_topic = device.get("spec", {}).get("topic", spec["deviceRef"])
+    topics = {}
+    for actor_entry in device.get("spec", {}).get("actors", []):
+        actor_ref = actor_entry.get("actorRef")
+        actor = resource_cache.get("actors", actor_ref or "")
+        if actor is not None:
+            topics[actor_ref] = f"{mqtt_root_topic}/{device_topic}/{actor.get('spec', {}).get('topic', actor_ref)}"
+    return topics
+
+# --------------------------------------
+# Stream-Route: /stream
+#    Server-Sent Events mit dem letzten Wert pro Topic (zusammengefasst
+#    alle STREAM_INTERVAL_MS); Topics per ?topic=... oder alle Sensoren
+#    des Namespaces
+# --------------------------------------
+@app.route("/stream")
+def stream():
+    topics = request.args.getlist("topic") or sensor_topics(request.args.get("namespace", "default"))
+    response = flask.Response(stream_with_context(telemetry_hub.events(topics)), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"  # kein Puffern in einem Ingress/Proxy
+    return response
 
 # --------------------------------------
 # D) Publish-Route: /publish
@@ -272,12 +362,166 @@ def publish():
     try:
         mqtt_client.publish(full_topic, payload)
         msg = f"Data '{payload}' auf Topic '{full_topic}' gesendet."
-        print(msg)
+        log.info(msg)
         # Zurück zur Hauptseite
         return redirect("/")
     except Exception as e:
         return f"Fehler beim Publish auf '{full_topic}': {e}", 500
 
+# --------------------------------------
+# E) JSON-API für Massen-Publish: /api/publish, /api/jobs
+#    POST /api/publish startet einen Job und liefert sofort dessen ID:
+#      {"messages": [{"topic": ..., "payload": ..., "qos": 1}, ...], "rate": 100}
+#    oder als Vorlage (ohne topics: alle Sensor-Topics des MQTTDevices):
+#      {"mqttdevice": "au-u69", "namespace": "default",
+#       "template": "0x{seq:X},{random:15:30:2},{random:30:70:1},middle",
+#       "rate": 50, "count": 10000, "duration": 300}
+#    QoS/Retain kommen aus mqttSettings des MQTTDevices, falls angegeben.
+# --------------------------------------
+@app.route("/api/publish", methods=["POST"])
+def api_publish():
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return jsonify({"error": "JSON-Objekt erwartet"}), 400
+
+    qos = body.get("qos", 0)
+    retain = body.get("retain", False)
+    topics = body.get("topics")
+    if body.get("mqttdevice"):
+        namespace = body.get("namespace", "default")
+        mqttdev = next(
+            (m for m in resource_cache.mqttdevices(namespace) if m["metadata"]["name"] == body["mqttdevice"]),
+            None,
+        )
+        if mqttdev is None:
+            return jsonify({"error": f"MQTTDevice '{body['mqttdevice']}' in '{namespace}' nicht gefunden"}), 404
+        mqtt_settings = mqttdev.get("spec", {}).get("mqttSettings", {})
+        qos = body.get("qos", mqtt_settings.get("qos", 0))
+        retain = body.get("retain", mqtt_settings.get("retain", False))
+        topics = topics or mqttdevice_sensor_topics(mqttdev)
+
+    try:
+        job = PublishJob(
+            messages=body.get("messages"),
+            topics=topics,
+            template=body.get("template"),
+            rate=body.get("rate", 0),
+            count=body.get("count"),
+            duration=body.get("duration"),
+            qos=int(qos),
+            retain=retain,
+            seed=body.get("seed"),
+        )
+        publish_jobs.submit(job)
+    except (ValueError, KeyError, IndexError, TypeError) as e:
+        return jsonify({"error": f"Ungültiger Job: {e}"}), 400
+    except OverflowError as e:
+        return jsonify({"error": str(e)}), 429
+
+    status = job.status()
+    status["status_url"] = f"/api/jobs/{job.id}"
+    return jsonify(status), 202
+
+@app.route("/api/jobs")
+def api_jobs():
+    return jsonify(publish_jobs.statuses())
+
+@app.route("/api/jobs/<job_id>", methods=["GET", "DELETE"])
+def api_job(job_id):
+    if request.method == "DELETE" and not publish_jobs.cancel(job_id):
+        return jsonify({"error": f"Job '{job_id}' nicht gefunden"}), 404
+    status = publish_jobs.status(job_id)
+    if status is None:
+        return jsonify({"error": f"Job '{job_id}' nicht gefunden"}), 404
+    return jsonify(status)
+
+# --------------------------------------
+# F) Befehle an Aktoren: /api/commands
+#    POST /api/commands publiziert einen oder mehrere Befehle und liefert
+#    sofort deren IDs (202); die Antwort des Geräts kommt über
+#    <Actor-Topic>/reply und wird per Correlation-ID zugeordnet:
+#      {"mqttdevice": "au-u69", "namespace": "default", "actor": "servo",
+#       "command": "move", "args": {"angle": 90}, "timeout": 5}
+#    oder mehrere: {"mqttdevice": ..., "commands": [{"actor": ..., "command": ...}, ...]}
+#    Mit "wait": N wartet der Request höchstens N Sekunden auf alle Antworten.
+#    GET /api/commands/<id>[?wait=N] liefert Status und Round-Trip-Zeit,
+#    GET /api/commands/stats die Perzentile pro Actor.
+# --------------------------------------
+COMMAND_MAX_WAIT = float(os.environ.get("COMMAND_MAX_WAIT", "10"))
+COMMAND_DEFAULT_TIMEOUT = float(os.environ.get("COMMAND_TIMEOUT", "5"))
+
+def wait_commands(commands, wait: float):
+    """Wartet höchstens wait Sekunden (begrenzt auf COMMAND_MAX_WAIT) auf alle Befehle."""
+    deadline = time.monotonic() + min(max(wait, 0.0), COMMAND_MAX_WAIT)
+    for command in commands:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not command.wait(remaining):
+            break
+
+@app.route("/api/commands", methods=["POST"])
+def api_commands():
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not body.get("mqttdevice"):
+        return jsonify({"error": "JSON-Objekt mit mqttdevice erwartet"}), 400
+    namespace = body.get("namespace", "default")
+    mqttdev = next(
+        (m for m in resource_cache.mqttdevices(namespace) if m["metadata"]["name"] == body["mqttdevice"]),
+        None,
+    )
+    if mqttdev is None:
+        return jsonify({"error": f"MQTTDevice '{body['mqttdevice']}' in '{namespace}' nicht gefunden"}), 404
+    actor_topics = mqttdevice_actor_topics(mqttdev)
+    qos = int(mqttdev.get("spec", {}).get("mqttSettings", {}).get("qos", 1))
+
+    items = body.get("commands") if "commands" in body else [body]
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "commands muss eine nicht leere Liste sein"}), 400
+    try:
+        wait = float(body.get("wait") or 0)
+        commands = []
+        for item in items:
+            actor = item["actor"]
+            if actor not in actor_topics:
+                return jsonify({"error": f"Actor '{actor}' gehört nicht zu '{body['mqttdevice']}'"}), 404
+            commands.append(Command(
+                actor, actor_topics[actor], item["command"], item.get("args"),
+                timeout=float(item.get("timeout", body.get("timeout", COMMAND_DEFAULT_TIMEOUT))),
+                qos=int(item.get("qos", qos)),
+            ))
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({"error": f"Ungültiger Befehl: {e}"}), 400
+
+    for command in commands:
+        command_channel.send(command)
+    wait_commands(commands, wait)
+
+    statuses = []
+    for command in commands:
+        status = command.status()
+        status["status_url"] = f"/api/commands/{command.id}"
+        statuses.append(status)
+    code = 202 if any(s["state"] == STATE_PENDING for s in statuses) else 200
+    return jsonify(statuses if "commands" in body else statuses[0]), code
+
+@app.route("/api/commands/stats")
+def api_command_stats():
+    return jsonify(command_channel.stats())
+
+@app.route("/api/commands/<command_id>")
+def api_command(command_id):
+    try:
+        wait = float(request.args.get("wait") or 0)
+    except ValueError:
+        return jsonify({"error": "wait muss eine Zahl sein"}), 400
+    command = command_channel.get(command_id)
+    if command is not None and wait > 0:
+        wait_commands([command], wait)
+    status = command_channel.status(command_id)
+    if status is None:
+        return jsonify({"error": f"Befehl '{command_id}' nicht gefunden"}), 404
+    return jsonify(status)
+
 if __name__ == "__main__":
+    # Entwicklungsserver; im Container läuft gunicorn (siehe gunicorn.conf.py)
     port = int(os.environ.get("PORT", 8080))
-    app.run(host="0.0.0.0", port=port, debug=True)
+    app.run(host="0.0.0.0", port=port, debug=os.environ.get("UI_DEBUG", "false").lower() == "true", threaded=True)
@@ -0,0 +1,311 @@
+"""
+Asynchrone Publish-Jobs für Inbetriebnahme- und Lasttests.
+
+Ein Job publiziert entweder eine feste Liste von Nachrichten oder erzeugt
+sie aus einer Vorlage (Topics, Payload-Template, Rate, Anzahl, Dauer). Er
+läuft in einem eigenen Thread über den gemeinsamen MQTT-Client des UIs; der
+Request erhält sofort eine Job-ID, Fortschritt und erreichte Rate werden
+über /api/jobs/<id> abgefragt. Höchstens max_inflight Nachrichten eines Jobs
+sind gleichzeitig unbestätigt (paho puffert sonst unbegrenzt); published und
+rate zählen erst, was paho über on_publish als gesendet (QoS 0) bzw. vom
+Broker bestätigt (QoS 1/2) meldet. Mit state_dir wird der Status zusätzlich als
+Datei abgelegt, damit bei mehreren gunicorn-Workern jeder Worker jeden Job
+kennt und abbrechen kann.
+
+Platzhalter im Payload-Template (str.format):
+
+    {seq}                 laufende Nummer der Nachricht (ab 0)
+    {topic}               Topic der Nachricht
+    {time}                Unix-Zeit in Sekunden
+    {random:15:30:2}      Zufallszahl zwischen 15 und 30 mit 2 Nachkommastellen
+"""
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+
+import paho.mqtt.client as mqtt
+
+STATE_RUNNING = "running"
+STATE_DONE = "done"
+STATE_CANCELLED = "cancelled"
+STATE_FAILED = "failed"
+
+
+class _Random:
+    """{random:LOW:HIGH[:STELLEN]} im Template."""
+
+    def __init__(self, rng):
+        self.rng = rng
+
+    def __format__(self, spec: str) -> str:
+        parts = spec.split(":") if spec else []
+        low = float(parts[0]) if len(parts) > 0 else 0.0
+        high = float(parts[1]) if len(parts) > 1 else 1.0
+        digits = int(parts[2]) if len(parts) > 2 else 2
+        return f"{self.rng.uniform(low, high):.{digits}f}"
+
+
+class PublishJob:
+
+    def __init__(self, messages=None, topics=None, template=None, rate=0.0, count=None,
+                 duration=None, qos=0, retain=False, seed=None, max_inflight=100):
+        if messages is None and not topics:
+            raise ValueError("Entweder 'messages' oder 'topics' angeben")
+        if messages is not None:
+            for m in messages:
+                if "topic" not in m or "payload" not in m:
+                    raise ValueError("Jede Nachricht braucht 'topic' und 'payload'")
+        if qos not in (0, 1, 2):
+            raise ValueError(f"Ungültige QoS {qos}")
+        if template is not None:
+            template.format(seq=0, topic="", time=0.0, random=_Random(random.Random()))  # früh validieren
+
+        self.id = uuid.uuid4().hex[:12]
+        self.messages = messages
+        self.topics = list(topics or [])
+        self.template = template if template is not None else "{seq}"
+        self.rate = float(rate or 0)
+        self.duration = float(duration) if duration else None
+        if count is None and self.duration is None:
+            count = len(messages) if messages is not None else len(self.topics)
+        self.count = int(count) if count is not None else None
+        if messages is not None:
+            self.count = min(self.count, len(messages)) if self.count is not None else len(messages)
+        self.qos = qos
+        self.retain = bool(retain)
+        self.rng = random.Random(seed)
+        self.max_inflight = max(1, int(max_inflight))
+
+        self.state = STATE_RUNNING
+        self.error = None
+        self.published = 0
+        self.failed = 0
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self._cancel = threading.Event()
+        self._lock = threading.Lock()
+        self._pending = set()    # mids ohne on_publish
+        self._inflight = deque()  # MQTTMessageInfo in Sende-Reihenfolge
+
+    def cancel(self):
+        self._cancel.set()
+
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    def on_publish(self, mid: int) -> bool:
+        """Zählt eine gesendete bzw. bestätigte Nachricht; False, wenn mid nicht zu diesem Job gehört."""
+        with self._lock:
+            if mid not in self._pending:
+                return False
+            self._pending.discard(mid)
+            self.published += 1
+            return True
+
+    def message(self, seq: int):
+        """(Topic, Payload, QoS, Retain) der seq-ten Nachricht."""
+        if self.messages is not None:
+            m = self.messages[seq]
+            return m["topic"], m["payload"], m.get("qos", self.qos), m.get("retain", self.retain)
+        topic = self.topics[seq % len(self.topics)]
+        payload = self.template.format(seq=seq, topic=topic, time=time.time(), random=_Random(self.rng))
+        return topic, payload, self.qos, self.retain
+
+    def run(self, mqtt_client, on_progress=None, progress_interval: float = 0.5):
+        self.started = time.perf_counter()
+        next_progress = self.started + progress_interval
+        end = None if self.duration is None else self.started + self.duration
+        seq = 0
+        try:
+            while not self._cancel.is_set():
+                if self.count is not None and seq >= self.count:
+                    break
+                now = time.perf_counter()
+                if end is not None and now >= end:
+                    break
+                if on_progress is not None and now >= next_progress:
+                    on_progress(self)
+                    next_progress = now + progress_interval
+                if self.rate > 0:
+                    due = self.started + seq / self.rate
+                    if due > now:
+                        self._cancel.wait(min(due - now, 0.05))
+                        continue
+                if len(self._inflight) >= self.max_inflight:
+                    self._wait_oldest()
+                    continue
+                topic, payload, qos, retain = self.message(seq)
+                info = mqtt_client.publish(topic, payload, qos=qos, retain=retain)
+                if info.rc == mqtt.MQTT_ERR_QUEUE_SIZE:
+                    # Ausgehende Queue des Clients voll (max_queued_messages_set): warten, dann erneut
+                    self._wait_oldest()
+                    continue
+                if info.rc == mqtt.MQTT_ERR_SUCCESS:
+                    with self._lock:
+                        self._pending.add(info.mid)
+                    self._inflight.append(info)
+                else:
+                    self.failed += 1
+                seq += 1
+                self._reap()
+            # Ausstehende Bestätigungen abwarten, solange der Job nicht abgebrochen wird
+            while self._inflight and not self._cancel.is_set():
+                self._wait_oldest()
+            self.state = STATE_CANCELLED if self._cancel.is_set() else STATE_DONE
+        except Exception as e:
+            self.state = STATE_FAILED
+            self.error = str(e)
+        finally:
+            self.finished = time.perf_counter()
+            if on_progress is not None:
+                on_progress(self)
+
+    def _reap(self):
+        # on_publish kommt vor dem Flag der MQTTMessageInfo und evtl. vor der Registrierung
+        # der mid; was schon als gesendet gilt, wird hier nachgezählt (on_publish zählt nur einmal)
+        while self._inflight and self._inflight[0].is_published():
+            self.on_publish(self._inflight.popleft().mid)
+
+    def _wait_oldest(self):
+        if self._inflight:
+            self._inflight[0].wait_for_publish(0.1)
+        else:
+            self._cancel.wait(0.05)
+        self._reap()
+
+    def status(self) -> dict:
+        elapsed = 0.0
+        if self.started is not None:
+            elapsed = (self.finished or time.perf_counter()) - self.started
+        return {
+            "id": self.id,
+            "state": self.state,
+            "published": self.published,
+            "failed": self.failed,
+            "inflight": len(self._pending),
+            "total": self.count,
+            "target_rate": self.rate,
+            "rate": round(self.published / elapsed, 1) if elapsed > 0 else 0.0,
+            "elapsed": round(elapsed, 3),
+            "qos": self.qos,
+            "retain": self.retain,
+            "error": self.error,
+            "created": self.created,
+        }
+
+
+class JobManager:
+    """Startet Jobs in eigenen Threads und behält die letzten history Jobs."""
+
+    def __init__(self, mqtt_client, max_running: int = 4, history: int = 100, state_dir: str = None,
+                 max_inflight: int = 100):
+        self.mqtt_client = mqtt_client
+        self.max_running = max_running
+        self.max_inflight = max(1, max_inflight)
+        self.history = history
+        self.state_dir = state_dir
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        if state_dir:
+            os.makedirs(state_dir, exist_ok=True)
+
+    def submit(self, job: PublishJob) -> PublishJob:
+        with self._lock:
+            running = sum(1 for j in self._jobs.values() if j.state == STATE_RUNNING)
+            if running >= self.max_running:
+                raise OverflowError(f"Bereits {running} Jobs aktiv (Maximum {self.max_running})")
+            job.max_inflight = min(job.max_inflight, self.max_inflight)
+            self._jobs[job.id] = job
+            while len(self._jobs) > self.history:
+                oldest = next(iter(self._jobs))
+                if self._jobs[oldest].state == STATE_RUNNING:
+                    break
+                del self._jobs[oldest]
+                self._remove_state(oldest)
+        self._write_state(job)
+        threading.Thread(
+            target=job.run, args=(self.mqtt_client, self._on_progress), name=f"publish-{job.id}", daemon=True,
+        ).start()
+        return job
+
+    def on_publish(self, client, userdata, mid):
+        """on_publish des MQTT-Clients: an den Job mit dieser mid weitergeben."""
+        with self._lock:
+            running = [j for j in self._jobs.values() if j.state == STATE_RUNNING]
+        for job in running:
+            if job.on_publish(mid):
+                return
+
+    def status(self, job_id: str):
+        """Status eines Jobs dieses oder (über state_dir) eines anderen Workers, sonst None."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None:
+            return job.status()
+        return self._read_state(job_id)
+
+    def cancel(self, job_id: str) -> bool:
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None:
+            job.cancel()
+            return True
+        if self._read_state(job_id) is None:
+            return False
+        # Job läuft in einem anderen Worker: der merkt es beim nächsten Fortschritt
+        open(self._path(job_id, ".cancel"), "w").close()
+        return True
+
+    def statuses(self) -> list:
+        """Status aller bekannten Jobs, nach Erstellung sortiert."""
+        with self._lock:
+            result = {job.id: job.status() for job in self._jobs.values()}
+        if self.state_dir:
+            for name in os.listdir(self.state_dir):
+                job_id, ext = os.path.splitext(name)
+                if ext == ".json" and job_id not in result:
+                    status = self._read_state(job_id)
+                    if status is not None:
+                        result[job_id] = status
+        return sorted(result.values(), key=lambda s: s.get("created", 0))
+
+    # --------------------------------------
+    # Status-Dateien (geteilt zwischen Workern)
+    # --------------------------------------
+    def _path(self, job_id: str, ext: str) -> str:
+        return os.path.join(self.state_dir, f"{job_id}{ext}")
+
+    def _on_progress(self, job: PublishJob):
+        self._write_state(job)
+        if self.state_dir and not job.cancelled() and os.path.exists(self._path(job.id, ".cancel")):
+            job.cancel()
+
+    def _write_state(self, job: PublishJob):
+        if not self.state_dir:
+            return
+        tmp = self._path(job.id, ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(job.status(), f)
+        os.replace(tmp, self._path(job.id, ".json"))
+
+    def _read_state(self, job_id: str):
+        if not self.state_dir or not job_id.isalnum():
+            return None
+        try:
+            with open(self._path(job_id, ".json"), encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _remove_state(self, job_id: str):
+        if self.state_dir:
+            for ext in (".json", ".cancel"):
+                try:
+                    os.remove(self._path(job_id, ext))
+                except OSError:
+                    pass
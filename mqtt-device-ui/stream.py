@@ -0,0 +1,146 @@
+"""
+Live-Telemetrie für das UI über Server-Sent Events.
+
+Alle Browser teilen sich die Abos des einen MQTT-Clients (Referenzzähler pro
+Topic). Eingehende Nachrichten werden pro Topic zusammengefasst: nur der
+letzte Wert wird alle interval Sekunden an die Clients verteilt, die das
+Topic sehen wollen. Jeder Client hat einen begrenzten Puffer; ist er voll,
+weil der Browser nicht nachkommt, fallen die ältesten Einträge weg.
+"""
+import json
+import threading
+import time
+from collections import deque
+
+from metrics import STREAM_CLIENTS, STREAM_DROPPED
+
+
+class StreamClient:
+    """Begrenzter Puffer eines Browsers."""
+
+    def __init__(self, topics: set, buffer_size: int):
+        self.topics = topics
+        self.dropped = 0
+        self._events = deque(maxlen=buffer_size)
+        self._cond = threading.Condition()
+
+    def push(self, events: list):
+        with self._cond:
+            overflow = len(self._events) + len(events) - self._events.maxlen
+            if overflow > 0:
+                self.dropped += overflow
+                STREAM_DROPPED.inc(overflow)
+            self._events.extend(events)
+            self._cond.notify()
+
+    def wait(self, timeout: float) -> list:
+        with self._cond:
+            if not self._events:
+                self._cond.wait(timeout)
+            events = list(self._events)
+            self._events.clear()
+            return events
+
+
+class TelemetryHub:
+
+    def __init__(self, mqtt_client, interval: float = 0.5, buffer_size: int = 256, heartbeat: float = 15.0):
+        self.mqtt_client = mqtt_client
+        self.interval = interval
+        self.buffer_size = buffer_size
+        self.heartbeat = heartbeat
+        self._lock = threading.Lock()
+        self._clients = set()
+        self._refcount = {}  # Topic -> Anzahl Clients
+        self._latest = {}    # Topic -> (Payload, Zeitpunkt), seit der letzten Verteilung
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="telemetry-hub", daemon=True)
+            self._thread.start()
+
+    # --------------------------------------
+    # MQTT-Callbacks
+    # --------------------------------------
+    def on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            # Nach einem Reconnect die Abos der offenen Streams erneuern
+            with self._lock:
+                topics = sorted(self._refcount)
+            for topic in topics:
+                client.subscribe(topic)
+
+    def on_message(self, client, userdata, msg):
+        with self._lock:
+            if msg.topic in self._refcount:
+                self._latest[msg.topic] = (msg.payload.decode("utf-8", errors="replace"), time.time())
+
+    # --------------------------------------
+    # Clients
+    # --------------------------------------
+    def register(self, topics: list) -> StreamClient:
+        stream_client = StreamClient(set(topics), self.buffer_size)
+        subscribe = []
+        with self._lock:
+            self._clients.add(stream_client)
+            STREAM_CLIENTS.inc()
+            for topic in stream_client.topics:
+                self._refcount[topic] = self._refcount.get(topic, 0) + 1
+                if self._refcount[topic] == 1:
+                    subscribe.append(topic)
+        for topic in subscribe:
+            self.mqtt_client.subscribe(topic)
+        return stream_client
+
+    def unregister(self, stream_client: StreamClient):
+        unsubscribe = []
+        with self._lock:
+            if stream_client in self._clients:
+                self._clients.discard(stream_client)
+                STREAM_CLIENTS.dec()
+            for topic in stream_client.topics:
+                self._refcount[topic] -= 1
+                if self._refcount[topic] == 0:
+                    del self._refcount[topic]
+                    self._latest.pop(topic, None)
+                    unsubscribe.append(topic)
+        for topic in unsubscribe:
+            self.mqtt_client.unsubscribe(topic)
+
+    def events(self, topics: list):
+        """Generator für eine SSE-Antwort; meldet den Client beim Abbruch ab."""
+        stream_client = self.register(topics)
+        try:
+            yield f"event: topics\ndata: {json.dumps(sorted(stream_client.topics))}\n\n"
+            while True:
+                events = stream_client.wait(self.heartbeat)
+                if not events:
+                    yield ": keep-alive\n\n"  # hält Proxies und die Verbindung offen
+                    continue
+                for topic, payload, received in events:
+                    data = json.dumps({"topic": topic, "payload": payload, "time": received})
+                    yield f"data: {data}\n\n"
+        finally:
+            self.unregister(stream_client)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "clients": len(self._clients),
+                "topics": len(self._refcount),
+                "dropped": sum(c.dropped for c in self._clients),
+            }
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                latest, self._latest = self._latest, {}
+                clients = list(self._clients)
+            if not latest:
+                continue
+            for stream_client in clients:
+                events = [(t, p, r) for t, (p, r) in latest.items() if t in stream_client.topics]
+                if events:
+                    stream_client.push(events)
@@ -0,0 +1,223 @@
+"""
+Watch-basierter Cache der CRs für das UI.
+
+Statt pro Seitenaufruf alle MQTTDevices und danach jedes Device, jeden
+Sensor und jeden Aktor einzeln vom API-Server zu holen, hält ein Informer
+pro Ressource (list + watch) die Objekte im Speicher. Device, Sensor und
+Actor sind clusterweit, MQTTDevices werden pro Namespace beim ersten Zugriff
+beobachtet. Da der Namespace aus der URL kommt, laufen höchstens
+max_namespaces solche Informer; für einen neuen werden zuerst die länger als
+idle_timeout unbenutzten, sonst der am längsten unbenutzte beendet.
+
+Aus den resourceVersions der beteiligten Informer entsteht ein ETag; solange
+sich nichts ändert, kann das UI mit 304 antworten.
+"""
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from kubernetes import client, watch
+
+from metrics import CACHE_LOOKUPS
+
+GROUP = "iiot.mc-b.ch"
+VERSION = "v1alpha1"
+CLUSTER_PLURALS = ("devices", "sensors", "actors")
+
+log = logging.getLogger(__name__)
+
+
+class Informer:
+    """Hält alle Objekte einer Ressource aktuell (list, danach watch ab resourceVersion)."""
+
+    def __init__(self, api, plural: str, namespace: str = None, watch_timeout: int = 300):
+        self.api = api
+        self.plural = plural
+        self.namespace = namespace
+        self.watch_timeout = watch_timeout
+        self.resource_version = None
+        self.last_modified = datetime.now(timezone.utc)
+        self.error = None
+        self.synced = threading.Event()
+        self._objects = {}  # Name -> Objekt
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._watch = None
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            name = f"informer-{self.plural}" + (f"-{self.namespace}" if self.namespace else "")
+            self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._watch is not None:
+            self._watch.stop()
+
+    def get(self, name: str):
+        with self._lock:
+            return self._objects.get(name)
+
+    def items(self) -> list:
+        with self._lock:
+            return [self._objects[name] for name in sorted(self._objects)]
+
+    # --------------------------------------
+    # Interna
+    # --------------------------------------
+    def _call_args(self) -> dict:
+        args = {"group": GROUP, "version": VERSION, "plural": self.plural}
+        if self.namespace:
+            args["namespace"] = self.namespace
+        return args
+
+    def _list_func(self):
+        if self.namespace:
+            return self.api.list_namespaced_custom_object
+        return self.api.list_cluster_custom_object
+
+    def _list(self):
+        result = self._list_func()(**self._call_args())
+        objects = {item["metadata"]["name"]: item for item in result.get("items", [])}
+        with self._lock:
+            changed = objects != self._objects
+            self._objects = objects
+            self.resource_version = result.get("metadata", {}).get("resourceVersion")
+            if changed:
+                self.last_modified = datetime.now(timezone.utc)
+            self.error = None
+        self.synced.set()
+
+    def _apply(self, event_type: str, obj: dict):
+        name = obj["metadata"]["name"]
+        with self._lock:
+            if event_type == "DELETED":
+                self._objects.pop(name, None)
+            else:
+                self._objects[name] = obj
+            self.resource_version = obj["metadata"].get("resourceVersion", self.resource_version)
+            self.last_modified = datetime.now(timezone.utc)
+
+    def _run(self):
+        backoff = 1.0
+        while not self._stop.is_set():
+            try:
+                self._list()
+                backoff = 1.0
+                while not self._stop.is_set():
+                    if not self._watch_once():
+                        break  # resourceVersion veraltet: neu listen
+            except Exception as e:
+                with self._lock:
+                    self.error = e
+                self.synced.set()  # Wartende nicht blockieren, Fehler wird angezeigt
+                log.error(f"Fehler im Watch auf {self.plural}: {e}")
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, 60.0)
+
+    def _watch_once(self) -> bool:
+        """Ein Watch-Durchlauf; False, wenn neu gelistet werden muss."""
+        self._watch = watch.Watch()
+        try:
+            for event in self._watch.stream(
+                self._list_func(),
+                resource_version=self.resource_version,
+                timeout_seconds=self.watch_timeout,
+                allow_watch_bookmarks=True,
+                **self._call_args(),
+            ):
+                obj = event["object"]
+                if event["type"] == "ERROR":
+                    # z.B. 410 Gone: resourceVersion nicht mehr vorhanden
+                    return False
+                if event["type"] == "BOOKMARK":
+                    with self._lock:
+                        self.resource_version = obj["metadata"].get("resourceVersion", self.resource_version)
+                    continue
+                self._apply(event["type"], obj)
+        except client.exceptions.ApiException as e:
+            if e.status == 410:
+                return False
+            raise
+        finally:
+            self._watch.stop()
+        return True
+
+
+class ResourceCache:
+    """Informer für Device/Sensor/Actor und pro Namespace für MQTTDevices."""
+
+    def __init__(self, api=None, sync_timeout: float = 10.0, max_namespaces: int = 20, idle_timeout: float = 600.0):
+        self.api = api or client.CustomObjectsApi()
+        self.sync_timeout = sync_timeout
+        self.max_namespaces = max(1, max_namespaces)
+        self.idle_timeout = idle_timeout
+        self._cluster = {}
+        self._namespaced = OrderedDict()  # Namespace -> Informer der MQTTDevices (LRU-Reihenfolge)
+        self._last_used = {}              # Namespace -> letzter Zugriff (monotonic)
+        self._lock = threading.Lock()
+
+    def _informers(self, namespace: str) -> list:
+        with self._lock:
+            if not self._cluster:
+                for plural in CLUSTER_PLURALS:
+                    self._cluster[plural] = Informer(self.api, plural)
+                    self._cluster[plural].start()
+            now = time.monotonic()
+            if namespace not in self._namespaced:
+                self._evict_locked(now)
+                self._namespaced[namespace] = Informer(self.api, "mqttdevices", namespace)
+                self._namespaced[namespace].start()
+            self._namespaced.move_to_end(namespace)
+            self._last_used[namespace] = now
+            informers = [self._namespaced[namespace]] + [self._cluster[p] for p in CLUSTER_PLURALS]
+        # Beim ersten Zugriff auf die initiale Liste warten
+        deadline = time.monotonic() + self.sync_timeout
+        for informer in informers:
+            informer.synced.wait(max(0.0, deadline - time.monotonic()))
+        return informers
+
+    def mqttdevices(self, namespace: str) -> list:
+        """MQTTDevices des Namespaces; wirft den letzten Fehler, falls nie geladen."""
+        informer = self._informers(namespace)[0]
+        if informer.error is not None and informer.resource_version is None:
+            raise informer.error
+        return informer.items()
+
+    def get(self, plural: str, name: str):
+        """Clusterweites Device/Sensor/Actor oder None."""
+        with self._lock:
+            informer = self._cluster.get(plural)
+        obj = informer.get(name) if informer is not None else None
+        CACHE_LOOKUPS.labels(plural, "miss" if obj is None else "hit").inc()
+        return obj
+
+    def version(self, namespace: str):
+        """(ETag, Last-Modified) über alle Objekte, die die Seite des Namespaces zeigt."""
+        informers = self._informers(namespace)
+        key = "|".join([namespace] + [f"{i.plural}={i.resource_version}" for i in informers])
+        etag = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return etag, max(i.last_modified for i in informers)
+
+    def _evict_locked(self, now: float):
+        # Unbenutzte Namespaces beenden, dann notfalls den am längsten unbenutzten
+        for namespace in list(self._namespaced):
+            if now - self._last_used[namespace] >= self.idle_timeout:
+                self._stop_namespace_locked(namespace)
+        while len(self._namespaced) >= self.max_namespaces:
+            self._stop_namespace_locked(next(iter(self._namespaced)))
+
+    def _stop_namespace_locked(self, namespace: str):
+        log.info(f"Beende Informer der MQTTDevices in Namespace '{namespace}'.")
+        self._namespaced.pop(namespace).stop()
+        del self._last_used[namespace]
+
+    def stop(self):
+        with self._lock:
+            for informer in list(self._cluster.values()) + list(self._namespaced.values()):
+                informer.stop()
@@ -0,0 +1,16 @@
+"""
+WSGI-Einstiegspunkt für gunicorn (mqtt-device-ui.py lässt sich wegen des
+Bindestrichs nicht direkt importieren):
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+"""
+import importlib.util
+import os
+
+_spec = importlib.util.spec_from_file_location(
+    "mqtt_device_ui", os.path.join(os.path.dirname(os.path.abspath(__file__)), "mqtt-device-ui.py")
+)
+ui = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(ui)
+
+app = ui.app
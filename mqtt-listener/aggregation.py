@@ -0,0 +1,274 @@
+"""
+Aggregation und Downsampling von Sensorwerten im Listener.
+
+Pro Topic (aus spec.aggregation des MQTTDevices) werden die numerischen
+Werte in Zeitfenstern zusammengefasst und beim Schliessen des Fensters als
+ein Datensatz ausgegeben:
+
+    {"start": 1737360000.0, "end": 1737360060.0, "count": 60,
+     "Temperature.min": 21.3, "Temperature.max": 21.9, "Temperature.mean": 21.6, ...}
+
+- window: Fensterlänge in Sekunden; slide: Abstand der Fenster (0 = window,
+  also nicht überlappend/tumbling; kleiner als window = gleitend)
+- functions: Auswahl aus count, min, max, mean, last
+- deadband: Rohwerte werden nur gespeichert, wenn sich mindestens ein Wert
+  um mehr als deadband gegenüber dem zuletzt gespeicherten geändert hat
+- mode: "both" speichert Rohdaten und Aggregate, "aggregate" nur Aggregate
+
+Die Fenster sind an der Epoche ausgerichtet (60 s = volle Minuten) und
+werden über die Empfangszeit zugeordnet. Die Ausgabe (Datei, Segmente,
+abgeleitetes Topic <Topic>/<suffix>) übernimmt der emit-Callback.
+"""
+import logging
+import math
+import threading
+import time
+
+from metrics import AGGREGATES, MESSAGES_SUPPRESSED
+
+log = logging.getLogger(__name__)
+
+FUNCTIONS = ("count", "min", "max", "mean", "last")
+MODE_BOTH = "both"
+MODE_AGGREGATE = "aggregate"
+
+# Obergrenze überlappender Fenster pro Nachricht (window / slide)
+MAX_OVERLAP = 60
+
+
+class AggregationSpec:
+    """Einstellungen eines Topics aus spec.aggregation."""
+
+    def __init__(self, window: float = 60.0, slide: float = 0.0, functions=FUNCTIONS, deadband: float = None,
+                 mode: str = MODE_BOTH, suffix: str = "agg", publish: bool = True, broker: str = None,
+                 qos: int = 0):
+        if window <= 0:
+            raise ValueError("window muss grösser als 0 sein")
+        unknown = set(functions) - set(FUNCTIONS)
+        if unknown:
+            raise ValueError(f"Unbekannte Funktionen {sorted(unknown)}, erlaubt: {FUNCTIONS}")
+        if mode not in (MODE_BOTH, MODE_AGGREGATE):
+            raise ValueError(f"Unbekannter Modus '{mode}'")
+        self.window = float(window)
+        self.slide = float(slide) if slide and 0 < slide < window else self.window
+        if self.window / self.slide > MAX_OVERLAP:
+            raise ValueError(f"slide zu klein: höchstens {MAX_OVERLAP} überlappende Fenster")
+        self.functions = tuple(f for f in FUNCTIONS if f in functions)
+        self.deadband = float(deadband) if deadband is not None else None
+        self.mode = mode
+        self.suffix = suffix
+        self.publish = publish
+        self.broker = broker
+        self.qos = qos
+
+    @classmethod
+    def from_dict(cls, spec: dict):
+        return cls(
+            window=float(spec.get("window", 60)),
+            slide=float(spec.get("slide", 0)),
+            functions=spec.get("functions") or FUNCTIONS,
+            deadband=spec.get("deadband"),
+            mode=spec.get("mode", MODE_BOTH),
+            suffix=spec.get("topicSuffix", "agg"),
+            publish=bool(spec.get("publish", True)),
+            broker=spec.get("broker"),
+            qos=int(spec.get("qos", 0)),
+        )
+
+    def derived_topic(self, topic: str) -> str:
+        return f"{topic}/{self.suffix}"
+
+    def columns(self, names: list) -> list:
+        """Spalten des Aggregats in der Reihenfolge der Ausgabe."""
+        columns = ["count"] if "count" in self.functions else []
+        for name in names:
+            columns += [f"{name}.{fn}" for fn in self.functions if fn != "count"]
+        return columns
+
+
+class _Window:
+
+    def __init__(self, start: float, end: float, size: int):
+        self.start = start
+        self.end = end
+        self.count = 0
+        self.n = [0] * size
+        self.min = [math.inf] * size
+        self.max = [-math.inf] * size
+        self.sum = [0.0] * size
+        self.last = [math.nan] * size
+
+    def add(self, values: list):
+        self.count += 1
+        for i, v in enumerate(values):
+            if math.isnan(v):
+                continue
+            self.n[i] += 1
+            self.sum[i] += v
+            self.last[i] = v
+            if v < self.min[i]:
+                self.min[i] = v
+            if v > self.max[i]:
+                self.max[i] = v
+
+    def record(self, names: list, functions: tuple) -> dict:
+        record = {"start": self.start, "end": self.end}
+        if "count" in functions:
+            record["count"] = self.count
+        for i, name in enumerate(names):
+            has = self.n[i] > 0
+            for fn in functions:
+                if fn == "min":
+                    record[f"{name}.min"] = self.min[i] if has else None
+                elif fn == "max":
+                    record[f"{name}.max"] = self.max[i] if has else None
+                elif fn == "mean":
+                    record[f"{name}.mean"] = self.sum[i] / self.n[i] if has else None
+                elif fn == "last":
+                    record[f"{name}.last"] = self.last[i] if has else None
+        return record
+
+
+class _TopicState:
+
+    def __init__(self, spec: AggregationSpec, columns: list):
+        self.spec = spec
+        self.columns = columns
+        self.windows = {}           # Start -> _Window
+        self.emitted_until = 0.0    # Fenster, die davor enden, sind ausgegeben
+        self.kept = None            # zuletzt gespeicherte Rohwerte (Deadband)
+
+
+class Aggregator:
+    """
+    Fasst die Werte der konfigurierten Topics zusammen. process() wird vom
+    Worker des Datei-Sinks aufgerufen, ein eigener Thread schliesst fällige
+    Fenster und ruft emit(topic, derived_topic, record, spec) auf.
+    """
+
+    def __init__(self, decoders, emit, tick: float = 1.0):
+        self.decoders = decoders
+        self.emit = emit
+        self.tick = tick
+        self._topics = {}  # Topic -> _TopicState
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def apply(self, specs: dict):
+        """Übernimmt Topic -> spec.aggregation (inkl. broker); offene Fenster unveränderter Topics bleiben."""
+        topics = {}
+        for topic, spec_dict in specs.items():
+            decoder = self.decoders.get(topic)
+            if decoder is None or not decoder.columns:
+                continue
+            try:
+                spec = AggregationSpec.from_dict(spec_dict)
+            except (TypeError, ValueError) as e:
+                log.error(f"Aggregation für {topic} ungültig: {e}")
+                continue
+            with self._lock:
+                current = self._topics.get(topic)
+            if current is not None and vars(current.spec) == vars(spec) and current.columns == decoder.columns:
+                topics[topic] = current
+            else:
+                topics[topic] = _TopicState(spec, list(decoder.columns))
+        with self._lock:
+            dropped = [t for t in self._topics if t not in topics or topics[t] is not self._topics[t]]
+            previous, self._topics = self._topics, topics
+        # Fenster entfernter oder geänderter Topics noch ausgeben
+        for topic in dropped:
+            self._emit_windows(topic, previous[topic], math.inf)
+
+    def columns(self) -> dict:
+        """Abgeleitetes Topic -> Spalten der Aggregate (für den SegmentStore)."""
+        with self._lock:
+            return {
+                state.spec.derived_topic(topic): state.spec.columns(state.columns)
+                for topic, state in self._topics.items()
+            }
+
+    def process(self, topic: str, payload_str: str, ts: float) -> bool:
+        """Nimmt die Werte auf; False, wenn die Rohdaten nicht gespeichert werden sollen."""
+        state = self._topics.get(topic)
+        if state is None:
+            return True
+        decoder = self.decoders.get(topic)
+        values = decoder.numbers(payload_str) if decoder is not None else None
+        if values is None or len(values) != len(state.columns):
+            return True  # nicht dekodierbar: Rohdaten wie bisher speichern
+        spec = state.spec
+        with self._lock:
+            first = math.floor((ts - spec.window) / spec.slide) + 1
+            last = math.floor(ts / spec.slide)
+            for k in range(first, last + 1):
+                start = k * spec.slide
+                end = start + spec.window
+                if end <= state.emitted_until:
+                    continue  # Fenster bereits ausgegeben (verspätete Nachricht)
+                window = state.windows.get(start)
+                if window is None:
+                    window = state.windows[start] = _Window(start, end, len(values))
+                window.add(values)
+            keep = spec.mode == MODE_BOTH and self._outside_deadband(state, values)
+        if not keep:
+            MESSAGES_SUPPRESSED.labels(topic).inc()
+        return keep
+
+    def flush(self, now: float = None):
+        """Gibt alle Fenster aus, die vor now enden."""
+        now = time.time() if now is None else now
+        with self._lock:
+            topics = list(self._topics.items())
+        for topic, state in topics:
+            self._emit_windows(topic, state, now)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="aggregator", daemon=True)
+            self._thread.start()
+
+    def close(self):
+        """Beendet den Thread und gibt alle offenen (auch unvollständigen) Fenster aus."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush(math.inf)
+
+    # --------------------------------------
+    # Interna
+    # --------------------------------------
+    @staticmethod
+    def _outside_deadband(state: _TopicState, values: list) -> bool:
+        deadband = state.spec.deadband
+        if deadband is None or state.kept is None:
+            state.kept = values
+            return True
+        for v, prev in zip(values, state.kept):
+            if math.isnan(v) != math.isnan(prev) or (not math.isnan(v) and abs(v - prev) > deadband):
+                state.kept = values
+                return True
+        return False
+
+    def _emit_windows(self, topic: str, state: _TopicState, now: float):
+        with self._lock:
+            due = sorted(start for start, w in state.windows.items() if w.end <= now)
+            windows = [state.windows.pop(start) for start in due]
+            if windows:
+                state.emitted_until = max(state.emitted_until, max(w.end for w in windows))
+        derived = state.spec.derived_topic(topic)
+        wall = time.time()
+        for window in windows:
+            record = window.record(state.columns, state.spec.functions)
+            if window.end > wall:
+                record["partial"] = True  # beim Beenden vorzeitig geschlossen
+            try:
+                self.emit(topic, derived, record, state.spec)
+                AGGREGATES.labels(topic).inc()
+            except Exception as e:
+                log.error(f"Aggregat für {derived} konnte nicht ausgegeben werden: {e}")
+
+    def _run(self):
+        while not self._stop.wait(self.tick):
+            self.flush()
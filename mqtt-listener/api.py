@@ -0,0 +1,79 @@
+"""
+Schlanker HTTP-Server des Listeners (nur Standardbibliothek).
+
+Handler werden pro Pfad registriert und erhalten die Query-Parameter als
+Dict (jeweils erster Wert); sie liefern (Status, Content-Type, Body).
+"""
+import json
+import logging
+import threading
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+log = logging.getLogger(__name__)
+
+
+def json_response(data, status: int = 200):
+    return status, "application/json", json.dumps(data)
+
+
+def parse_time(value: str, default: float) -> float:
+    """Epoch-Sekunden oder ISO-8601 (z.B. 2025-01-27T10:00:00+00:00)."""
+    if value is None or value == "":
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+class ApiServer:
+
+    def __init__(self, port: int = 8080, host: str = "0.0.0.0"):
+        self.host = host
+        self.port = port
+        self.routes = {}
+        self._server = None
+
+    def route(self, path: str, handler):
+        self.routes[path] = handler
+
+    def start(self):
+        routes = self.routes
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                handler = routes.get(url.path)
+                if handler is None:
+                    status, content_type, body = json_response({"error": f"Unbekannter Pfad {url.path}"}, 404)
+                else:
+                    params = {k: v[0] for k, v in parse_qs(url.query).items()}
+                    try:
+                        status, content_type, body = handler(params)
+                    except (KeyError, ValueError) as e:
+                        status, content_type, body = json_response({"error": f"Ungültige Anfrage: {e}"}, 400)
+                    except Exception as e:
+                        log.error(f"Fehler in {url.path}: {e}")
+                        status, content_type, body = json_response({"error": str(e)}, 500)
+                data = body.encode("utf-8") if isinstance(body, str) else body
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass  # kein Zugriffslog pro Request
+
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="api-server", daemon=True).start()
+        log.info(f"HTTP-API auf Port {self.port} gestartet.")
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
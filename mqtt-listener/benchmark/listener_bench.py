@@ -0,0 +1,458 @@
+"""
+Lasttest für den Ingestion-Pfad des MQTT-Listeners.
+
+Erzeugt Nachrichten mit einstellbarer Rate, Anzahl Topics und Payload-Mix
+(ENV-CSV, RFID, JSON order/shipment) und schickt sie durch on_message,
+Pipeline, Datei-Sink/Segmente und CloudEvents-Forwarder. Ein Stub-HTTP-
+Empfänger nimmt die CloudEvents entgegen.
+
+Ohne --broker werden die Nachrichten direkt an on_message übergeben (kein
+Broker nötig, ersetzt den Netzwerk-Thread von paho). Mit --broker werden
+sie über einen echten Broker (z.B. lokaler Mosquitto) publiziert und vom
+Listener mit BrokerConnections abonniert.
+
+Gemessen werden:
+- Durchsatz: bestätigte Nachrichten pro Sekunde (Ack nach dem Speichern, QoS >= 1)
+- Latenz p50/p99: Senden -> Ack (Speicherpfad) und Senden -> Empfang (CloudEvents)
+- CPU (User+System des ganzen Prozesses, inkl. Generator) und RSS
+
+Beispiel:
+
+    python mqtt-listener/benchmark/listener_bench.py --rate 2000 --duration 30 \\
+        --topics 50 --mix env=70,rfid=20,order=5,shipment=5 --storage both
+"""
+import argparse
+import contextlib
+import importlib.util
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LISTENER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, LISTENER_DIR)
+
+PAYLOAD_TYPES = ("env", "rfid", "order", "shipment")
+
+# Broker-URL der Zuordnung im Modus ohne Broker (on_message direkt)
+IN_PROCESS_BROKER = "mqtt://in-process"
+
+
+def load_listener():
+    """Lädt mqtt-listener.py als Modul (Dateiname mit Bindestrich)."""
+    spec = importlib.util.spec_from_file_location("mqtt_listener", os.path.join(LISTENER_DIR, "mqtt-listener.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def parse_mix(value: str) -> list:
+    """"env=70,rfid=20,order=10" -> [(Typ, Gewicht), ...]"""
+    mix = []
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in PAYLOAD_TYPES:
+            raise ValueError(f"Unbekannter Payload-Typ '{name}', erlaubt: {PAYLOAD_TYPES}")
+        mix.append((name, float(weight or 1)))
+    return mix
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, int(round(p / 100.0 * (len(values) - 1)))))
+    return values[k]
+
+
+def current_rss_kb() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (OSError, ValueError):
+        return 0
+
+
+class PayloadGenerator:
+    """Erzeugt eindeutige Nachrichten (die Sequenznummer steckt im Payload)."""
+
+    def __init__(self, topics: int, mix: list, seed: int = 42):
+        self.random = random.Random(seed)
+        self.names = [name for name, _w in mix]
+        self.weights = [w for _n, w in mix]
+        self.topics = max(1, topics)
+
+    def topic_values(self) -> dict:
+        # Wertenamen wie spec.values von enviii, damit die Segmente mitlaufen
+        return {
+            f"bench/dev{i}/env": ["Temperature", "Humidity", "Atmospheric Pressure"]
+            for i in range(self.topics)
+        }
+
+    def topic_schemas(self) -> dict:
+        # spec.format wie bei enviii: Adresse und Position werden übersprungen
+        schema = {
+            "format": {"type": "csv", "fields": ["", "Temperature", "Humidity", "Atmospheric Pressure", ""]},
+            "values": [{"name": "Temperature"}, {"name": "Humidity"}, {"name": "Atmospheric Pressure"}],
+        }
+        return {topic: schema for topic in self.topic_values()}
+
+    def next(self, seq: int):
+        kind = self.random.choices(self.names, self.weights)[0]
+        device = f"dev{seq % self.topics}"
+        r = self.random
+        if kind == "env":
+            # Erstes Feld ist hexadezimal und wird beim Parsen übersprungen
+            payload = f"0x{seq:X},{r.uniform(15, 30):.2f},{r.uniform(30, 70):.1f},{r.uniform(950, 1050):.1f},middle"
+        elif kind == "rfid":
+            payload = f"0x{seq:08X}{r.getrandbits(24):06X}"
+        else:
+            payload = json.dumps({
+                "bench_seq": seq,
+                "id": f"{kind}-{seq}",
+                "customer": f"C{r.randint(1, 500)}",
+                "items": [{"sku": f"A{r.randint(1, 999)}", "qty": r.randint(1, 5)} for _ in range(r.randint(1, 4))],
+            })
+        return f"bench/{device}/{kind}", payload.encode("utf-8"), kind in ("order", "shipment")
+
+
+class LatencyRecorder:
+    """Merkt sich Sendezeitpunkte und misst bis zum Ack bzw. bis zum CloudEvent-Empfang."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sent = {}          # Payload -> Sendezeitpunkt
+        self._by_mid = {}        # Message-ID -> Sendezeitpunkt
+        self._ce_sent = {}       # bench_seq -> Sendezeitpunkt
+        self.ack_latencies = []
+        self.ce_latencies = []
+        self.received = 0
+        self.last_ack = 0.0
+        self.last_ce = 0.0
+
+    def sent(self, payload: bytes, seq: int, cloudevent: bool):
+        now = time.perf_counter()
+        with self._lock:
+            self._sent[payload] = now
+            if cloudevent:
+                self._ce_sent[seq] = now
+
+    def received_message(self, msg):
+        with self._lock:
+            self.received += 1
+            t = self._sent.pop(msg.payload, None)
+            if t is not None:
+                self._by_mid[msg.mid] = t
+
+    def acked(self, mid: int):
+        now = time.perf_counter()
+        with self._lock:
+            t = self._by_mid.pop(mid, None)
+            if t is not None:
+                self.ack_latencies.append(now - t)
+                self.last_ack = now
+
+    def cloudevent(self, data):
+        now = time.perf_counter()
+        if not isinstance(data, dict) or "bench_seq" not in data:
+            return
+        with self._lock:
+            t = self._ce_sent.pop(data["bench_seq"], None)
+            if t is not None:
+                self.ce_latencies.append(now - t)
+                self.last_ce = now
+
+    def pending(self) -> tuple:
+        with self._lock:
+            return len(self._sent) + len(self._by_mid), len(self._ce_sent)
+
+
+class CloudEventReceiver:
+    """Stub für den Knative-Broker-Ingress: nimmt Events an und antwortet 202."""
+
+    def __init__(self, recorder: LatencyRecorder, delay: float = 0.0):
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # Keep-Alive wie beim echten Ingress
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", "0")))
+                if delay:
+                    time.sleep(delay)
+                try:
+                    data = json.loads(body)
+                    if "batch" in self.headers.get("Content-Type", ""):
+                        for event in data:
+                            recorder.cloudevent(event.get("data"))
+                    else:
+                        recorder.cloudevent(data)
+                except ValueError:
+                    pass
+                self.send_response(202)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self._server.server_address[1]}/"
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, name="ce-receiver", daemon=True).start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class FakeMessage:
+    """Entspricht den von on_message verwendeten Feldern von paho's MQTTMessage."""
+
+    __slots__ = ("topic", "payload", "qos", "mid")
+
+    def __init__(self, topic: str, payload: bytes, qos: int, mid: int):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.mid = mid
+
+
+class AckingClient:
+    """Stellt client.ack() für on_message bereit und misst dabei die Latenz."""
+
+    def __init__(self, recorder: LatencyRecorder, client=None):
+        self.recorder = recorder
+        self.client = client
+
+    def ack(self, mid: int, qos: int):
+        self.recorder.acked(mid)
+        if self.client is not None:
+            self.client.ack(mid, qos)
+
+
+def build_listener(listener, data_dir: str, storage: str, topic_values: dict, topic_schemas: dict = None):
+    """Baut Sink, Segmente, Forwarder und Pipeline wie main() im Listener."""
+    decoders = listener.DecoderRegistry()
+    decoders.apply(topic_schemas or {}, topic_values)
+    sink = None
+    if storage in ("text", "both"):
+        sink = listener.FileSink.from_env(data_dir)
+        sink.start()
+    segments = None
+    if storage in ("columnar", "both"):
+        segments = listener.SegmentStore.from_env(data_dir)
+        segments.columns_by_topic = decoders.columns()
+        segments.decoders = decoders
+        segments.start()
+    forward_workers = int(os.environ.get("FORWARD_WORKERS", "4"))
+    forwarder = listener.CloudEventForwarder.from_env(data_dir, pool_size=forward_workers)
+    forwarder.start()
+    pipeline = listener.create_pipeline(data_dir, sink, segments, forwarder, forward_workers, decoders)
+    pipeline.start()
+    return sink, segments, forwarder, pipeline
+
+
+def publish_loop(generator, recorder, publish, rate: float, duration: float, stop: threading.Event) -> int:
+    """Sendet mit der Zielrate (0 = so schnell wie möglich); liefert die Anzahl Nachrichten."""
+    seq = 0
+    start = time.perf_counter()
+    end = start + duration
+    while not stop.is_set():
+        now = time.perf_counter()
+        if now >= end:
+            break
+        if rate > 0:
+            due = start + seq / rate
+            if due > now:
+                time.sleep(min(due - now, 0.01))
+                continue
+        topic, payload, cloudevent = generator.next(seq)
+        recorder.sent(payload, seq, cloudevent)
+        publish(seq, topic, payload)
+        seq += 1
+    return seq
+
+
+def run(args) -> dict:
+    mix = parse_mix(args.mix)
+    generator = PayloadGenerator(args.topics, mix, args.seed)
+    recorder = LatencyRecorder()
+    receiver = CloudEventReceiver(recorder, args.receiver_delay)
+    receiver.start()
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="listener-bench-")
+    os.environ.update({
+        "DATA_DIR": data_dir,
+        "CLOUDEVENTS_URL": receiver.url,
+        "CLOUDEVENTS_HOST": "",
+        "PIPELINE_STATS_INTERVAL": "0",
+    })
+    listener = load_listener()
+    # Mit --verbose auch die Zeile pro Nachricht (DEBUG), sonst nur Warnungen und Fehler
+    listener.setup_logging(level="DEBUG" if args.verbose else "WARNING")
+    out = sys.stdout if args.verbose else open(os.devnull, "w")
+
+    stop = threading.Event()
+    usage_start = resource.getrusage(resource.RUSAGE_SELF)
+    wall_start = time.perf_counter()
+    with contextlib.redirect_stdout(out):
+        sink, segments, forwarder, pipeline = build_listener(
+            listener, data_dir, args.storage, generator.topic_values(), generator.topic_schemas()
+        )
+        connections = publisher = None
+        topics = [f"bench/dev{i}/{kind}" for i in range(generator.topics) for kind, _w in mix]
+        if args.broker:
+            def on_message(client, userdata, msg):
+                recorder.received_message(msg)
+                listener.on_message(AckingClient(recorder, client), userdata, msg)
+
+            connections = listener.BrokerConnections(
+                f"listener-bench-{os.getpid()}", on_message, {"pipeline": pipeline}, clean_session=True,
+                wildcard_min=args.wildcard_min,
+            )
+            config = {"bench": {"broker": args.broker, "topics": topics}}
+            connections.apply({args.broker: dict.fromkeys(topics, args.qos)}, listener.routes_by_broker(config))
+            publisher = connect_publisher(args.broker)
+            time.sleep(1.0)  # Abos abwarten
+
+            def publish(seq, topic, payload):
+                publisher.publish(topic, payload, qos=args.qos)
+        else:
+            client = AckingClient(recorder)
+            # Nur die Zuordnung über den Trie, ohne Verbindung
+            router = listener.BrokerConnections(f"listener-bench-{os.getpid()}", None, {})
+            router.apply({}, listener.routes_by_broker({"bench": {"broker": IN_PROCESS_BROKER, "topics": topics}}))
+            userdata = {"pipeline": pipeline, "connections": router, "broker": IN_PROCESS_BROKER}
+
+            def publish(seq, topic, payload):
+                msg = FakeMessage(topic, payload, args.qos, seq + 1)
+                recorder.received_message(msg)
+                listener.on_message(client, userdata, msg)
+
+        publish_start = time.perf_counter()
+        published = publish_loop(generator, recorder, publish, args.rate, args.duration, stop)
+        publish_end = time.perf_counter()
+
+        # Warten, bis alles bestätigt bzw. empfangen ist
+        deadline = time.monotonic() + args.drain_timeout
+        while time.monotonic() < deadline:
+            pending_acks, pending_ce = recorder.pending()
+            if (args.qos == 0 or pending_acks == 0) and pending_ce == 0:
+                break
+            time.sleep(0.05)
+        rss_peak_run = current_rss_kb()
+
+        if connections is not None:
+            connections.close()
+        if publisher is not None:
+            publisher.loop_stop()
+            publisher.disconnect()
+        pipeline.stop(timeout=args.drain_timeout)
+        forwarder_stats = forwarder.stats()
+        forwarder.close()
+        if segments is not None:
+            segments.close()
+        if sink is not None:
+            sink.close()
+    receiver.stop()
+    wall = time.perf_counter() - wall_start
+    usage_end = resource.getrusage(resource.RUSAGE_SELF)
+
+    pending_acks, pending_ce = recorder.pending()
+    last = max(recorder.last_ack, recorder.last_ce, publish_end)
+    cpu = (usage_end.ru_utime - usage_start.ru_utime) + (usage_end.ru_stime - usage_start.ru_stime)
+    result = {
+        "mode": "broker" if args.broker else "in-process",
+        "storage": args.storage,
+        "qos": args.qos,
+        "topics": generator.topics,
+        "mix": args.mix,
+        "target_rate": args.rate,
+        "published": published,
+        "publish_rate": published / max(publish_end - publish_start, 1e-9),
+        "received": recorder.received,
+        "acked": len(recorder.ack_latencies),
+        "throughput": len(recorder.ack_latencies) / max(last - publish_start, 1e-9),
+        "unacked": pending_acks if args.qos > 0 else None,
+        "ack_p50_ms": percentile(recorder.ack_latencies, 50) * 1000,
+        "ack_p99_ms": percentile(recorder.ack_latencies, 99) * 1000,
+        "cloudevents": len(recorder.ce_latencies),
+        "cloudevents_missing": pending_ce,
+        "ce_p50_ms": percentile(recorder.ce_latencies, 50) * 1000,
+        "ce_p99_ms": percentile(recorder.ce_latencies, 99) * 1000,
+        "forwarder": forwarder_stats,
+        "cpu_seconds": cpu,
+        "cpu_percent": 100.0 * cpu / max(wall, 1e-9),
+        "rss_kb": rss_peak_run,
+        "max_rss_kb": usage_end.ru_maxrss,
+    }
+    if not args.data_dir and not args.keep:
+        shutil.rmtree(data_dir, ignore_errors=True)
+    return result
+
+
+def connect_publisher(broker: str):
+    import paho.mqtt.client as mqtt
+    from subscriptions import parse_broker_url
+
+    host, port = parse_broker_url(broker)
+    publisher = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=f"listener-bench-pub-{os.getpid()}")
+    publisher.max_inflight_messages_set(1000)
+    publisher.connect(host, port, 60)
+    publisher.loop_start()
+    return publisher
+
+
+def print_report(r: dict):
+    print(f"Modus:        {r['mode']}, Speicher {r['storage']}, QoS {r['qos']}, {r['topics']} Topics, Mix {r['mix']}")
+    print(f"Gesendet:     {r['published']} Nachrichten ({r['publish_rate']:.0f}/s, Ziel {r['target_rate'] or 'max'})")
+    if r["qos"] > 0:
+        print(f"Durchsatz:    {r['throughput']:.0f} Nachrichten/s gespeichert und bestätigt ({r['acked']}, offen {r['unacked']})")
+        print(f"Latenz Ack:   p50 {r['ack_p50_ms']:.2f} ms, p99 {r['ack_p99_ms']:.2f} ms")
+    else:
+        print("Durchsatz:    QoS 0 ohne Acks, nur CloudEvents werden gemessen")
+    print(
+        f"CloudEvents:  {r['cloudevents']} empfangen, {r['cloudevents_missing']} fehlen, "
+        f"p50 {r['ce_p50_ms']:.2f} ms, p99 {r['ce_p99_ms']:.2f} ms"
+    )
+    print(f"CPU:          {r['cpu_seconds']:.2f} s ({r['cpu_percent']:.0f} % eines Kerns, inkl. Generator)")
+    print(f"Speicher:     RSS {r['rss_kb'] / 1024:.1f} MiB, Maximum {r['max_rss_kb'] / 1024:.1f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Lasttest für den Ingestion-Pfad des MQTT-Listeners")
+    parser.add_argument("--rate", type=float, default=1000, help="Nachrichten pro Sekunde (0 = Maximum)")
+    parser.add_argument("--duration", type=float, default=10, help="Dauer in Sekunden")
+    parser.add_argument("--topics", type=int, default=10, help="Anzahl Geräte; pro Gerät ein Topic je Payload-Typ")
+    parser.add_argument("--mix", default="env=70,rfid=20,order=5,shipment=5", help="Payload-Mix mit Gewichten")
+    parser.add_argument("--qos", type=int, default=1, choices=(0, 1, 2))
+    parser.add_argument("--storage", default="text", choices=("text", "columnar", "both"))
+    parser.add_argument("--broker", help="z.B. mqtt://localhost:1883; ohne wird on_message direkt aufgerufen")
+    parser.add_argument("--wildcard-min", type=int, default=0,
+                        help="Topics ab dieser Anzahl als Wildcard-Filter abonnieren (nur mit --broker, 0 = aus)")
+    parser.add_argument("--receiver-delay", type=float, default=0.0, help="Antwortzeit des CloudEvents-Stubs in Sekunden")
+    parser.add_argument("--drain-timeout", type=float, default=30, help="Sekunden, um auf offene Acks zu warten")
+    parser.add_argument("--data-dir", help="Ausgabeverzeichnis (Default: temporär, wird gelöscht)")
+    parser.add_argument("--keep", action="store_true", help="temporäres Ausgabeverzeichnis behalten")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", action="store_true", help="Ergebnis als JSON (für Vergleiche zwischen Versionen)")
+    parser.add_argument("--verbose", action="store_true", help="Ausgaben des Listeners anzeigen")
+    args = parser.parse_args()
+
+    result = run(args)
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_report(result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Gemeinsame CloudEvents-Hilfsfunktionen für Listener und Operator.
+
+Ein CloudEvent wird hier als Dict im "structured" Format gehalten
+(specversion, id, source, type, datacontenttype, data). Für den Versand
+einzelner Events wird daraus der "binary" Modus (Ce-* Header + JSON-Body),
+für Batches application/cloudevents-batch+json.
+
+Ist data bereits JSON-Text (z.B. die unveränderte MQTT-Nachricht), liegt
+er als "data_json" im Event und wird beim Versand unverändert eingesetzt,
+statt ihn wieder zu serialisieren. Er muss gültiges JSON sein, sonst wird
+der ganze Batch ungültig; anderer Text geht mit make_text_event als
+text/plain.
+"""
+import json
+import uuid
+
+import requests
+from requests.adapters import HTTPAdapter
+
+BATCH_CONTENT_TYPE = "application/cloudevents-batch+json"
+
+
+def new_session(pool_size: int = 10) -> requests.Session:
+    """Session mit Keep-Alive-Connection-Pool für den Broker-Ingress."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def make_event(data, source: str, event_type: str, event_id: str = None) -> dict:
+    """Erzeugt ein CloudEvent mit eindeutiger Id (damit der Broker deduplizieren kann)."""
+    return {
+        "specversion": "1.0",
+        "id": event_id or str(uuid.uuid4()),
+        "source": source,
+        "type": event_type,
+        "datacontenttype": "application/json",
+        "data": data,
+    }
+
+
+def make_raw_event(data_json: str, source: str, event_type: str, event_id: str = None) -> dict:
+    """Wie make_event, aber mit data als fertigem JSON-Text."""
+    event = make_event(None, source, event_type, event_id)
+    del event["data"]
+    event["data_json"] = data_json
+    return event
+
+
+def make_text_event(text: str, source: str, event_type: str, event_id: str = None) -> dict:
+    """Wie make_event, aber mit data als Text (text/plain), z.B. für ungültiges JSON."""
+    event = make_event(text, source, event_type, event_id)
+    event["datacontenttype"] = "text/plain"
+    return event
+
+
+def event_body(event: dict) -> bytes:
+    """Body eines Events im binary Modus (nur data)."""
+    if "data_json" in event:
+        return event["data_json"].encode("utf-8")
+    if event.get("datacontenttype") == "text/plain":
+        return event["data"].encode("utf-8")
+    return json.dumps(event["data"]).encode("utf-8")
+
+
+def batch_body(events: list) -> bytes:
+    """Body eines Batches; data_json wird als JSON-Wert "data" eingesetzt."""
+    parts = []
+    for event in events:
+        if "data_json" in event:
+            attributes = {k: v for k, v in event.items() if k != "data_json"}
+            parts.append(json.dumps(attributes)[:-1] + ', "data": ' + event["data_json"] + "}")
+        else:
+            parts.append(json.dumps(event))
+    return ("[" + ", ".join(parts) + "]").encode("utf-8")
+
+
+def send_event(session, url: str, event: dict, host: str = None, timeout: float = 10.0):
+    """Sendet ein einzelnes Event im binary Modus; wirft bei HTTP-Fehlern eine Exception."""
+    headers = {
+        "Ce-Id": event["id"],
+        "Ce-Specversion": event["specversion"],
+        "Ce-Type": event["type"],
+        "Ce-Source": event["source"],
+        "Content-Type": event.get("datacontenttype", "application/json"),
+    }
+    if host:
+        headers["Host"] = host
+    resp = session.post(url, headers=headers, data=event_body(event), timeout=timeout)
+    resp.raise_for_status()
+    return resp
+
+
+def send_batch(session, url: str, events: list, host: str = None, timeout: float = 10.0):
+    """Sendet mehrere Events in einem Request (CloudEvents batched mode)."""
+    headers = {"Content-Type": BATCH_CONTENT_TYPE}
+    if host:
+        headers["Host"] = host
+    resp = session.post(url, headers=headers, data=batch_body(events), timeout=timeout)
+    resp.raise_for_status()
+    return resp
+
+
+_default_session = None
+
+
+def send_cloudevent(url: str, data, source: str, event_type: str, host: str = None):
+    """
+    Einfacher Einzelversand über eine modulweite Session, z. B. für den Operator.
+    """
+    global _default_session
+    if _default_session is None:
+        _default_session = new_session()
+    return send_event(_default_session, url, make_event(data, source, event_type), host=host)
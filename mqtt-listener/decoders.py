@@ -0,0 +1,272 @@
+"""
+Decoder pro Topic aus dem Wire-Format des Sensors (spec.format).
+
+Der Operator legt pro Sensor-Topic das Schema in die Konfiguration:
+
+    "topic_schemas": {"au-u69/atom/env": {
+        "format": {"type": "csv", "fields": ["", "Temperature", "Humidity", ""]},
+        "values": [{"name": "Temperature", "type": "number"}, ...]}}
+
+Beim Übernehmen der Konfiguration wird daraus je Topic ein Decoder
+kompiliert (Feld-Indizes, Konverter, Regex), pro Nachricht bleibt nur noch
+das Zerlegen. Ein Decoder liefert einen normalisierten Datensatz
+{Wertename: typisierter Wert} bzw. die numerischen Werte für die Segmente.
+
+Formate:
+
+    csv    Felder nach Position (fields), "" überspringt ein Feld
+    json   Wert über field (Default: name), verschachtelt mit "a.b"
+    kv     "KEY=Wert,KEY2=Wert" (separator, assign)
+    regex  pattern mit benannten Gruppen (= field) oder Gruppen nach fields
+
+Topics ohne format (oder csv ohne fields) verwenden die bisherige
+Heuristik aus parse_reading. JSON-Nachrichten ohne Umbenennung oder
+Umrechnung werden unverändert weitergereicht (passthrough), der Forwarder
+sendet dann die Original-Bytes statt json.loads/json.dumps.
+"""
+import json
+import logging
+import math
+import re
+
+from segments import parse_reading
+
+log = logging.getLogger(__name__)
+
+FORMAT_CSV = "csv"
+FORMAT_JSON = "json"
+FORMAT_KV = "kv"
+FORMAT_REGEX = "regex"
+
+_TRUE = {"1", "true", "on", "yes", "ja"}
+
+
+def _to_bool(raw):
+    if isinstance(raw, bool):
+        return raw
+    if isinstance(raw, (int, float)):
+        return raw != 0
+    return str(raw).strip().lower() in _TRUE
+
+
+def _to_int(raw):
+    if isinstance(raw, str):
+        raw = raw.strip()
+        return int(raw, 0) if raw.lower().startswith(("0x", "0o", "0b")) else int(float(raw))
+    return int(raw)
+
+
+VALUE_TYPES = {
+    "number": float,
+    "integer": _to_int,
+    "string": lambda raw: raw.strip() if isinstance(raw, str) else str(raw),
+    "boolean": _to_bool,
+}
+NUMERIC_TYPES = ("number", "integer")
+
+
+class Value:
+    """Ein Wert aus spec.values: Quelle (field), Typ und optionale Umrechnung."""
+
+    def __init__(self, spec: dict):
+        self.name = spec["name"]
+        self.field = spec.get("field") or self.name
+        self.type = spec.get("type", "number")
+        if self.type not in VALUE_TYPES:
+            raise ValueError(f"Unbekannter Typ '{self.type}' für Wert '{self.name}'")
+        self.scale = float(spec.get("scale", 1.0))
+        self.offset = float(spec.get("offset", 0.0))
+        self.numeric = self.type in NUMERIC_TYPES
+        self.identity = self.field == self.name and self.scale == 1.0 and self.offset == 0.0
+        self._convert = VALUE_TYPES[self.type]
+
+    def convert(self, raw):
+        """Typisierter Wert oder None, falls nicht vorhanden oder nicht umwandelbar."""
+        if raw is None or raw == "":
+            return None
+        try:
+            value = self._convert(raw)
+        except (TypeError, ValueError):
+            return None
+        if self.numeric and not self.identity:
+            value = value * self.scale + self.offset
+        return value
+
+
+class Decoder:
+    """Basis: decode() liefert {Name: Wert} oder None, numbers() die Werte für die Segmente."""
+
+    passthrough = False
+
+    def __init__(self, values: list):
+        self.values = values
+        self.columns = [v.name for v in values if v.numeric]
+
+    def fields(self, payload_str: str):
+        """Rohwerte pro Value in der Reihenfolge von self.values (None = fehlt)."""
+        raise NotImplementedError
+
+    def decode(self, payload_str: str):
+        try:
+            raws = self.fields(payload_str)
+        except ValueError:
+            return None
+        if raws is None:
+            return None
+        record = {v.name: v.convert(raw) for v, raw in zip(self.values, raws)}
+        if all(value is None for value in record.values()):
+            return None
+        return record
+
+    def numbers(self, payload_str: str):
+        """Numerische Werte in der Reihenfolge von self.columns (NaN = fehlt), None ohne Werte."""
+        record = self.decode(payload_str)
+        if record is None:
+            return None
+        result = []
+        for name in self.columns:
+            value = record.get(name)
+            result.append(float(value) if value is not None else math.nan)
+        if all(math.isnan(v) for v in result):
+            return None
+        return result
+
+
+class CsvDecoder(Decoder):
+
+    def __init__(self, values: list, fields: list, separator: str = ","):
+        super().__init__(values)
+        self.separator = separator
+        positions = {name: i for i, name in enumerate(fields) if name}
+        self._indexes = [positions.get(v.field) for v in values]
+
+    def fields(self, payload_str: str):
+        parts = payload_str.strip().split(self.separator)
+        n = len(parts)
+        return [parts[i] if i is not None and i < n else None for i in self._indexes]
+
+
+class JsonDecoder(Decoder):
+
+    def __init__(self, values: list):
+        super().__init__(values)
+        self._paths = [tuple(v.field.split(".")) for v in values]
+        # Ohne Umbenennung/Umrechnung geht die Nachricht unverändert weiter
+        self.passthrough = all(v.identity for v in values)
+
+    def fields(self, payload_str: str):
+        data = json.loads(payload_str)
+        if not isinstance(data, dict):
+            return None
+        result = []
+        for path in self._paths:
+            node = data
+            for key in path:
+                node = node.get(key) if isinstance(node, dict) else None
+            result.append(node)
+        return result
+
+
+class KvDecoder(Decoder):
+
+    def __init__(self, values: list, separator: str = ",", assign: str = "="):
+        super().__init__(values)
+        self.separator = separator
+        self.assign = assign
+
+    def fields(self, payload_str: str):
+        pairs = {}
+        for part in payload_str.split(self.separator):
+            key, sep, value = part.partition(self.assign)
+            if sep:
+                pairs[key.strip()] = value
+        return [pairs.get(v.field) for v in self.values]
+
+
+class RegexDecoder(Decoder):
+
+    def __init__(self, values: list, pattern: str, fields: list = None):
+        super().__init__(values)
+        self.pattern = re.compile(pattern)
+        positions = {name: i + 1 for i, name in enumerate(fields or []) if name}
+        self._groups = []
+        for v in values:
+            if v.field in self.pattern.groupindex:
+                self._groups.append(v.field)
+            else:
+                self._groups.append(positions.get(v.field))
+
+    def fields(self, payload_str: str):
+        match = self.pattern.search(payload_str)
+        if match is None:
+            return None
+        return [match.group(g) if g is not None else None for g in self._groups]
+
+
+class LegacyDecoder(Decoder):
+    """Ohne format: numerische CSV-Felder der Reihe nach bzw. JSON über die Wertenamen."""
+
+    def __init__(self, columns: list):
+        super().__init__([Value({"name": name}) for name in columns])
+        self.passthrough = True
+
+    def decode(self, payload_str: str):
+        values = parse_reading(payload_str, self.columns)
+        if values is None:
+            return None
+        return {name: (None if math.isnan(v) else v) for name, v in zip(self.columns, values)}
+
+    def numbers(self, payload_str: str):
+        return parse_reading(payload_str, self.columns)
+
+
+def compile_decoder(schema: dict) -> Decoder:
+    """Kompiliert den Decoder eines Topics aus {"format": {...}, "values": [...]}."""
+    values = [Value(v) for v in schema.get("values", []) if v.get("name")]
+    fmt = schema.get("format") or {}
+    kind = fmt.get("type")
+    if kind is None or (kind == FORMAT_CSV and not fmt.get("fields")):
+        return LegacyDecoder([v.name for v in values if v.numeric])
+    if kind == FORMAT_CSV:
+        return CsvDecoder(values, fmt["fields"], fmt.get("separator", ","))
+    if kind == FORMAT_JSON:
+        return JsonDecoder(values)
+    if kind == FORMAT_KV:
+        return KvDecoder(values, fmt.get("separator", ","), fmt.get("assign", "="))
+    if kind == FORMAT_REGEX:
+        return RegexDecoder(values, fmt["pattern"], fmt.get("fields"))
+    raise ValueError(f"Unbekanntes Format '{kind}'")
+
+
+class DecoderRegistry:
+    """
+    Decoder aller Topics; wird bei jeder Konfigurationsänderung neu aufgebaut
+    und als Ganzes ausgetauscht, die Worker lesen ohne Lock.
+    """
+
+    def __init__(self):
+        self._decoders = {}
+        self._schemas = {}
+
+    def apply(self, schemas: dict, columns_by_topic: dict = None):
+        """Schemas (Topic -> Schema) kompilieren; Topics nur mit Wertenamen erhalten die Heuristik."""
+        decoders = {}
+        for topic, columns in (columns_by_topic or {}).items():
+            decoders[topic] = LegacyDecoder(columns)
+        for topic, schema in schemas.items():
+            if schema == self._schemas.get(topic) and topic in self._decoders:
+                decoders[topic] = self._decoders[topic]  # unverändert, nicht neu kompilieren
+                continue
+            try:
+                decoders[topic] = compile_decoder(schema)
+            except (KeyError, ValueError, re.error) as e:
+                log.error(f"Format für {topic} ungültig, verwende die Heuristik: {e}")
+        self._schemas = dict(schemas)
+        self._decoders = decoders
+
+    def get(self, topic: str):
+        return self._decoders.get(topic)
+
+    def columns(self) -> dict:
+        """Topic -> numerische Wertenamen (für den SegmentStore)."""
+        return {topic: d.columns for topic, d in self._decoders.items() if d.columns}
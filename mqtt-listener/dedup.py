@@ -0,0 +1,259 @@
+"""
+Duplikaterkennung für QoS-1-Wiederholungen und CloudEvents.
+
+Jede geprüfte Nachricht erhält einen Schlüssel: bei JSON mit key_field
+(Default "id") Topic + dieser Wert, sonst ein Hash über Topic und Payload.
+Dieser wird für jede Nachricht festgehalten, verworfen wird damit aber nur
+eine vom Broker wiederholte Nachricht (DUP-Flag), ausser content_hash
+(DEDUP_CONTENT_HASH) ist gesetzt; sonst gelten zwei gleiche Aufträge ohne
+key_field als zwei Aufträge. Der Cache hält
+die Schlüssel der letzten ttl Sekunden (höchstens max_entries, älteste
+zuerst verdrängt); ein zweites Exemplar wird nicht gespeichert und nicht
+weitergeleitet, aber bestätigt.
+
+Ein Schlüssel gilt erst als bekannt, wenn die erste Nachricht gespeichert
+ist (commit beim Ack). Trifft ein Duplikat ein, solange das Original noch
+in der Queue liegt, wird es erst mit dem Original bestätigt; geht der
+Listener vorher verloren, liefert der Broker es wieder aus. Mit path
+werden bestätigte Schlüssel in eine Datei auf dem PVC geschrieben und beim
+Start wieder geladen.
+
+Modi (DEDUP_MODE):
+
+    cloudevents  nur Topics, die als CloudEvent weitergehen (order, shipment, invoicing)
+    all          zusätzlich alle anderen Topics; dort wird jede Nachricht festgehalten,
+                 verworfen aber nur eine Wiederholung mit DUP-Flag, da gleiche
+                 Messwerte legitim sind
+    off          keine Duplikaterkennung
+
+Die CloudEvent-Id (event_id) ist der Wert von key_field, sonst eine zufällige
+Id, die einmal pro angenommener Nachricht vergeben wird und mit ihr durch
+Pipeline, Auslagerung und Retry-Queue geht. Sie wird nie aus dem Inhalt
+abgeleitet: zwei gleiche, aber verschiedene Events bleiben unterscheidbar.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from metrics import DEDUP_LOOKUPS
+from sink import safe_topic_name
+
+log = logging.getLogger(__name__)
+
+MODE_CLOUDEVENTS = "cloudevents"
+MODE_ALL = "all"
+MODE_OFF = "off"
+
+
+def key_value(payload: bytes, key_field: str):
+    """Wert von key_field in einer JSON-Payload oder None."""
+    if not key_field or payload[:1] != b"{":
+        return None
+    try:
+        return json.loads(payload).get(key_field)
+    except (ValueError, AttributeError):
+        return None
+
+
+def event_id(payload: bytes, key_field: str = "id") -> str:
+    """CloudEvent-Id: Wert von key_field, sonst eine neue zufällige Id (auch für replay.py)."""
+    value = key_value(payload, key_field)
+    return str(value) if value is not None else str(uuid.uuid4())
+
+
+class _Entry:
+    __slots__ = ("ts", "committed", "waiters")
+
+    def __init__(self, ts: float, committed: bool = False):
+        self.ts = ts
+        self.committed = committed
+        self.waiters = []
+
+
+class DedupCache:
+
+    def __init__(self, mode: str = MODE_CLOUDEVENTS, ttl: float = 3600.0, max_entries: int = 50000,
+                 key_field: str = "id", path: str = None, content_hash: bool = False):
+        if mode not in (MODE_CLOUDEVENTS, MODE_ALL, MODE_OFF):
+            raise ValueError(f"Unbekannter Modus '{mode}'")
+        self.mode = mode
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.key_field = key_field
+        self.content_hash = content_hash
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # Schlüssel (bytes) -> _Entry, nach Eintreffen sortiert
+        self._lock = threading.Lock()
+        self._journal = None
+        self._journal_lines = 0
+        if path:
+            self._load()
+
+    @classmethod
+    def from_env(cls, data_dir: str, instance: str = None):
+        """
+        Erzeugt den Cache anhand der DEDUP_* Umgebungsvariablen. Mit instance
+        (Client-ID) liegt das Journal in einem eigenen Unterverzeichnis: alle
+        Listener teilen das PVC, und _compact ersetzt die Datei beim Start.
+        """
+        persist = os.environ.get("DEDUP_PERSIST", "true").lower() == "true"
+        directory = os.environ.get("DEDUP_DIR", os.path.join(data_dir, ".dedup"))
+        if instance:
+            directory = os.path.join(directory, safe_topic_name(instance))
+        return cls(
+            mode=os.environ.get("DEDUP_MODE", MODE_CLOUDEVENTS),
+            ttl=float(os.environ.get("DEDUP_TTL", "3600")),
+            max_entries=int(os.environ.get("DEDUP_MAX_ENTRIES", "50000")),
+            key_field=os.environ.get("DEDUP_KEY_FIELD", "id") or None,
+            content_hash=os.environ.get("DEDUP_CONTENT_HASH", "false").lower() == "true",
+            path=os.path.join(directory, "keys.log") if persist else None,
+        )
+
+    # --------------------------------------
+    # Öffentliche API
+    # --------------------------------------
+    def key(self, topic: str, payload: bytes, cloudevent: bool, redelivered: bool = False):
+        """
+        (Schlüssel, nur_merken) der Nachricht; Schlüssel None, wenn sie nicht
+        geprüft wird. Mit nur_merken=True wird der Schlüssel festgehalten, die
+        Nachricht aber nicht als Duplikat verworfen (Original ohne Id, gegen
+        das eine spätere Wiederholung mit DUP-Flag geprüft wird).
+        """
+        if self.mode == MODE_OFF or (not cloudevent and self.mode != MODE_ALL):
+            return None, False
+        value = key_value(payload, self.key_field)
+        if value is not None:
+            key = hashlib.blake2b(f"{topic}\0id\0{value}".encode("utf-8"), digest_size=16).digest()
+            return key, not cloudevent and not redelivered
+        # Ohne Id sind gleiche Payloads nur bei einer Wiederholung des Brokers sicher Duplikate
+        key = hashlib.blake2b(topic.encode("utf-8") + b"\0" + payload, digest_size=16).digest()
+        return key, not redelivered and not (cloudevent and self.content_hash)
+
+    def check(self, key: bytes, ack=None, record_only: bool = False) -> bool:
+        """
+        True, wenn key ein Duplikat ist. ack wird dann aufgerufen, sobald das
+        Original gespeichert ist (sofort, falls schon geschehen). Mit
+        record_only wird key nur (erneut) festgehalten und nie verworfen.
+        """
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            entry = self._entries.get(key)
+            if entry is None:
+                self._entries[key] = _Entry(now)
+                self.misses += 1
+                DEDUP_LOOKUPS.labels("miss").inc()
+                return False
+            if record_only:
+                # Gleiche Nachricht ohne Id und ohne DUP-Flag: gilt als neu, die TTL beginnt erneut
+                entry.ts = now
+                self._entries.move_to_end(key)
+                self.misses += 1
+                DEDUP_LOOKUPS.labels("miss").inc()
+                return False
+            self.hits += 1
+            DEDUP_LOOKUPS.labels("hit").inc()
+            if not entry.committed and ack is not None:
+                entry.waiters.append(ack)
+                return True
+        if ack is not None:
+            ack()
+        return True
+
+    def commit(self, key: bytes):
+        """Das Original ist gespeichert: Schlüssel festhalten und wartende Duplikate bestätigen."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = _Entry(time.time())
+            entry.committed = True
+            waiters, entry.waiters = entry.waiters, []
+            self._write(key, entry.ts)
+        for ack in waiters:
+            ack()
+
+    def committer(self, key: bytes, ack=None):
+        """Ack-Callback, der nach dem eigentlichen Ack den Schlüssel festhält."""
+        def call():
+            if ack is not None:
+                ack()
+            self.commit(key)
+        return call
+
+    def event_id(self, payload: bytes) -> str:
+        """CloudEvent-Id über key_field dieses Caches (siehe event_id)."""
+        return event_id(payload, self.key_field)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+    def close(self):
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+
+    # --------------------------------------
+    # Interna
+    # --------------------------------------
+    def _expire(self, now: float):
+        cutoff = now - self.ttl
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if entry.ts >= cutoff and len(self._entries) < self.max_entries:
+                break
+            if not entry.committed and entry.ts >= cutoff:
+                # Original noch in Verarbeitung: nicht verdrängen, ans Ende stellen
+                self._entries.move_to_end(key)
+                break
+            del self._entries[key]
+            for ack in entry.waiters:
+                ack()
+
+    def _load(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        cutoff = time.time() - self.ttl
+        if os.path.exists(self.path):
+            with open(self.path, encoding="ascii", errors="replace") as f:
+                for line in f:
+                    try:
+                        ts, hex_key = line.split()
+                        if float(ts) >= cutoff:
+                            self._entries[bytes.fromhex(hex_key)] = _Entry(float(ts), committed=True)
+                    except ValueError:
+                        continue  # z.B. unvollständige letzte Zeile
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            log.info(f"{len(self._entries)} Schlüssel aus {self.path} geladen.")
+        self._compact()
+
+    def _compact(self):
+        """Schreibt nur noch die bestätigten, gültigen Schlüssel (atomar über eine Temp-Datei)."""
+        if self._journal is not None:
+            self._journal.close()
+        tmp = self.path + ".tmp"
+        lines = 0
+        with open(tmp, "w", encoding="ascii") as f:
+            for key, entry in self._entries.items():
+                if entry.committed:
+                    f.write(f"{entry.ts:.3f} {key.hex()}\n")
+                    lines += 1
+        os.replace(tmp, self.path)
+        self._journal = open(self.path, "a", encoding="ascii", buffering=1)
+        self._journal_lines = lines
+
+    def _write(self, key: bytes, ts: float):
+        if self._journal is None:
+            return
+        self._journal.write(f"{ts:.3f} {key.hex()}\n")
+        self._journal_lines += 1
+        if self._journal_lines > 2 * self.max_entries:
+            self._compact()
@@ -0,0 +1,323 @@
+"""
+CloudEvents-Forwarder des MQTT-Listeners.
+
+- JSON-Nachrichten gehen unverändert als data weiter (kein json.loads/dumps),
+  dekodierte Sensorwerte als normalisierter Datensatz
+- Keep-Alive-Connection-Pool (eine requests.Session für alle Worker)
+- optional gebündelter Versand (application/cloudevents-batch+json)
+- fehlgeschlagene Events landen in einer persistenten Retry-Queue auf dem
+  PVC und werden mit exponentiellem Backoff erneut gesendet; nach
+  max_retries Versuchen werden sie in eine Dead-Letter-Datei geschrieben
+
+Die Retry-Queue ist ein Heap im Speicher nach next_at; die Datei ist nur
+ein Journal dazu (Versuch angehängt, erledigte Events als {"done": id}).
+Beim Start wird sie geladen; sobald sie doppelt so viele Zeilen wie offene
+Retries enthält, wird sie atomar neu geschrieben.
+"""
+import heapq
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+from cloudevent import make_event, make_raw_event, make_text_event, new_session, send_batch, send_event
+from metrics import CLOUDEVENTS, POST_SECONDS
+from pipeline import SpillFile
+from sink import safe_topic_name
+
+log = logging.getLogger(__name__)
+
+
+class CloudEventForwarder:
+
+    def __init__(
+        self,
+        url: str,
+        host: str = None,
+        pool_size: int = 4,
+        batch_size: int = 0,
+        batch_interval: float = 1.0,
+        max_retries: int = 8,
+        backoff_base: float = 1.0,
+        backoff_max: float = 300.0,
+        retry_dir: str = ".",
+        timeout: float = 10.0,
+    ):
+        self.url = url
+        self.host = host
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.session = new_session(pool_size)
+
+        self._retry_path = os.path.join(retry_dir, "cloudevents.retry")
+        self._retry_lock = threading.Lock()
+        self._retry_heap = []     # (next_at, Event-Id)
+        self._retry_items = {}    # Event-Id -> {"event", "attempt", "next_at"}
+        self._retry_file = None
+        self._retry_lines = 0
+        os.makedirs(retry_dir, exist_ok=True)
+        self._load_retries()
+        self._dead = SpillFile(os.path.join(retry_dir, "cloudevents.dead"))
+
+        self._batch = []
+        self._batch_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._retry_added = threading.Event()  # weckt die Retry-Schleife vor dem geplanten Zeitpunkt
+        self._threads = []
+
+        self._count_lock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.dead = 0
+
+    @classmethod
+    def from_env(cls, data_dir: str, pool_size: int = 4, instance: str = None):
+        """
+        Erzeugt den Forwarder anhand der CLOUDEVENTS_* Umgebungsvariablen. Mit
+        instance (Client-ID) liegt die Retry-Queue in einem eigenen Unterverzeichnis,
+        da alle Listener dasselbe PVC teilen.
+        """
+        retry_dir = os.environ.get("CLOUDEVENTS_RETRY_DIR", os.path.join(data_dir, ".cloudevents"))
+        if instance:
+            retry_dir = os.path.join(retry_dir, safe_topic_name(instance))
+        return cls(
+            url=os.environ.get("CLOUDEVENTS_URL", "http://broker-ingress.knative-eventing/ms-brkr/default"),
+            host=os.environ.get("CLOUDEVENTS_HOST", "broker-ingress.knative-eventing.svc.cluster.local") or None,
+            pool_size=pool_size,
+            batch_size=int(os.environ.get("CLOUDEVENTS_BATCH_SIZE", "0")),
+            batch_interval=float(os.environ.get("CLOUDEVENTS_BATCH_INTERVAL", "1.0")),
+            max_retries=int(os.environ.get("CLOUDEVENTS_MAX_RETRIES", "8")),
+            backoff_base=float(os.environ.get("CLOUDEVENTS_BACKOFF_BASE", "1.0")),
+            backoff_max=float(os.environ.get("CLOUDEVENTS_BACKOFF_MAX", "300")),
+            retry_dir=retry_dir,
+            timeout=float(os.environ.get("CLOUDEVENTS_TIMEOUT", "10")),
+        )
+
+    # --------------------------------------
+    # Öffentliche API
+    # --------------------------------------
+    def start(self):
+        self._start_thread(self._retry_loop, "cloudevents-retry")
+        if self.batch_size > 1:
+            self._start_thread(self._batch_loop, "cloudevents-batch")
+
+    def forward(self, topic: str, payload_str: str, record: dict = None, event_id: str = None):
+        """
+        Erzeugt aus einer MQTT-Nachricht ein CloudEvent und versendet es. Mit
+        record (dekodierte Werte) wird dieser gesendet, sonst die Nachricht als JSON;
+        ungültiges JSON geht einzeln als text/plain, nie in einen Batch.
+        event_id ersetzt die zufällige Id (Id der Nachricht für Empfänger-Deduplizierung).
+        """
+        event_type = topic.split("/")[-1]
+        if record is not None:
+            event = make_event(record, source=topic, event_type=event_type, event_id=event_id)
+        else:
+            # Einmal prüfen: roh eingesetztes, ungültiges JSON machte den ganzen Batch-Body ungültig
+            try:
+                data = json.loads(payload_str)
+            except ValueError:
+                log.warning(f"[{topic}] Nachricht ist kein gültiges JSON, sende sie als Text.")
+                self._deliver([make_text_event(payload_str, source=topic, event_type=event_type, event_id=event_id)])
+                return
+            if payload_str.lstrip()[:1] in ("{", "["):
+                event = make_raw_event(payload_str, source=topic, event_type=event_type, event_id=event_id)
+            else:
+                event = make_event(data, source=topic, event_type=event_type, event_id=event_id)
+        if self.batch_size > 1:
+            with self._batch_lock:
+                self._batch.append(event)
+                if len(self._batch) < self.batch_size:
+                    return
+                events, self._batch = self._batch, []
+            self._deliver(events)
+        else:
+            self._deliver([event])
+
+    def close(self):
+        """Restlichen Batch senden und Threads beenden; offene Retries bleiben auf dem PVC."""
+        self._stop.set()
+        self._retry_added.set()
+        for t in self._threads:
+            t.join()
+        self._threads = []
+        self._flush_batch()
+        self.session.close()
+        self._dead.close()
+        with self._retry_lock:
+            if self._retry_file is not None:
+                self._retry_file.close()
+                self._retry_file = None
+
+    def stats(self) -> dict:
+        return {
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "dead": self.dead,
+            "retry_pending": len(self._retry_items),
+        }
+
+    # --------------------------------------
+    # Interna
+    # --------------------------------------
+    def _start_thread(self, target, name):
+        t = threading.Thread(target=target, name=name, daemon=True)
+        t.start()
+        self._threads.append(t)
+
+    def _count(self, field: str, n: int = 1):
+        with self._count_lock:
+            setattr(self, field, getattr(self, field) + n)
+
+    def _deliver(self, events: list):
+        try:
+            with POST_SECONDS.time():
+                if len(events) == 1:
+                    send_event(self.session, self.url, events[0], host=self.host, timeout=self.timeout)
+                else:
+                    send_batch(self.session, self.url, events, host=self.host, timeout=self.timeout)
+            self._count("sent", len(events))
+            CLOUDEVENTS.labels("sent").inc(len(events))
+            log.debug("%d CloudEvent(s) an %s gesendet.", len(events), self.url)
+        except Exception as e:
+            self._count("failed", len(events))
+            CLOUDEVENTS.labels("failed").inc(len(events))
+            log.warning(f"Fehler beim Senden an {self.url}: {e}")
+            for event in events:
+                self._schedule_retry(event, 1)
+
+    def _backoff(self, attempt: int) -> float:
+        delay = min(self.backoff_max, self.backoff_base * (2 ** (attempt - 1)))
+        return delay * random.uniform(0.5, 1.0)
+
+    def _schedule_retry(self, event: dict, attempt: int):
+        if attempt > self.max_retries:
+            self._dead.append(event)
+            self._count("dead")
+            CLOUDEVENTS.labels("dead").inc()
+            log.error(f"CloudEvent {event['id']} nach {self.max_retries} Versuchen verworfen (Dead-Letter).")
+            return
+        item = {"event": event, "attempt": attempt, "next_at": time.time() + self._backoff(attempt)}
+        with self._retry_lock:
+            self._push_retry(item)
+            self._journal_retry(item)
+        self._retry_added.set()
+
+    def _retry_loop(self):
+        while not self._stop.is_set():
+            self._retry_added.clear()
+            next_at = self._retry_pass()
+            # Bis zum frühesten nächsten Versuch schlafen; ein neuer Retry weckt früher
+            delay = 60.0 if next_at is None else next_at - time.time()
+            if delay > 0:
+                self._retry_added.wait(delay)
+
+    def _next_due(self, now: float):
+        """Nimmt den nächsten fälligen Retry vom Heap; (None, frühester Zeitpunkt) sonst."""
+        with self._retry_lock:
+            while self._retry_heap:
+                next_at, event_id = self._retry_heap[0]
+                item = self._retry_items.get(event_id)
+                if item is None or item["next_at"] != next_at:
+                    heapq.heappop(self._retry_heap)  # erledigt oder neu geplant
+                    continue
+                if next_at > now:
+                    return None, next_at
+                heapq.heappop(self._retry_heap)
+                return item, None
+        return None, None
+
+    def _retry_pass(self):
+        """Sendet alle fälligen Retries und liefert den frühesten Zeitpunkt der übrigen."""
+        while not self._stop.is_set():
+            item, next_at = self._next_due(time.time())
+            if item is None:
+                return next_at
+            event_id = item["event"]["id"]
+            self._count("retried")
+            try:
+                with POST_SECONDS.time():
+                    send_event(self.session, self.url, item["event"], host=self.host, timeout=self.timeout)
+                self._count("sent")
+                CLOUDEVENTS.labels("sent").inc()
+                with self._retry_lock:
+                    if self._retry_items.get(event_id) is item:
+                        del self._retry_items[event_id]
+                        self._journal_retry({"done": event_id})
+            except Exception as e:
+                CLOUDEVENTS.labels("failed").inc()
+                log.warning(f"Retry {item['attempt']} für CloudEvent {event_id} fehlgeschlagen: {e}")
+                with self._retry_lock:
+                    if self._retry_items.get(event_id) is item:
+                        del self._retry_items[event_id]
+                if item["attempt"] + 1 > self.max_retries:
+                    with self._retry_lock:
+                        self._journal_retry({"done": event_id})
+                self._schedule_retry(item["event"], item["attempt"] + 1)
+        return None
+
+    # --------------------------------------
+    # Journal der Retry-Queue
+    # --------------------------------------
+    def _push_retry(self, item: dict):
+        self._retry_items[item["event"]["id"]] = item
+        heapq.heappush(self._retry_heap, (item["next_at"], item["event"]["id"]))
+
+    def _load_retries(self):
+        if os.path.exists(self._retry_path):
+            with open(self._retry_path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # z.B. unvollständige letzte Zeile
+                    if "done" in entry:
+                        self._retry_items.pop(entry["done"], None)
+                    else:
+                        # Neu geplant: der spätere Eintrag ersetzt den früheren
+                        self._retry_items[entry["event"]["id"]] = entry
+            self._retry_heap = [(item["next_at"], event_id) for event_id, item in self._retry_items.items()]
+            heapq.heapify(self._retry_heap)
+            if self._retry_items:
+                log.info(f"{len(self._retry_items)} offene CloudEvent-Retries aus {self._retry_path} geladen.")
+        self._compact_retries()
+
+    def _compact_retries(self):
+        """Schreibt nur noch die offenen Retries (atomar über eine Temp-Datei)."""
+        if self._retry_file is not None:
+            self._retry_file.close()
+        tmp = self._retry_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for item in self._retry_items.values():
+                f.write(json.dumps(item, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._retry_path)
+        self._retry_file = open(self._retry_path, "a", encoding="utf-8")
+        self._retry_lines = len(self._retry_items)
+
+    def _journal_retry(self, entry: dict):
+        if self._retry_file is None:
+            return
+        self._retry_file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._retry_file.flush()
+        self._retry_lines += 1
+        if self._retry_lines > 2 * len(self._retry_items) + 100:
+            self._compact_retries()
+
+    def _flush_batch(self):
+        with self._batch_lock:
+            events, self._batch = self._batch, []
+        if events:
+            self._deliver(events)
+
+    def _batch_loop(self):
+        while not self._stop.wait(self.batch_interval):
+            self._flush_batch()
@@ -0,0 +1,205 @@
+"""
+Letzte Werte pro MQTTDevice und Sensor.
+
+on_message legt pro Sensor-Topic nur die Roh-Payload der letzten Nachricht
+ab; dekodiert wird erst beim Abruf (GET /values) bzw. beim Zurückschreiben,
+also höchstens einmal pro Intervall statt bei jeder Nachricht.
+
+Der StatusPatcher schreibt die Werte in status.lastValues des MQTTDevices
+(Status-Subresource):
+
+    status:
+      lastValues:
+        enviii:
+          topic: au-u69/atom/env
+          time: "2025-01-27T10:00:00Z"
+          values: {Temperature: 25.4, Humidity: 51.6}
+
+Pro MQTTDevice geht höchstens ein Patch pro STATUS_INTERVAL an den
+API-Server, egal wie oft der Sensor sendet; pro Intervall höchstens
+STATUS_MAX_PATCHES Patches, der Rest folgt im nächsten. Ohne
+ServiceAccount mit Rechten auf mqttdevices/status (403) schaltet sich der
+Patcher ab, /values bleibt verfügbar.
+"""
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+import requests
+
+from metrics import STATUS_PATCHES
+
+log = logging.getLogger(__name__)
+
+SERVICE_ACCOUNT_DIR = "/var/run/secrets/kubernetes.io/serviceaccount"
+
+
+def sensor_topics(config: dict) -> dict:
+    """Sensor-Topic -> [(MQTTDevice, Sensor)] über alle MQTTDevices."""
+    result = {}
+    for name, entry in config.items():
+        sensors = entry.get("topic_sensors") or {t: t.rsplit("/", 1)[-1] for t in entry.get("topic_values", {})}
+        for topic, sensor in sensors.items():
+            result.setdefault(topic, []).append((name, sensor))
+    return result
+
+
+class LastValueCache:
+
+    def __init__(self, decoders=None):
+        self.decoders = decoders
+        self._sensors = {}   # Topic -> [(MQTTDevice, Sensor)]
+        self._raw = {}       # Topic -> (Payload, Empfangszeit)
+        self._decoded = {}   # Topic -> (Empfangszeit, Werte)
+        self._dirty = set()  # MQTTDevices mit neuen Werten seit dem letzten take_dirty()
+        self._lock = threading.Lock()
+
+    def apply(self, config: dict):
+        sensors = sensor_topics(config)
+        with self._lock:
+            self._sensors = sensors
+            for topic in list(self._raw):
+                if topic not in sensors:
+                    del self._raw[topic]
+                    self._decoded.pop(topic, None)
+
+    def update(self, topic: str, payload: bytes, ts: float = None):
+        """Aus on_message: nur merken, nicht dekodieren."""
+        targets = self._sensors.get(topic)
+        if not targets:
+            return
+        with self._lock:
+            self._raw[topic] = (payload, time.time() if ts is None else ts)
+            self._dirty.update(device for device, _sensor in targets)
+
+    def values(self, device: str = None) -> dict:
+        """MQTTDevice -> Sensor -> {topic, time, values}; mit device nur dieses."""
+        with self._lock:
+            sensors = dict(self._sensors)
+            raw = dict(self._raw)
+        result = {}
+        for topic, targets in sensors.items():
+            if topic not in raw:
+                continue
+            entry = self._entry(topic, *raw[topic])
+            for name, sensor in targets:
+                if device is None or name == device:
+                    result.setdefault(name, {})[sensor] = entry
+        return result
+
+    def take_dirty(self) -> set:
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+        return dirty
+
+    def mark_dirty(self, devices):
+        with self._lock:
+            self._dirty.update(devices)
+
+    def _entry(self, topic: str, payload: bytes, ts: float) -> dict:
+        cached = self._decoded.get(topic)
+        if cached is None or cached[0] != ts:
+            payload_str = payload.decode("utf-8", errors="replace")
+            decoder = self.decoders.get(topic) if self.decoders is not None else None
+            values = decoder.decode(payload_str) if decoder is not None else None
+            cached = self._decoded[topic] = (ts, values if values is not None else {"raw": payload_str})
+        return {
+            "topic": topic,
+            "time": datetime.fromtimestamp(ts, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "values": cached[1],
+        }
+
+
+class StatusPatcher:
+    """Schreibt status.lastValues der MQTTDevices zusammengefasst und begrenzt zurück."""
+
+    def __init__(self, cache: LastValueCache, namespace: str, api_url: str, interval: float = 10.0,
+                 max_patches: int = 50, account_dir: str = SERVICE_ACCOUNT_DIR, timeout: float = 5.0):
+        self.cache = cache
+        self.namespace = namespace
+        self.api_url = api_url.rstrip("/")
+        self.interval = interval
+        self.max_patches = max_patches
+        self.account_dir = account_dir
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.verify = os.path.join(account_dir, "ca.crt")
+        self._stop = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_env(cls, cache: LastValueCache):
+        """Patcher aus STATUS_* und der In-Cluster-Umgebung; None, falls abgeschaltet oder ausserhalb des Clusters."""
+        host = os.environ.get("KUBERNETES_SERVICE_HOST")
+        namespace = os.environ.get("POD_NAMESPACE")
+        if os.environ.get("STATUS_PATCH", "auto") == "off" or not host or not namespace:
+            return None
+        if not os.path.exists(os.path.join(SERVICE_ACCOUNT_DIR, "token")):
+            return None
+        port = os.environ.get("KUBERNETES_SERVICE_PORT", "443")
+        return cls(
+            cache,
+            namespace=namespace,
+            api_url=f"https://{host}:{port}",
+            interval=float(os.environ.get("STATUS_INTERVAL", "10")),
+            max_patches=int(os.environ.get("STATUS_MAX_PATCHES", "50")),
+        )
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="status-patcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.session.close()
+
+    def flush(self) -> bool:
+        """Ein Durchgang; False, wenn der Patcher mangels Rechten aufgibt."""
+        dirty = sorted(self.cache.take_dirty())
+        now, later = dirty[:self.max_patches], dirty[self.max_patches:]
+        if later:
+            self.cache.mark_dirty(later)
+        for device in now:
+            values = self.cache.values(device).get(device)
+            if not values:
+                continue
+            status = self._patch(device, values)
+            STATUS_PATCHES.labels(str(status)).inc()
+            if status == 403:
+                log.warning(f"Keine Berechtigung für mqttdevices/status in {self.namespace}, "
+                            f"letzte Werte nur noch über GET /values.")
+                return False
+            if status not in (200, 404):
+                self.cache.mark_dirty([device])  # im nächsten Intervall erneut
+        return True
+
+    def _patch(self, device: str, values: dict) -> int:
+        url = f"{self.api_url}/apis/iiot.mc-b.ch/v1alpha1/namespaces/{self.namespace}/mqttdevices/{device}/status"
+        try:
+            with open(os.path.join(self.account_dir, "token"), encoding="ascii") as f:
+                token = f.read().strip()  # wird vom kubelet rotiert, daher jedes Mal lesen
+            response = self.session.patch(
+                url,
+                json={"status": {"lastValues": values}},
+                headers={"Authorization": f"Bearer {token}", "Content-Type": "application/merge-patch+json"},
+                timeout=self.timeout,
+            )
+        except (OSError, requests.RequestException) as e:
+            log.error(f"Status von {device} konnte nicht geschrieben werden: {e}")
+            return 0
+        if response.status_code not in (200, 403, 404):
+            log.error(f"Status von {device}: HTTP {response.status_code} {response.text[:200]}")
+        return response.status_code
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                if not self.flush():
+                    return
+            except Exception as e:
+                log.error(f"Fehler beim Schreiben der letzten Werte: {e}")
@@ -0,0 +1,47 @@
+"""
+Logging des Listeners (und des UIs).
+
+LOG_LEVEL steuert die Stufe (z.B. DEBUG, INFO, WARNING); die Zeile pro
+empfangener Nachricht wird nur auf DEBUG ausgegeben. LOG_FORMAT=json
+schreibt eine JSON-Zeile pro Eintrag (für Loki/Elasticsearch), inklusive
+der mit extra={...} übergebenen Felder.
+"""
+import json
+import logging
+import os
+import sys
+import time
+
+# Attribute, die jeder LogRecord hat; alles andere stammt aus extra={...}
+_RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def setup_logging(level: str = None, fmt: str = None):
+    """Konfiguriert den Root-Logger anhand von LOG_LEVEL und LOG_FORMAT."""
+    level = (level or os.environ.get("LOG_LEVEL", "INFO")).upper()
+    fmt = fmt or os.environ.get("LOG_FORMAT", "text")
+    handler = logging.StreamHandler(sys.stdout)
+    if fmt == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level)
@@ -0,0 +1,43 @@
+"""
+Prometheus-Metriken des Listeners, abrufbar über GET /metrics der HTTP-API.
+"""
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+# Pro Nachricht werden nur Mikro- bis Millisekunden erwartet
+FAST_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+MESSAGES_RECEIVED = Counter(
+    "mqtt_listener_messages_received_total", "Empfangene MQTT-Nachrichten", ["topic"])
+MESSAGES_UNROUTED = Counter(
+    "mqtt_listener_messages_unrouted_total", "Über einen Wildcard-Filter empfangene Nachrichten ohne MQTTDevice",
+    ["broker"])
+MESSAGES_WRITTEN = Counter(
+    "mqtt_listener_messages_written_total", "Gespeicherte Nachrichten (store: text oder columnar)", ["topic", "store"])
+MESSAGES_FORWARDED = Counter(
+    "mqtt_listener_messages_forwarded_total", "Als CloudEvent weitergeleitete Nachrichten", ["topic"])
+MESSAGES_SUPPRESSED = Counter(
+    "mqtt_listener_messages_suppressed_total", "Nicht gespeicherte Rohdaten (Deadband oder nur Aggregate)", ["topic"])
+AGGREGATES = Counter(
+    "mqtt_listener_aggregates_total", "Ausgegebene Aggregate (ein Datensatz pro Fenster)", ["topic"])
+DEDUP_LOOKUPS = Counter(
+    "mqtt_listener_dedup_lookups_total", "Prüfungen auf Duplikate (result: hit = Duplikat verworfen, miss)", ["result"])
+CLOUDEVENTS = Counter(
+    "mqtt_listener_cloudevents_total", "Zustellversuche von CloudEvents (result: sent, failed, dead)", ["result"])
+STATUS_PATCHES = Counter(
+    "mqtt_listener_status_patches_total", "Patches von status.lastValues (status: HTTP-Status, 0 = Verbindungsfehler)",
+    ["status"])
+ARCHIVE_FILES = Counter(
+    "mqtt_listener_archive_files_total", "Textdateien im Archiv (action: rotated, compressed, deleted)", ["action"])
+QUEUE_DEPTH = Gauge(
+    "mqtt_listener_queue_depth", "Elemente in der Queue einer Pipeline-Stage", ["stage"])
+STAGE_SECONDS = Histogram(
+    "mqtt_listener_stage_seconds", "Verarbeitungsdauer einer Nachricht pro Stage", ["stage"], buckets=FAST_BUCKETS)
+SINK_FLUSH_SECONDS = Histogram(
+    "mqtt_listener_sink_flush_seconds", "Dauer eines Flushes des Datei-Sinks inkl. fsync", buckets=FAST_BUCKETS)
+POST_SECONDS = Histogram(
+    "mqtt_listener_cloudevent_post_seconds", "Dauer eines HTTP-POSTs an den Broker-Ingress")
+
+
+def metrics_handler(params):
+    """GET /metrics im Prometheus-Textformat."""
+    return 200, CONTENT_TYPE_LATEST, generate_latest()
@@ -1,92 +1,329 @@
+import logging
 import os
-import sys
-import paho.mqtt.client as mqtt
+import signal
 import json
-import requests
-import uuid
-
-def on_connect(client, userdata, flags, rc):
-    if rc == 0:
-        print("Verbindung zum MQTT-Broker erfolgreich hergestellt.")
-        # Abonniere alle Topics, die in TOPICS stehen
-        for topic in userdata['topics']:
-            client.subscribe(topic)
-            print(f"Abonniere Topic: {topic}")
-    else:
-        print(f"Fehler bei der MQTT-Verbindung. Return-Code: {rc}")
+import threading
+import time
+
+from sink import FSYNC_NEVER, FileSink, safe_topic_name
+from pipeline import Pipeline, Stage
+from forwarder import CloudEventForwarder
+from segments import SegmentStore
+from query import QueryEngine
+from api import ApiServer, json_response, parse_time
+from subscriptions import (
+    BrokerConnections, ConfigWatcher, aggregations, routes_by_broker, topic_schemas, topic_values, topics_by_broker,
+)
+from decoders import DecoderRegistry
+from aggregation import Aggregator
+from dedup import MODE_CLOUDEVENTS, MODE_OFF, DedupCache, event_id
+from lastvalues import LastValueCache, StatusPatcher
+from retention import ArchiveManager
+from logs import setup_logging
+from metrics import (
+    MESSAGES_FORWARDED, MESSAGES_RECEIVED, MESSAGES_UNROUTED, MESSAGES_WRITTEN, QUEUE_DEPTH, metrics_handler,
+)
+
+log = logging.getLogger("mqtt-listener")
+
+# Topic-Typen, die zusätzlich als CloudEvent an den Knative-Broker gehen
+VALID_TYPES = ["shipment", "invoicing", "order"]
+
+def is_cloudevent_topic(topic):
+    return topic.split("/")[-1] in VALID_TYPES
 
 def on_message(client, userdata, msg):
-    # Nachricht empfangen
-    payload_str = msg.payload.decode("utf-8")
-    print(f"[{msg.topic}] -> {payload_str}")
-
-    # Schreibe in Datei /data/<Topic>.txt
-    # Ersetze evtl. verbotene Zeichen im Dateinamen.
-    safe_topic = msg.topic.replace("/", "_")
-    file_path = f"/data/{safe_topic}.txt"
-    try:
-        with open(file_path, "a") as f:
-            f.write(payload_str + "\n")
-    except Exception as e:
-        print(f"Fehler beim Schreiben in {file_path}: {e}", file=sys.stderr)
-
-    # Überprüfe, ob das Topic zu den relevanten Typen gehört
-    last_entry = msg.topic.split("/")[-1]
-    valid_types = ["shipment", "invoicing", "order"]
-    if last_entry in valid_types:
-        cloudevents_url = os.environ.get("CLOUDEVENTS_URL", "http://broker-ingress.knative-eventing/ms-brkr/default")
-        headers = {
-            "Host": "broker-ingress.knative-eventing.svc.cluster.local",
-            "Ce-Id": "K-native-Broker",
-            "Ce-Specversion": "1.0",
-            "Ce-Type": last_entry,
-            "Ce-Source": msg.topic,
-            "Content-Type": "application/json"
+    # Nur einreihen, Platte und HTTP erledigen die Worker-Pools.
+    # QoS 1/2 wird erst bestätigt, wenn die Nachricht gespeichert ist.
+    ack = None
+    if msg.qos > 0:
+        ack = lambda: client.ack(msg.mid, msg.qos)
+    # Über einen Wildcard-Filter kommen auch Topics fremder Geräte: nur bestätigen
+    devices = userdata['connections'].route(userdata['broker'], msg.topic)
+    if not devices:
+        MESSAGES_UNROUTED.labels(userdata['broker']).inc()
+        if ack is not None:
+            ack()
+        return
+    MESSAGES_RECEIVED.labels(msg.topic).inc()
+    log.debug("[%s] für %s", msg.topic, ", ".join(sorted(devices)))
+    # Duplikate (QoS-1-Wiederholungen, doppelte Aufträge) weder speichern noch weiterleiten
+    dedup = userdata.get('dedup')
+    if dedup is not None:
+        key, record_only = dedup.key(msg.topic, msg.payload, is_cloudevent_topic(msg.topic), msg.dup)
+        if key is not None:
+            if dedup.check(key, ack, record_only):
+                return
+            ack = dedup.committer(key, ack)
+    # Letzter Wert pro Sensor (nur die Payload, dekodiert wird beim Abruf)
+    last_values = userdata.get('values')
+    if last_values is not None:
+        last_values.update(msg.topic, msg.payload)
+    # CloudEvent-Id einmal pro angenommener Nachricht, sie geht mit durch Pipeline und Retries
+    ce_id = None
+    if is_cloudevent_topic(msg.topic):
+        ce_id = dedup.event_id(msg.payload) if dedup is not None else event_id(msg.payload)
+    userdata['pipeline'].submit(msg.topic, msg.payload, ack, ce_id)
+
+def write_message(sink, segments, item, ack=None, aggregator=None):
+    """Worker Datei-Sink: schreibt in Datei /data/<Topic>.txt und/oder in die Segmente"""
+    topic, payload_str, received_at = item[:3]
+    log.debug("[%s] -> %s", topic, payload_str)  # nur mit LOG_LEVEL=DEBUG
+    # Aggregation: Rohdaten entfallen im Deadband bzw. bei mode=aggregate
+    if aggregator is not None and not aggregator.process(topic, payload_str, received_at):
+        if ack is not None:
+            ack()
+        return
+    # Der Ack hängt am Text-Sink, sonst an den Segmenten
+    if sink is not None:
+        sink.write(topic, payload_str, on_durable=ack)
+        MESSAGES_WRITTEN.labels(topic, "text").inc()
+        ack = None
+    if segments is not None and segments.append(topic, received_at, payload_str, on_durable=ack):
+        MESSAGES_WRITTEN.labels(topic, "columnar").inc()
+        ack = None
+    if ack is not None:
+        ack()
+
+def emit_aggregate(sink, segments, connections, topic, derived_topic, record, spec):
+    """Ausgabe eines Aggregats: Datei und Segmente des abgeleiteten Topics, optional MQTT."""
+    line = json.dumps(record)
+    if sink is not None:
+        sink.write(derived_topic, line)
+    if segments is not None:
+        segments.append(derived_topic, record["start"], line)
+    if spec.publish and connections is not None and not connections.publish(spec.broker, derived_topic, line, spec.qos):
+        log.warning(f"Aggregat für {derived_topic} nicht publiziert: keine Verbindung zu {spec.broker}")
+
+def forward_message(forwarder, decoders, item, ack=None):
+    """Worker CloudEvents: sendet die Nachricht an den Knative-Broker."""
+    topic, payload_str, received_at = item[:3]
+    # Ausgelagerte Elemente älterer Versionen haben noch keine Id
+    ce_id = item[3] if len(item) > 3 else None
+    # JSON ohne Umrechnung geht unverändert weiter, sonst der dekodierte Datensatz
+    record = None
+    decoder = decoders.get(topic) if decoders is not None else None
+    if decoder is not None and not decoder.passthrough:
+        record = decoder.decode(payload_str)
+        if record is None:
+            log.warning(f"[{topic}] Nachricht passt nicht zum Format, sende unverändert.")
+    forwarder.forward(topic, payload_str, record, ce_id)
+    MESSAGES_FORWARDED.labels(topic).inc()
+    if ack is not None:
+        ack()
+
+def query_handler(engine, params):
+    """GET /query?topic=...&from=...&to=...&points=N[&columns=a,b]"""
+    t_to = parse_time(params.get("to"), time.time())
+    t_from = parse_time(params.get("from"), t_to - 3600)
+    columns = params["columns"].split(",") if params.get("columns") else None
+    points = int(params.get("points", "500"))
+    return json_response(engine.query(params["topic"], t_from, t_to, points, columns))
+
+def archive_handler(archive, params):
+    """GET /archive?topic=...[&from=...&to=...]: rotierte Dateien aus dem Manifest"""
+    t_from = parse_time(params.get("from"), None)
+    t_to = parse_time(params.get("to"), None)
+    return json_response(archive.files(
+        params["topic"],
+        int(t_from * 1000) if t_from is not None else None,
+        int(t_to * 1000) if t_to is not None else None,
+    ))
+
+def create_pipeline(data_dir, sink, segments, forwarder, forward_workers, decoders=None, aggregator=None,
+                    instance=None):
+    """Baut die Pipeline mit je einem Worker-Pool für Datei-Sink und CloudEvents."""
+    queue_size = int(os.environ.get("PIPELINE_QUEUE_SIZE", "10000"))
+    backpressure = os.environ.get("PIPELINE_BACKPRESSURE", "block")
+    spill_dir = os.environ.get("PIPELINE_SPILL_DIR", os.path.join(data_dir, ".spill"))
+    # Alle Listener teilen das PVC: ein eigenes Verzeichnis pro Pod bzw. Shard (Client-ID)
+    if instance:
+        spill_dir = os.path.join(spill_dir, safe_topic_name(instance))
+    # Wie der Text-Sink bestätigen: mit fsync gemäss SINK_FSYNC (Segmente bestätigen nach dem Flush ins OS)
+    spill_fsync = sink.fsync_policy if sink is not None else FSYNC_NEVER
+    spill_fsync_interval = sink.fsync_interval if sink is not None else 5.0
+
+    pipeline = Pipeline(stats_interval=float(os.environ.get("PIPELINE_STATS_INTERVAL", "60")))
+    pipeline.add_stage(Stage(
+        "sink",
+        lambda item, ack: write_message(sink, segments, item, ack, aggregator),
+        workers=int(os.environ.get("SINK_WORKERS", "1")),
+        maxsize=queue_size,
+        backpressure=backpressure,
+        spill_dir=spill_dir,
+        spill_fsync=spill_fsync,
+        spill_fsync_interval=spill_fsync_interval,
+    ), owns_ack=True)
+    pipeline.add_stage(Stage(
+        "cloudevents",
+        lambda item, ack: forward_message(forwarder, decoders, item, ack),
+        workers=forward_workers,
+        maxsize=queue_size,
+        backpressure=backpressure,
+        spill_dir=spill_dir,
+        spill_fsync=spill_fsync,
+        spill_fsync_interval=spill_fsync_interval,
+    ), accepts=is_cloudevent_topic)
+    for stage in pipeline.stages.values():
+        QUEUE_DEPTH.labels(stage.name).set_function(stage.depth)
+    return pipeline
+
+def apply_config(connections, segments, decoders, aggregator, last_values, archive, config):
+    """Neue Konfiguration übernehmen: Decoder, Aggregation, Aufbewahrung, Spalten für Segmente, Abonnements als Delta."""
+    # Decoder vor den Abos kompilieren, damit die ersten Nachrichten sie schon vorfinden
+    decoders.apply(topic_schemas(config), topic_values(config))
+    aggregator.apply(aggregations(config))
+    last_values.apply(config)
+    archive.apply(config)
+    if segments is not None:
+        segments.columns_by_topic = dict(decoders.columns(), **aggregator.columns())
+        # Offene Segmente eines früheren Laufs nur für die eigenen (neuen) Topics versiegeln
+        segments.recover()
+    connections.apply(topics_by_broker(config), routes_by_broker(config))
+    log.info(f"Konfiguration übernommen: {len(config)} MQTTDevice(s).")
+
+def config_from_env():
+    """Einzelnes MQTTDevice aus den Umgebungsvariablen (ein Pod pro MQTTDevice)."""
+    topics_str = os.environ.get("TOPICS", "device")
+    return {
+        os.environ.get("MQTTDEVICE_NAME", "default-device"): {
+            "broker": os.environ.get("MQTT_BROKER_URL", "mqtt://cloud.tbz.ch:1883"),
+            "qos": int(os.environ.get("MQTT_QOS", "0")),
+            "topics": topics_str.split(",") if topics_str else [],
+            "topic_values": json.loads(os.environ.get("TOPIC_VALUES", "{}") or "{}"),
+            "topic_schemas": json.loads(os.environ.get("TOPIC_SCHEMAS", "{}") or "{}"),
+            "aggregation": json.loads(os.environ.get("AGGREGATION", "{}") or "{}"),
+            "retention": json.loads(os.environ.get("RETENTION", "{}") or "{}"),
         }
-        
-        # Debugging: Header ausgeben
-        print("Sende HTTP POST mit folgenden Headern:")
-        for key, value in headers.items():
-            print(f"{key}: {value}")
-        print(f"Payload: {payload_str}")
-        
-        try:
-            resp = requests.post(cloudevents_url, headers=headers, json=json.loads(payload_str))
-            resp.raise_for_status()
-            print(f"CloudEvent für {last_entry} an {cloudevents_url} gesendet.")
-        except Exception as e:
-            print(f"Fehler beim Senden an {cloudevents_url}: {e}", file=sys.stderr)
+    }
 
 def main():
-    mqtt_broker_url = os.environ.get("MQTT_BROKER_URL", "mqtt://cloud.tbz.ch:1883")
-    mqtt_device_name = os.environ.get("MQTTDEVICE_NAME", "default-device")
-    unique_id = f"{mqtt_device_name}-{uuid.uuid4()}"  # Beispiel: default-device-550e8400-e29b-41d4-a716-446655440000
-    print(f"MQTT-Client-ID: {unique_id}")  # Zur Überprüfung    
-    
-    topics_str = os.environ.get("TOPICS", "device")
-    topics = topics_str.split(",") if topics_str else []
+    setup_logging()
+
+    # Geteilter Modus: Shard mit vielen MQTTDevices aus einer gemounteten ConfigMap
+    config_dir = os.environ.get("LISTENER_CONFIG")
+    # Stabile Client-ID (Namespace + Shard bzw. MQTTDevice) für persistente Sessions
+    client_id = os.environ.get("SHARD_NAME") or os.environ.get("MQTTDEVICE_NAME", "default-device")
+    if os.environ.get("POD_NAMESPACE"):
+        client_id = f"{os.environ['POD_NAMESPACE']}-{client_id}"
+
+    data_dir = os.environ.get("DATA_DIR", "/data")
+    storage_mode = os.environ.get("STORAGE_MODE", "text")  # text, columnar oder both
+
+    # Rotation, Komprimierung und Aufbewahrung (storage.retention) der Dateien auf dem PVC
+    archive = ArchiveManager.from_env(data_dir)
+
+    # Gepufferter Datei-Sink, ein offener Handle pro Topic (rotiert ins Archiv)
+    sink = None
+    if storage_mode in ("text", "both"):
+        sink = FileSink.from_env(data_dir)
+        sink.archive = archive
+        sink.start()
+
+    # Ein Decoder pro Topic gemäss spec.format des Sensors (aus der Konfiguration)
+    decoders = DecoderRegistry()
+
+    # Spaltenweise Segmente für Sensorwerte gemäss spec.values (TOPIC_VALUES)
+    segments = None
+    if storage_mode in ("columnar", "both"):
+        segments = SegmentStore.from_env(data_dir)
+        segments.decoders = decoders
+        segments.start()
 
-    # Aus MQTT-URL Host & Port extrahieren
-    # Beispiel: "mqtt://test-broker:1883"
-    if mqtt_broker_url.startswith("mqtt://"):
-        mqtt_broker_url = mqtt_broker_url.replace("mqtt://", "")
-    broker_parts = mqtt_broker_url.split(":")
-    broker_host = broker_parts[0]
-    broker_port = int(broker_parts[1]) if len(broker_parts) > 1 else 1883
+    # CloudEvents-Forwarder mit einem Connection-Pool pro Worker-Pool
+    forward_workers = int(os.environ.get("FORWARD_WORKERS", "4"))
+    forwarder = CloudEventForwarder.from_env(data_dir, pool_size=forward_workers, instance=client_id)
+    forwarder.start()
 
-    # Client mit Device-Name als Client-ID
-    client = mqtt.Client(client_id=unique_id, userdata={"topics": topics})
-    client.on_connect = on_connect
-    client.on_message = on_message
+    # Aggregate (spec.aggregation) gehen in Datei/Segmente und auf <Topic>/<suffix>;
+    # die Verbindungen entstehen erst unten, daher über die Liste
+    connections_ref = []
+    aggregator = Aggregator(decoders, lambda topic, derived, record, spec: emit_aggregate(
+        sink, segments, connections_ref[0] if connections_ref else None, topic, derived, record, spec))
 
-    # Falls Username/Passwort notwendig, hier client.username_pw_set(...) aufrufen
-    # client.username_pw_set("user", "password")
+    # Duplikaterkennung vor Datei-Sink und Forwarder (DEDUP_MODE, Schlüssel auf dem PVC)
+    dedup = None
+    if os.environ.get("DEDUP_MODE", MODE_CLOUDEVENTS) != MODE_OFF:
+        dedup = DedupCache.from_env(data_dir, instance=client_id)
 
-    # Mit dem Broker verbinden
-    client.connect(broker_host, broker_port, 60)
+    # Letzter Wert pro MQTTDevice und Sensor (GET /values, status.lastValues)
+    last_values = LastValueCache(decoders)
 
-    # Blocking loop, um Nachrichten zu verarbeiten
-    client.loop_forever()
+    # Begrenzte Queues mit eigenen Worker-Pools, damit on_message nie blockiert
+    pipeline = create_pipeline(data_dir, sink, segments, forwarder, forward_workers, decoders, aggregator, client_id)
+    pipeline.start()
+
+    # HTTP-API (z. B. Zeitbereichs-Abfragen über die Segmente), API_PORT=0 schaltet sie ab
+    api = None
+    api_port = int(os.environ.get("API_PORT", "8080"))
+    if api_port:
+        api = ApiServer(api_port)
+        engine = QueryEngine.from_env(data_dir)
+        api.route("/query", lambda params: query_handler(engine, params))
+        api.route("/metrics", metrics_handler)
+        api.route("/values", lambda params: json_response(last_values.values(params.get("device"))))
+        api.route("/archive", lambda params: archive_handler(archive, params))
+        api.start()
+
+    # Eine MQTT-Verbindung pro Broker (Wildcard-Filter ab MQTT_WILDCARD_MIN Topics);
+    # Topics werden bei Änderungen als Delta nachgeführt
+    connections = BrokerConnections.from_env(
+        client_id, on_message, {"pipeline": pipeline, "dedup": dedup, "values": last_values}, data_dir
+    )
+    connections_ref.append(connections)
+    if api is not None:
+        api.route("/subscriptions", lambda params: json_response(connections.subscriptions()))
+    watcher = None
+    if config_dir:
+        watcher = ConfigWatcher(
+            config_dir,
+            lambda config: apply_config(connections, segments, decoders, aggregator, last_values, archive, config),
+            interval=float(os.environ.get("CONFIG_POLL_INTERVAL", "5")),
+        )
+        watcher.start()
+    else:
+        apply_config(connections, segments, decoders, aggregator, last_values, archive, config_from_env())
+    aggregator.start()
+    archive.start()
+
+    # Letzte Werte zusammengefasst in status.lastValues der MQTTDevices (STATUS_INTERVAL)
+    patcher = StatusPatcher.from_env(last_values)
+    if patcher is not None:
+        patcher.start()
+
+    # Bei SIGTERM (Pod wird beendet) sauber trennen, damit der Puffer geschrieben wird
+    stop = threading.Event()
+    def on_sigterm(signum, frame):
+        log.info("SIGTERM empfangen, beende Listener ...")
+        stop.set()
+    signal.signal(signal.SIGTERM, on_sigterm)
+    signal.signal(signal.SIGINT, on_sigterm)
+
+    # Warten, die MQTT-Clients laufen in eigenen Threads
+    try:
+        stop.wait()
+    finally:
+        if watcher is not None:
+            watcher.stop()
+        if patcher is not None:
+            patcher.stop()
+        connections.close()
+        if api is not None:
+            api.stop()
+        # Queues abarbeiten (Rest wird bei "spill" ausgelagert), dann Puffer schreiben
+        pipeline.stop(timeout=float(os.environ.get("PIPELINE_DRAIN_TIMEOUT", "20")))
+        # Offene Fenster nur noch speichern (die Verbindungen sind getrennt)
+        connections_ref.clear()
+        aggregator.close()
+        forwarder.close()
+        if segments is not None:
+            segments.close()
+        if sink is not None:
+            sink.close()
+        archive.stop()
+        if dedup is not None:
+            dedup.close()
+        log.info("Datei-Sink geschlossen.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
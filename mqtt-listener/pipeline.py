@@ -0,0 +1,438 @@
+"""
+Entkoppelt den MQTT-Empfang von Platten- und HTTP-Arbeit.
+
+on_message legt Nachrichten nur noch in begrenzte Queues; pro Verarbeitungs-
+schritt (Datei-Sink, CloudEvents-Forwarder) arbeitet ein eigener Worker-Pool
+die Queue ab. Ist eine Queue voll, greift die konfigurierte Backpressure-
+Strategie:
+
+- block:       der MQTT-Thread wartet, bis wieder Platz ist
+- drop-oldest: die älteste Nachricht wird verworfen
+- spill:       die Nachricht wird auf die Platte ausgelagert und später verarbeitet
+
+Optional kann pro Nachricht ein ack-Callback mitgegeben werden (QoS 1/2 mit
+manuellem Ack). Er geht an genau eine Stage und wird aufgerufen, sobald die
+Nachricht dort sicher abgelegt ist: vom Handler selbst (z.B. nach dem fsync),
+beim Auslagern auf die Platte oder wenn sie bewusst verworfen wird. Aus der
+Auslagerung nachgeladene Elemente erhalten in jeder Stage einen Ack, mit dem
+der Handler die Verarbeitung bestätigt; erst dann rückt die Datei vor.
+"""
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from metrics import STAGE_SECONDS
+from sink import FSYNC_BATCH, FSYNC_INTERVAL, FSYNC_NEVER, FSYNC_POLICIES
+
+log = logging.getLogger(__name__)
+
+BACKPRESSURE_BLOCK = "block"
+BACKPRESSURE_DROP_OLDEST = "drop-oldest"
+BACKPRESSURE_SPILL = "spill"
+BACKPRESSURE_POLICIES = (BACKPRESSURE_BLOCK, BACKPRESSURE_DROP_OLDEST, BACKPRESSURE_SPILL)
+
+
+def _call(ack):
+    if ack is not None:
+        ack()
+
+
+def _once(ack):
+    """Ack höchstens einmal senden (z.B. Handler-Fehler nach übernommenem Ack)."""
+    if ack is None:
+        return None
+    lock = threading.Lock()
+    done = []
+
+    def call():
+        with lock:
+            if done:
+                return
+            done.append(True)
+        ack()
+    return call
+
+
+class SpillFile:
+    """
+    Einfache JSON-Lines-Datei als Überlauf einer Queue.
+
+    Einträge werden über einen offenen Handle angehängt und ab einer
+    Leseposition wieder gelesen. on_durable eines Eintrags wird wie beim
+    FileSink gemäss fsync-Strategie aufgerufen: bei "never" nach dem Flush
+    ins OS, bei "batch" nach dem nächsten gemeinsamen fsync (spätestens ab
+    sync_pending Einträgen oder beim nächsten sync()), bei "interval"
+    höchstens alle fsync_interval Sekunden. Erst commit() bestätigt die gelesenen
+    Einträge: die Position geht in <path>.offset, sind alle bestätigt, wird
+    die Datei geleert. Beim Neustart wird ab der bestätigten Position gelesen,
+    gelesene, aber nicht verarbeitete Einträge gehen also nicht verloren
+    (sie werden höchstens erneut verarbeitet).
+    """
+
+    def __init__(self, path: str, fsync_policy: str = FSYNC_NEVER, fsync_interval: float = 5.0,
+                 sync_pending: int = 10):
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError(f"Unbekannte fsync-Strategie '{fsync_policy}', erlaubt: {FSYNC_POLICIES}")
+        self.path = path
+        self.offset_path = path + ".offset"
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval
+        self.sync_pending = max(1, sync_pending)
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._size = os.path.getsize(path) if os.path.exists(path) else 0
+        self._committed = self._load_offset()
+        self._read_pos = self._committed
+        self._file = None            # Handle zum Anhängen, bleibt offen
+        self._unsynced = 0           # geschriebene, noch nicht ge-fsync-te Einträge
+        self._unsynced_acks = []     # deren on_durable-Callbacks
+        self._last_fsync = time.monotonic()
+
+    def __len__(self):
+        # Nur ein Hinweis, ob noch ungelesene Daten vorhanden sind (in Bytes)
+        with self._lock:
+            return self._size - self._read_pos
+
+    def append(self, item, on_durable=None):
+        """Hängt einen Eintrag an; on_durable folgt gemäss fsync-Strategie."""
+        line = (json.dumps(item, ensure_ascii=False) + "\n").encode("utf-8")
+        ready = []
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, "ab")
+            self._file.write(line)
+            # Ins OS, damit read() über einen eigenen Handle den Eintrag sieht
+            self._file.flush()
+            self._size += len(line)
+            if self.fsync_policy == FSYNC_NEVER:
+                ready.append(on_durable)
+            else:
+                self._unsynced += 1
+                if on_durable is not None:
+                    self._unsynced_acks.append(on_durable)
+                if self.fsync_policy == FSYNC_BATCH and self._unsynced >= self.sync_pending:
+                    ready = self._fsync_locked()
+        for ack in ready:
+            _call(ack)
+
+    def sync(self, force: bool = False):
+        """fsync der angehängten Einträge gemäss Strategie (mit force immer), dann deren on_durable."""
+        with self._lock:
+            if not self._unsynced:
+                return
+            if (not force and self.fsync_policy == FSYNC_INTERVAL
+                    and time.monotonic() - self._last_fsync < self.fsync_interval):
+                return
+            ready = self._fsync_locked()
+        for ack in ready:
+            _call(ack)
+
+    def close(self):
+        self.sync(force=True)
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def commit(self):
+        """Bestätigt alle bisher gelesenen Einträge als verarbeitet."""
+        with self._lock:
+            if self._read_pos == self._committed:
+                return
+            if self._read_pos >= self._size:
+                # Alles verarbeitet: Datei leeren, die Position gilt dann nicht mehr
+                open(self.path, "w").close()
+                self._remove_offset()
+                self._read_pos = self._committed = self._size = 0
+                return
+            tmp = self.offset_path + ".tmp"
+            with open(tmp, "w") as f:
+                f.write(str(self._read_pos))
+            os.replace(tmp, self.offset_path)
+            self._committed = self._read_pos
+
+    def read(self, max_items: int) -> list:
+        """Liest bis zu max_items Einträge ab der Leseposition, ohne sie zu bestätigen."""
+        items = []
+        with self._lock:
+            if self._read_pos >= self._size:
+                return items
+            with open(self.path, "rb") as f:
+                f.seek(self._read_pos)
+                while len(items) < max_items:
+                    line = f.readline()
+                    if not line:
+                        break
+                    self._read_pos += len(line)
+                    try:
+                        items.append(json.loads(line))
+                    except ValueError as e:
+                        log.warning(f"Defekter Eintrag in {self.path} übersprungen: {e}")
+        return items
+
+    def _fsync_locked(self) -> list:
+        # Schlägt fsync fehl, bleiben die Einträge offen und werden beim nächsten Mal bestätigt
+        try:
+            os.fsync(self._file.fileno())
+        except OSError as e:
+            log.error(f"Fehler bei fsync von {self.path}: {e}")
+            return []
+        self._last_fsync = time.monotonic()
+        ready, self._unsynced_acks = self._unsynced_acks, []
+        self._unsynced = 0
+        return ready
+
+    def _load_offset(self) -> int:
+        try:
+            with open(self.offset_path) as f:
+                offset = int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+        # Eine Position hinter dem Dateiende stammt von einer schon geleerten Datei
+        return offset if offset <= self._size else 0
+
+    def _remove_offset(self):
+        try:
+            os.remove(self.offset_path)
+        except FileNotFoundError:
+            pass
+
+
+class Stage:
+    """Begrenzte Queue plus Worker-Pool für einen Verarbeitungsschritt."""
+
+    def __init__(
+        self,
+        name: str,
+        handler,
+        workers: int = 1,
+        maxsize: int = 10000,
+        backpressure: str = BACKPRESSURE_BLOCK,
+        spill_dir: str = None,
+        spill_fsync: str = FSYNC_NEVER,
+        spill_fsync_interval: float = 5.0,
+    ):
+        if backpressure not in BACKPRESSURE_POLICIES:
+            raise ValueError(f"Unbekannte Backpressure-Strategie '{backpressure}', erlaubt: {BACKPRESSURE_POLICIES}")
+        self.name = name
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.maxsize = maxsize
+        self.backpressure = backpressure
+        self.spill = None
+        self._spill_lock = threading.Lock()
+        self._spill_pending = 0  # noch nicht verarbeitete Elemente des nachgeladenen Blocks
+        if backpressure == BACKPRESSURE_SPILL:
+            # Ausgelagert heisst bestätigt: mit fsync, wenn auch der Sink erst nach dem fsync bestätigt
+            self.spill = SpillFile(os.path.join(spill_dir or ".", f"{name}.spill"), spill_fsync, spill_fsync_interval)
+
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._threads = []
+        self._stopping = threading.Event()
+        self._count_lock = threading.Lock()
+        self.enqueued = 0
+        self.processed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.spilled = 0
+
+    def start(self):
+        for i in range(self.workers):
+            t = threading.Thread(target=self._run, name=f"{self.name}-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def put(self, item, ack=None):
+        """Legt ein Element in die Queue, gemäss Backpressure-Strategie."""
+        entry = (item, ack)
+        if self.backpressure == BACKPRESSURE_BLOCK:
+            self._queue.put(entry)
+        elif self.backpressure == BACKPRESSURE_DROP_OLDEST:
+            while True:
+                try:
+                    self._queue.put_nowait(entry)
+                    break
+                except queue.Full:
+                    try:
+                        _dropped, dropped_ack = self._queue.get_nowait()
+                        self._queue.task_done()
+                        self._count("dropped")
+                        _call(dropped_ack)
+                    except queue.Empty:
+                        pass
+        else:
+            # Solange ausgelagerte Elemente warten, hinten anstellen (Reihenfolge)
+            if len(self.spill) > 0:
+                self._spill(item, ack)
+            else:
+                try:
+                    self._queue.put_nowait(entry)
+                except queue.Full:
+                    self._spill(item, ack)
+        self._count("enqueued")
+
+    def _spill(self, item, ack):
+        # Auf der Platte gilt die Nachricht als abgelegt (Ack gemäss fsync-Strategie)
+        self.spill.append(item, ack)
+        self._count("spilled")
+
+    def stop(self, timeout: float = None):
+        """Arbeitet die Queue ab (höchstens timeout Sekunden) und beendet die Worker."""
+        self._stopping.set()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for t in self._threads:
+            t.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+        self._threads = [t for t in self._threads if t.is_alive()]
+
+        # Was nicht mehr verarbeitet wurde, wenn möglich auslagern
+        left = 0
+        while True:
+            try:
+                item, ack = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if self.spill is not None:
+                self.spill.append(item, ack)
+            else:
+                # Kein Ack: bei persistenter Session stellt der Broker erneut zu
+                left += 1
+        if self.spill is not None:
+            self.spill.close()
+        if left:
+            log.warning(f"[{self.name}] {left} Nachrichten beim Beenden verworfen.")
+
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def stats(self) -> dict:
+        return {
+            "stage": self.name,
+            "depth": self.depth(),
+            "maxsize": self.maxsize,
+            "spill_bytes": len(self.spill) if self.spill is not None else 0,
+            "enqueued": self.enqueued,
+            "processed": self.processed,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "spilled": self.spilled,
+        }
+
+    def _count(self, field: str, n: int = 1):
+        with self._count_lock:
+            setattr(self, field, getattr(self, field) + n)
+
+    def _refill_from_spill(self):
+        # Nur nachladen, wenn die Queue mindestens halb leer ist
+        free = self.maxsize - self._queue.qsize()
+        if self.spill is None or free < self.maxsize // 2:
+            return
+        with self._spill_lock:
+            # Erst nachladen, wenn der vorige Block vollständig verarbeitet und bestätigt ist
+            if self._spill_pending:
+                return
+            items = self.spill.read(free)
+            if not items:
+                self.spill.commit()
+                return
+            self._spill_pending = len(items)
+        for item in items:
+            try:
+                # Wie bei submit höchstens einmal: ein Handler kann bestätigen und danach fehlschlagen
+                self._queue.put_nowait((item, _once(self._spill_done)))
+            except queue.Full:
+                # Die Datei rückt erst vor, wenn der erneut angehängte Eintrag sicher ist
+                self.spill.append(item, self._spill_done)
+
+    def _spill_done(self):
+        # Ack eines nachgeladenen Elements; der letzte des Blocks bestätigt ihn in der Datei
+        with self._spill_lock:
+            self._spill_pending -= 1
+            if self._spill_pending:
+                return
+        self.spill.commit()
+
+    def _run(self):
+        while True:
+            if self.spill is not None:
+                # Gemeinsamer fsync der seit dem letzten Durchlauf ausgelagerten Nachrichten
+                self.spill.sync()
+                if len(self.spill) > 0:
+                    self._refill_from_spill()
+            try:
+                item, ack = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                if self._stopping.is_set():
+                    return
+                continue
+            start = time.perf_counter()
+            try:
+                self.handler(item, ack)
+                self._count("processed")
+            except Exception as e:
+                self._count("failed")
+                log.error(f"[{self.name}] Fehler bei der Verarbeitung: {e}")
+                # Trotzdem bestätigen, sonst füllt sich das Inflight-Fenster des Brokers
+                _call(ack)
+            finally:
+                STAGE_SECONDS.labels(self.name).observe(time.perf_counter() - start)
+                self._queue.task_done()
+
+
+class Pipeline:
+    """Verteilt empfangene Nachrichten auf die Stages und berichtet Queue-Tiefen."""
+
+    def __init__(self, stats_interval: float = 60.0):
+        self.stages = {}
+        self._routes = []  # (Stage, Prädikat(topic) -> bool, erhält den Ack?)
+        self.stats_interval = stats_interval
+        self._stop = threading.Event()
+        self._stats_thread = None
+
+    def add_stage(self, stage: Stage, accepts=None, owns_ack: bool = False):
+        """
+        Registriert eine Stage; accepts(topic) entscheidet, ob sie eine Nachricht erhält.
+        Die Stage mit owns_ack=True (höchstens eine) erhält den ack-Callback.
+        """
+        self.stages[stage.name] = stage
+        self._routes.append((stage, accepts, owns_ack))
+        return stage
+
+    def submit(self, topic: str, payload: bytes, ack=None, event_id: str = None):
+        """Wird aus on_message aufgerufen: nur einreihen, keine Verarbeitung."""
+        item = (topic, payload.decode("utf-8", errors="replace"), time.time(), event_id)
+        ack = _once(ack)
+        acked = False
+        for stage, accepts, owns_ack in self._routes:
+            if accepts is None or accepts(topic):
+                stage.put(item, ack if owns_ack else None)
+                acked = acked or owns_ack
+        if not acked:
+            _call(ack)
+
+    def start(self):
+        for stage in self.stages.values():
+            stage.start()
+        if self.stats_interval > 0:
+            self._stats_thread = threading.Thread(target=self._report, name="pipeline-stats", daemon=True)
+            self._stats_thread.start()
+
+    def stop(self, timeout: float = None):
+        self._stop.set()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for stage in self.stages.values():
+            stage.stop(None if deadline is None else max(0.0, deadline - time.monotonic()))
+
+    def stats(self) -> list:
+        return [stage.stats() for stage in self.stages.values()]
+
+    def _report(self):
+        while not self._stop.wait(self.stats_interval):
+            for s in self.stats():
+                log.info(
+                    f"[{s['stage']}] Queue {s['depth']}/{s['maxsize']}, "
+                    f"verarbeitet={s['processed']}, Fehler={s['failed']}, "
+                    f"verworfen={s['dropped']}, ausgelagert={s['spilled']}"
+                )
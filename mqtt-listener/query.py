@@ -0,0 +1,225 @@
+"""
+Zeitbereichs-Abfragen über die spaltenweisen Segmente (siehe segments.py).
+
+"Topic X zwischen t1 und t2, auf N Punkte verdichtet, mit min/max/avg":
+
+- Segmente werden über Tagesverzeichnis und Dateiname (<start>-<end>.seg)
+  vorgefiltert, ohne sie zu öffnen
+- die Header (Block-Index mit t_min/t_max und Statistiken) werden gecacht
+- Blöcke, die vollständig in einen Zielpunkt fallen, werden nur über ihre
+  Statistiken aggregiert; alle anderen werden per mmap gelesen und nur die
+  benötigten Spalten dekomprimiert
+"""
+import json
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from itertools import accumulate
+
+from segments import ACTIVE_SUFFIX, SEALED_SUFFIX, SEG_MAGIC, from_le_bytes, read_active_rows
+from sink import safe_topic_name
+
+
+class Bucket:
+    """Aggregat (count/min/max/sum) einer Spalte in einem Zielpunkt."""
+    __slots__ = ("count", "min", "max", "sum")
+
+    def __init__(self):
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+        self.sum = 0.0
+
+    def add_stats(self, count, vmin, vmax, vsum):
+        if count:
+            self.count += count
+            self.min = min(self.min, vmin)
+            self.max = max(self.max, vmax)
+            self.sum += vsum
+
+    def add_values(self, values):
+        if not values:
+            return
+        self.add_stats(len(values), min(values), max(values), math.fsum(values))
+
+    def to_dict(self):
+        if not self.count:
+            return None
+        return {"min": self.min, "max": self.max, "avg": self.sum / self.count, "count": self.count}
+
+
+class SegmentIndex:
+    """Findet die Segmente eines Topics und cached deren Header (LRU)."""
+
+    def __init__(self, base_dir: str, max_headers: int = 1024):
+        self.base_dir = base_dir
+        self.max_headers = max_headers
+        self._headers = OrderedDict()  # (Pfad, mtime) -> Header
+        self._lock = threading.Lock()
+
+    def segments(self, topic: str, t_from_ms: int, t_to_ms: int):
+        """Liefert (Pfad, versiegelt?) aller Segmente, die den Zeitbereich berühren."""
+        topic_dir = os.path.join(self.base_dir, safe_topic_name(topic))
+        if not os.path.isdir(topic_dir):
+            return []
+        first_day = time.strftime("%Y%m%d", time.gmtime(t_from_ms / 1000))
+        last_day = time.strftime("%Y%m%d", time.gmtime(t_to_ms / 1000))
+        result = []
+        for day in sorted(os.listdir(topic_dir)):
+            if day < first_day or day > last_day:
+                continue
+            day_dir = os.path.join(topic_dir, day)
+            for name in sorted(os.listdir(day_dir)):
+                if name.endswith(SEALED_SUFFIX):
+                    start, end = (int(x) for x in name[:-len(SEALED_SUFFIX)].split("-"))
+                    if end >= t_from_ms and start <= t_to_ms:
+                        result.append((os.path.join(day_dir, name), True))
+                elif name.endswith(ACTIVE_SUFFIX):
+                    if int(name[:-len(ACTIVE_SUFFIX)]) <= t_to_ms:
+                        result.append((os.path.join(day_dir, name), False))
+        return result
+
+    def header(self, path: str, mm) -> dict:
+        key = (path, os.path.getmtime(path))
+        with self._lock:
+            header = self._headers.get(key)
+            if header is not None:
+                self._headers.move_to_end(key)
+                return header
+        if mm[:8] != SEG_MAGIC:
+            raise ValueError(f"{path} ist kein versiegeltes Segment")
+        (hlen,) = struct.unpack_from("<I", mm, 8)
+        header = json.loads(mm[12:12 + hlen].decode("utf-8"))
+        header["_data_start"] = 12 + hlen
+        with self._lock:
+            self._headers[key] = header
+            while len(self._headers) > self.max_headers:
+                self._headers.popitem(last=False)
+        return header
+
+
+class QueryEngine:
+
+    def __init__(self, index: SegmentIndex):
+        self.index = index
+
+    @classmethod
+    def from_env(cls, data_dir: str):
+        return cls(SegmentIndex(os.environ.get("SEGMENT_DIR", os.path.join(data_dir, "segments"))))
+
+    def query(self, topic: str, t_from: float, t_to: float, points: int = 500, columns: list = None) -> dict:
+        """
+        Verdichtet die Werte von topic im Bereich [t_from, t_to] (Sekunden)
+        auf höchstens points Zielpunkte mit min/max/avg je Spalte.
+        """
+        t_from_ms = int(t_from * 1000)
+        t_to_ms = int(t_to * 1000)
+        points = max(1, points)
+        width = max(1, (t_to_ms - t_from_ms + 1) / points)
+        buckets = {}   # Index des Zielpunkts -> {Spalte: Bucket}
+        all_columns = []
+
+        def bucket_of(ts):
+            return int((ts - t_from_ms) // width)
+
+        def get_bucket(i, col):
+            b = buckets.setdefault(i, {})
+            if col not in b:
+                b[col] = Bucket()
+            return b[col]
+
+        for path, sealed in self.index.segments(topic, t_from_ms, t_to_ms):
+            if sealed:
+                seg_columns = self._scan_sealed(path, t_from_ms, t_to_ms, columns, bucket_of, get_bucket)
+            else:
+                seg_columns = self._scan_active(path, t_from_ms, t_to_ms, columns, bucket_of, get_bucket)
+            for c in seg_columns:
+                if c not in all_columns:
+                    all_columns.append(c)
+
+        result_columns = [c for c in all_columns if columns is None or c in columns]
+        result = []
+        for i in sorted(buckets):
+            values = {c: buckets[i][c].to_dict() for c in result_columns if c in buckets[i]}
+            values = {c: v for c, v in values.items() if v is not None}
+            if values:
+                result.append({"t": int(t_from_ms + i * width) / 1000, "values": values})
+        return {"topic": topic, "from": t_from, "to": t_to, "columns": result_columns, "points": result}
+
+    def _scan_sealed(self, path, t_from_ms, t_to_ms, wanted, bucket_of, get_bucket):
+        with open(path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                header = self.index.header(path, mm)
+                seg_columns = header["columns"]
+                data_start = header["_data_start"]
+                for block in header["blocks"]:
+                    if block["t_max"] < t_from_ms or block["t_min"] > t_to_ms:
+                        continue
+                    first = bucket_of(block["t_min"])
+                    inside = block["t_min"] >= t_from_ms and block["t_max"] <= t_to_ms
+                    if inside and first == bucket_of(block["t_max"]):
+                        # Schneller Pfad: Block liegt in einem Zielpunkt, Statistiken genügen
+                        for c, stats in zip(seg_columns, block["stats"]):
+                            if wanted is None or c in wanted:
+                                get_bucket(first, c).add_stats(stats["count"], stats["min"], stats["max"], stats["sum"])
+                        continue
+                    self._scan_block(mm, data_start, block, seg_columns, t_from_ms, t_to_ms, wanted, bucket_of, get_bucket)
+        return seg_columns
+
+    def _scan_block(self, mm, data_start, block, seg_columns, t_from_ms, t_to_ms, wanted, bucket_of, get_bucket):
+        sizes = block["sizes"]
+        offset = data_start + block["offset"]
+        ts = list(accumulate(from_le_bytes("q", zlib.decompress(mm[offset:offset + sizes[0]]))))
+        lo = bisect_left(ts, t_from_ms)
+        hi = bisect_right(ts, t_to_ms)
+        # Grenzen der Zielpunkte innerhalb des Blocks bestimmen
+        ranges = []
+        start = lo
+        while start < hi:
+            i = bucket_of(ts[start])
+            end = self._bucket_end(ts, start, hi, i, bucket_of)
+            ranges.append((i, start, end))
+            start = end
+
+        offset += sizes[0]
+        for c, (name, size, stats) in enumerate(zip(seg_columns, sizes[1:], block["stats"])):
+            col_offset = offset
+            offset += size
+            if (wanted is not None and name not in wanted) or not stats["count"]:
+                continue
+            values = from_le_bytes("f", zlib.decompress(mm[col_offset:col_offset + size]))
+            has_nan = stats["count"] < block["rows"]
+            for i, start, end in ranges:
+                chunk = values[start:end]
+                if has_nan:
+                    chunk = [v for v in chunk if v == v]
+                get_bucket(i, name).add_values(chunk)
+
+    @staticmethod
+    def _bucket_end(ts, start, hi, i, bucket_of):
+        # Binäre Suche nach der ersten Zeile, die in einen späteren Zielpunkt fällt
+        lo_idx, hi_idx = start + 1, hi
+        while lo_idx < hi_idx:
+            mid = (lo_idx + hi_idx) // 2
+            if bucket_of(ts[mid]) <= i:
+                lo_idx = mid + 1
+            else:
+                hi_idx = mid
+        return lo_idx
+
+    def _scan_active(self, path, t_from_ms, t_to_ms, wanted, bucket_of, get_bucket):
+        seg_columns, rows = read_active_rows(path)
+        for row in rows:
+            if row[0] < t_from_ms or row[0] > t_to_ms:
+                continue
+            i = bucket_of(row[0])
+            for name, v in zip(seg_columns, row[1:]):
+                if v == v and (wanted is None or name in wanted):
+                    get_bucket(i, name).add_stats(1, v, v, v)
+        return seg_columns
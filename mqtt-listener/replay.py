@@ -0,0 +1,394 @@
+"""
+Replay/Backfill gespeicherter Nachrichten aus den Textdateien.
+
+Liest <DATA_DIR>/<Topic>.txt und die rotierten Dateien im Archiv (siehe
+retention.py, auch .txt.gz) zeilenweise über Generatoren, also mit
+konstantem Speicher, und sendet die Nachrichten erneut:
+
+    --target cloudevents   über den CloudEventForwarder direkt an den Broker-Ingress,
+                           z.B. nach einem Ausfall des Knative-Brokers. Mit key_field
+                           (--key-field, Default "id") ist die Id dieselbe wie im
+                           Original, Empfänger erkennen schon zugestellte Events
+                           als Duplikat; sonst erhält jedes Event eine neue Id.
+    --target mqtt          an einen MQTT-Broker, optional unter --prefix (ohne Präfix
+                           speichert ein laufender Listener die Nachrichten erneut)
+
+Die Textdateien enthalten pro Zeile nur die Payload, keinen Zeitstempel. Der
+Zeitpunkt einer Zeile wird aus dem Zeitbereich der Datei (Manifest) anhand
+ihrer Position in der Datei interpoliert. Zeitfenster (--from/--to) und
+Tempo stimmen damit pro Datei, innerhalb einer Datei nur angenähert.
+
+Tempo: --speed 1 = Echtzeit, 10 = zehnfach, 0 = so schnell wie möglich. Es
+sind höchstens --concurrency Nachrichten gleichzeitig unterwegs.
+
+Mit --checkpoint wird die Position pro Topic alle --progress Sekunden
+gespeichert, nachdem alle offenen Sendungen abgeschlossen sind; ein
+erneuter Aufruf mit derselben Datei setzt dort fort.
+
+Beispiel (im Listener-Pod, dort sind DATA_DIR und die CLOUDEVENTS_* gesetzt):
+
+    kubectl exec mqtt-listener-au-u69 -- python /app/replay.py \\
+        --topic au-u69/atom/order --from 2025-01-27T08:00:00 --to 2025-01-27T12:00:00 \\
+        --target cloudevents --speed 0 --checkpoint /data/.replay/order.json
+"""
+import argparse
+import gzip
+import heapq
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+
+from api import parse_time
+from decoders import DecoderRegistry
+from dedup import event_id
+from logs import setup_logging
+from retention import GZIP_SUFFIX, read_manifest
+from sink import safe_topic_name
+
+log = logging.getLogger("replay")
+
+# Schlüssel der laufenden <Topic>.txt im Checkpoint
+ACTIVE = "active"
+
+
+class ReplayFile:
+    """Eine Datei eines Topics mit Zeitbereich (ms) und Grösse (unkomprimiert)."""
+    __slots__ = ("key", "path", "start", "end", "size")
+
+    def __init__(self, key: str, path: str, start: int, end: int, size: int):
+        self.key = key
+        self.path = path
+        self.start = start
+        self.end = end
+        self.size = size
+
+
+def replay_files(data_dir: str, archive_dir: str, topic: str, t_from_ms: int, t_to_ms: int) -> list:
+    """Rotierte Dateien und die laufende Datei des Topics, die den Zeitbereich berühren (nach Zeit sortiert)."""
+    files = []
+    last_end = 0
+    directory = os.path.join(archive_dir, safe_topic_name(topic))
+    for entry in read_manifest(archive_dir, topic):
+        last_end = max(last_end, entry["end"])
+        if entry["end"] >= t_from_ms and entry["start"] <= t_to_ms:
+            key = entry["file"][:-len(GZIP_SUFFIX)] if entry["file"].endswith(GZIP_SUFFIX) else entry["file"]
+            files.append(ReplayFile(key, os.path.join(directory, entry["file"]), entry["start"], entry["end"],
+                                    entry["bytes"]))
+    active = os.path.join(data_dir, f"{safe_topic_name(topic)}.txt")
+    try:
+        st = os.stat(active)
+    except FileNotFoundError:
+        return files
+    end = int(st.st_mtime * 1000)
+    if end >= t_from_ms and last_end <= t_to_ms:
+        # Nur bis zur aktuellen Grösse lesen, der Listener schreibt weiter
+        files.append(ReplayFile(ACTIVE, active, last_end, end, st.st_size))
+    return files
+
+
+def iter_lines(path: str, offset: int = 0, limit: int = None):
+    """(Position nach der Zeile, Zeile) ab offset (unkomprimierte Bytes), .gz wird beim Lesen entpackt."""
+    if not os.path.exists(path) and os.path.exists(path + GZIP_SUFFIX):
+        path += GZIP_SUFFIX  # inzwischen vom Listener komprimiert
+    opener = gzip.open if path.endswith(GZIP_SUFFIX) else open
+    with opener(path, "rb") as f:
+        f.seek(offset)
+        pos = offset
+        for line in f:
+            if not line.endswith(b"\n") or (limit is not None and pos + len(line) > limit):
+                break  # unvollständige letzte Zeile oder nach dem Listing geschrieben
+            pos += len(line)
+            yield pos, line[:-1]
+
+
+def topic_stream(topic: str, files: list, t_from_ms: int, t_to_ms: int, position: dict = None):
+    """
+    Nachrichten eines Topics als (Zeit in ms, Topic, Payload, Datei, Beginn der Datei, Position).
+
+    position (aus dem Checkpoint) überspringt Dateien, die vor der dort
+    gespeicherten beginnen; die erste übrige Datei setzt beim Offset fort,
+    wenn sie die gespeicherte ist. War das die laufende Datei und wurde sie
+    inzwischen rotiert, ist es die erste rotierte Datei ab deren Beginn.
+    """
+    resume = position
+    for f in files:
+        offset = 0
+        if resume is not None:
+            if f.start < resume["start"]:
+                continue
+            if f.key == resume["file"] or resume["file"] == ACTIVE:
+                offset = resume["offset"]
+            resume = None
+        span = f.end - f.start
+        limit = f.size if f.key == ACTIVE else None
+        for pos, line in iter_lines(f.path, offset, limit):
+            ts = f.start + (span * pos // f.size if f.size else 0)
+            if ts < t_from_ms or not line:
+                continue
+            if ts > t_to_ms:
+                return
+            yield ts, topic, line.decode("utf-8", errors="replace"), f.key, f.start, pos
+
+
+class Pacer:
+    """Hält die Abstände der Nachrichten ein (geteilt durch speed); speed 0 = ohne Pause."""
+
+    def __init__(self, speed: float):
+        self.speed = speed
+        self._origin = None  # (Zeit der ersten Nachricht in ms, monotonic)
+
+    def wait(self, ts_ms: int):
+        if self.speed <= 0:
+            return
+        if self._origin is None:
+            self._origin = (ts_ms, time.monotonic())
+            return
+        delay = self._origin[1] + (ts_ms - self._origin[0]) / 1000 / self.speed - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class Checkpoint:
+    """Position pro Topic: {"file": Schlüssel, "start": Beginn der Datei, "offset": Bytes}."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.positions = {}
+        self.sent = 0
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            self.positions = data.get("topics", {})
+            self.sent = data.get("sent", 0)
+            log.info(f"Setze bei Checkpoint {path} fort ({self.sent} Nachrichten bereits gesendet).")
+
+    def update(self, topic: str, key: str, start: int, offset: int):
+        self.positions[topic] = {"file": key, "start": start, "offset": offset}
+
+    def save(self, sent: int):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"topics": self.positions, "sent": sent}, f)
+        os.replace(self.path + ".tmp", self.path)
+
+
+class CloudEventTarget:
+    """Versand über den CloudEventForwarder mit concurrency Worker-Threads."""
+
+    def __init__(self, forwarder, decoders: DecoderRegistry = None, concurrency: int = 4, key_field: str = "id"):
+        self.forwarder = forwarder
+        self.decoders = decoders
+        self.key_field = key_field
+        self.errors = 0
+        self._queue = queue.Queue(maxsize=concurrency)
+        self._workers = [
+            threading.Thread(target=self._work, name=f"replay-{i}", daemon=True) for i in range(concurrency)
+        ]
+        for t in self._workers:
+            t.start()
+
+    def send(self, topic: str, payload_str: str):
+        self._queue.put((topic, payload_str))
+
+    def drain(self):
+        self._queue.join()
+
+    def close(self, submitted: int, retry_wait: float):
+        self.drain()
+        for _ in self._workers:
+            self._queue.put(None)
+        for t in self._workers:
+            t.join()
+        # Fehlgeschlagene Events liegen in der Retry-Queue: ihr etwas Zeit lassen
+        deadline = time.monotonic() + retry_wait
+        while self.forwarder.sent + self.forwarder.dead < submitted - self.errors and time.monotonic() < deadline:
+            time.sleep(0.5)
+        self.forwarder.close()
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                topic, payload_str = item
+                # Wie im Listener: JSON ohne Umrechnung unverändert, sonst der dekodierte Datensatz
+                record = None
+                decoder = self.decoders.get(topic) if self.decoders is not None else None
+                if decoder is not None and not decoder.passthrough:
+                    record = decoder.decode(payload_str)
+                self.forwarder.forward(topic, payload_str, record,
+                                       event_id(payload_str.encode("utf-8"), self.key_field))
+            except Exception as e:
+                self.errors += 1
+                log.warning(f"[{item[0]}] Nachricht kann nicht als CloudEvent gesendet werden: {e}")
+            finally:
+                self._queue.task_done()
+
+
+class MqttTarget:
+    """Publiziert an einen Broker; höchstens concurrency unbestätigte Nachrichten."""
+
+    def __init__(self, broker_url: str, qos: int = 1, prefix: str = "", concurrency: int = 100,
+                 timeout: float = 30.0):
+        import paho.mqtt.client as mqtt
+        from subscriptions import parse_broker_url
+
+        self.qos = qos
+        self.prefix = prefix
+        self.concurrency = max(1, concurrency)
+        self.timeout = timeout
+        self.errors = 0
+        self._inflight = deque()
+        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=f"mqtt-replay-{os.getpid()}")
+        self.client.max_inflight_messages_set(self.concurrency)
+        host, port = parse_broker_url(broker_url)
+        self.client.connect(host, port, 60)
+        self.client.loop_start()
+
+    def send(self, topic: str, payload_str: str):
+        self._inflight.append(self.client.publish(self.prefix + topic, payload_str, qos=self.qos))
+        while len(self._inflight) >= self.concurrency:
+            self._wait(self._inflight.popleft())
+
+    def drain(self):
+        while self._inflight:
+            self._wait(self._inflight.popleft())
+
+    def close(self, submitted: int, retry_wait: float):
+        self.drain()
+        self.client.disconnect()
+        self.client.loop_stop()
+
+    def _wait(self, info):
+        try:
+            info.wait_for_publish(self.timeout)
+        except (RuntimeError, ValueError) as e:
+            self.errors += 1
+            log.warning(f"Publish fehlgeschlagen: {e}")
+            return
+        if not info.is_published():
+            self.errors += 1
+
+
+def iso(ts_ms: int) -> str:
+    return datetime.fromtimestamp(ts_ms / 1000, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def replay(streams: list, target, pacer: Pacer, checkpoint: Checkpoint = None, progress: float = 10.0,
+           t_begin: int = 0, t_end: int = 0) -> dict:
+    """Sendet die nach Zeit zusammengeführten Nachrichten aller Topics; liefert die Statistik."""
+    sent = checkpoint.sent if checkpoint is not None else 0
+    count = 0
+    started = time.monotonic()
+    next_report = started + progress
+    ts = t_begin
+
+    def report():
+        elapsed = time.monotonic() - started
+        done = (ts - t_begin) / (t_end - t_begin) * 100 if t_end > t_begin else 100.0
+        log.info(f"Replay {min(100.0, done):.1f} %: {count} Nachrichten ({count / elapsed if elapsed else 0:.0f}/s), "
+                 f"Stand {iso(ts)}, Fehler {target.errors}")
+
+    for ts, topic, payload_str, key, start, offset in heapq.merge(*streams, key=lambda r: r[0]):
+        pacer.wait(ts)
+        target.send(topic, payload_str)
+        count += 1
+        if checkpoint is not None:
+            checkpoint.update(topic, key, start, offset)
+        if progress and time.monotonic() >= next_report:
+            # Erst alles Offene abschliessen, dann die Position festhalten
+            target.drain()
+            if checkpoint is not None:
+                checkpoint.save(sent + count)
+            report()
+            next_report = time.monotonic() + progress
+
+    target.drain()
+    if checkpoint is not None:
+        checkpoint.save(sent + count)
+    report()
+    return {"sent": count, "errors": target.errors, "seconds": round(time.monotonic() - started, 3)}
+
+
+def load_decoders(config_dir: str):
+    """Decoder gemäss spec.format der Sensoren aus der Listener-Konfiguration (falls vorhanden)."""
+    from subscriptions import load_config_dir, topic_schemas, topic_values
+
+    decoders = DecoderRegistry()
+    if config_dir and os.path.isdir(config_dir):
+        config = load_config_dir(config_dir)
+        decoders.apply(topic_schemas(config), topic_values(config))
+    return decoders
+
+
+def main():
+    data_dir = os.environ.get("DATA_DIR", "/data")
+    parser = argparse.ArgumentParser(description="Gespeicherte Nachrichten erneut an MQTT oder CloudEvents senden")
+    parser.add_argument("--topic", action="append", required=True, help="Topic (mehrfach möglich)")
+    parser.add_argument("--from", dest="t_from", help="Beginn, Epoch-Sekunden oder ISO-8601 (Default: alles)")
+    parser.add_argument("--to", dest="t_to", help="Ende, Epoch-Sekunden oder ISO-8601 (Default: jetzt)")
+    parser.add_argument("--target", default="cloudevents", choices=("cloudevents", "mqtt"))
+    parser.add_argument("--speed", type=float, default=1.0, help="1 = Echtzeit, N = N-fach, 0 = so schnell wie möglich")
+    parser.add_argument("--concurrency", type=int, default=4, help="Höchstens so viele Nachrichten gleichzeitig unterwegs")
+    parser.add_argument("--broker", default=os.environ.get("MQTT_BROKER_URL", "mqtt://cloud.tbz.ch:1883"))
+    parser.add_argument("--qos", type=int, default=1, choices=(0, 1, 2))
+    parser.add_argument("--prefix", default="", help="Präfix für die Topics beim Publizieren (z.B. replay/)")
+    parser.add_argument("--data-dir", default=data_dir)
+    parser.add_argument("--archive-dir", default=os.environ.get("ARCHIVE_DIR"), help="Default: <data-dir>/archive")
+    parser.add_argument("--config", default=os.environ.get("LISTENER_CONFIG"), help="Listener-Konfiguration für die Decoder")
+    parser.add_argument("--key-field", default=os.environ.get("DEDUP_KEY_FIELD", "id"),
+                        help="JSON-Feld als CloudEvent-Id (wie im Listener)")
+    parser.add_argument("--checkpoint", help="Datei für die Position, um einen Abbruch fortzusetzen")
+    parser.add_argument("--progress", type=float, default=10.0, help="Sekunden zwischen Fortschritt und Checkpoint")
+    parser.add_argument("--retry-dir", help="Retry-Queue des Forwarders (Default: <data-dir>/.cloudevents-replay)")
+    parser.add_argument("--retry-wait", type=float, default=30.0,
+                        help="Sekunden, die fehlgeschlagene CloudEvents am Ende erneut versucht werden")
+    args = parser.parse_args()
+    setup_logging()
+
+    t_to = parse_time(args.t_to, time.time())
+    t_from = parse_time(args.t_from, 0)
+    t_from_ms, t_to_ms = int(t_from * 1000), int(t_to * 1000)
+    archive_dir = args.archive_dir or os.path.join(args.data_dir, "archive")
+    checkpoint = Checkpoint(args.checkpoint) if args.checkpoint else None
+
+    streams = []
+    starts, ends = [], []
+    for topic in args.topic:
+        files = replay_files(args.data_dir, archive_dir, topic, t_from_ms, t_to_ms)
+        log.info(f"{topic}: {len(files)} Datei(en), {sum(f.size for f in files)} Bytes.")
+        if files:
+            starts.append(files[0].start)
+            ends.append(files[-1].end)
+        position = checkpoint.positions.get(topic) if checkpoint is not None else None
+        streams.append(topic_stream(topic, files, t_from_ms, t_to_ms, position))
+
+    if args.target == "mqtt":
+        target = MqttTarget(args.broker, args.qos, args.prefix, args.concurrency)
+    else:
+        from forwarder import CloudEventForwarder
+
+        # Immer eine eigene Retry-Queue, die des laufenden Listeners bleibt unberührt
+        os.environ["CLOUDEVENTS_RETRY_DIR"] = args.retry_dir or os.path.join(args.data_dir, ".cloudevents-replay")
+        forwarder = CloudEventForwarder.from_env(args.data_dir, pool_size=args.concurrency)
+        forwarder.start()
+        target = CloudEventTarget(forwarder, load_decoders(args.config), args.concurrency, args.key_field or None)
+
+    result = replay(
+        streams, target, Pacer(args.speed), checkpoint, args.progress,
+        t_begin=max(t_from_ms, min(starts, default=t_from_ms)), t_end=min(t_to_ms, max(ends, default=t_to_ms)),
+    )
+    target.close(result["sent"], args.retry_wait)
+    if args.target == "cloudevents":
+        result["cloudevents"] = target.forwarder.stats()
+    print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,404 @@
+"""
+Rotation, Komprimierung und Aufbewahrung der Textdateien (<DATA_DIR>/<Topic>.txt).
+
+Der FileSink rotiert <Topic>.txt nach Grösse oder Alter (SINK_ROTATE_BYTES,
+SINK_ROTATE_AGE) ins Archiv:
+
+    <ARCHIVE_DIR>/<Topic>/<start_ms>-<end_ms>.txt      (rotiert, noch nicht komprimiert)
+    <ARCHIVE_DIR>/<Topic>/<start_ms>-<end_ms>.txt.gz   (komprimiert)
+    <ARCHIVE_DIR>/<Topic>/manifest.json
+
+Das Manifest listet die rotierten Dateien mit ihrem Zeitbereich, damit
+Leser nur die Dateien öffnen, die den gesuchten Bereich berühren:
+
+    {"topic": "au-u69/atom/env",
+     "files": [{"file": "1737360000000-1737446400000.txt.gz", "start": 1737360000000,
+                "end": 1737446400000, "bytes": 67108864, "stored": 9437184, "compressed": true}]}
+
+Die laufende Datei <Topic>.txt enthält alles nach "end" des letzten
+Eintrags. start ist 0, wenn der Beginn einer Datei unbekannt ist (Datei aus
+einem Lauf vor der Rotation).
+
+Ein Hintergrund-Thread mit niedriger Priorität komprimiert rotierte Dateien
+(gzip) und löscht gemäss storage.retention des MQTTDevices alte Dateien:
+
+    maxAgeDays  rotierte Dateien (und Tagesverzeichnisse der Segmente) löschen,
+                deren Ende älter ist; 0 = unbegrenzt
+    maxBytes    höchstens so viele Bytes (komprimiert) rotierter Dateien pro
+                Topic, die ältesten zuerst löschen; 0 = unbegrenzt
+
+Teilen sich mehrere MQTTDevices ein Topic, gilt die grosszügigste Vorgabe.
+Es werden nur Topics der eigenen Konfiguration verwaltet, damit sich die
+Shards auf einem gemeinsamen PVC nicht in die Quere kommen.
+"""
+import gzip
+import json
+import logging
+import os
+import queue
+import re
+import shutil
+import threading
+import time
+
+from metrics import ARCHIVE_FILES
+from sink import safe_topic_name
+
+log = logging.getLogger(__name__)
+
+MANIFEST = "manifest.json"
+TEXT_SUFFIX = ".txt"
+GZIP_SUFFIX = ".gz"
+
+_ARCHIVED = re.compile(r"^(\d+)-(\d+)\.txt(\.gz)?$")
+
+
+class RetentionPolicy:
+    """Aufbewahrung eines Topics aus storage.retention."""
+
+    def __init__(self, max_age_days: float = 0.0, max_bytes: int = 0):
+        if max_age_days < 0 or max_bytes < 0:
+            raise ValueError("maxAgeDays und maxBytes dürfen nicht negativ sein")
+        self.max_age_days = float(max_age_days)
+        self.max_bytes = int(max_bytes)
+
+    @classmethod
+    def from_dict(cls, spec: dict):
+        return cls(
+            max_age_days=float(spec.get("maxAgeDays", 0)),
+            max_bytes=int(spec.get("maxBytes", 0)),
+        )
+
+    def merge(self, other: "RetentionPolicy") -> "RetentionPolicy":
+        """Die grosszügigere Vorgabe je Grenze (0 = unbegrenzt gewinnt)."""
+        def loosest(a, b):
+            return 0 if not a or not b else max(a, b)
+        return RetentionPolicy(loosest(self.max_age_days, other.max_age_days),
+                               loosest(self.max_bytes, other.max_bytes))
+
+
+def retention_by_topic(config: dict, default: RetentionPolicy) -> dict:
+    """Topic -> RetentionPolicy über alle MQTTDevices (ohne storage.retention gilt default)."""
+    result = {}
+    for name, entry in config.items():
+        try:
+            policy = RetentionPolicy.from_dict(entry["retention"]) if entry.get("retention") else default
+        except (TypeError, ValueError) as e:
+            log.error(f"Ungültige Aufbewahrung für {name}, verwende Default: {e}")
+            policy = default
+        for topic in entry.get("topics", []):
+            result[topic] = result[topic].merge(policy) if topic in result else policy
+    return result
+
+
+def read_manifest(base_dir: str, topic: str) -> list:
+    """
+    Einträge des Manifests eines Topics, nur lesend (z.B. für replay.py neben
+    dem laufenden Listener). Ohne Manifest aus den Dateinamen.
+    """
+    directory = os.path.join(base_dir, safe_topic_name(topic))
+    try:
+        with open(os.path.join(directory, MANIFEST), encoding="utf-8") as f:
+            return json.load(f).get("files", [])
+    except FileNotFoundError:
+        pass
+    if not os.path.isdir(directory):
+        return []
+    files = []
+    for name in sorted(os.listdir(directory)):
+        match = _ARCHIVED.match(name)
+        if match:
+            size = os.path.getsize(os.path.join(directory, name))
+            files.append({
+                "file": name, "start": int(match.group(1)), "end": int(match.group(2)),
+                "bytes": size, "stored": size, "compressed": bool(match.group(3)),
+            })
+    return sorted(files, key=lambda f: (f["start"], f["end"]))
+
+
+def _lower_priority():
+    """Nur diesen Thread zurückstufen (unter Linux wirkt setpriority mit der Thread-ID)."""
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+    except (AttributeError, OSError):
+        pass
+
+
+class ArchiveManager:
+
+    def __init__(self, base_dir: str, segment_dir: str = None, compress: bool = True, compress_level: int = 6,
+                 interval: float = 300.0, default: RetentionPolicy = None):
+        self.base_dir = base_dir
+        self.segment_dir = segment_dir
+        self.compress = compress
+        self.compress_level = compress_level
+        self.interval = interval
+        self.default = default or RetentionPolicy()
+        self._policies = {}    # Topic -> RetentionPolicy
+        self._manifests = {}   # Topic -> Manifest (geladen bei der ersten Verwendung)
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()  # (Topic, Dateiname) zum Komprimieren
+        self._stop = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_env(cls, data_dir: str):
+        """Erzeugt den Manager anhand der ARCHIVE_* und RETENTION_* Umgebungsvariablen."""
+        return cls(
+            base_dir=os.environ.get("ARCHIVE_DIR", os.path.join(data_dir, "archive")),
+            segment_dir=os.environ.get("SEGMENT_DIR", os.path.join(data_dir, "segments")),
+            compress=os.environ.get("ARCHIVE_COMPRESS", "true").lower() == "true",
+            compress_level=int(os.environ.get("ARCHIVE_COMPRESS_LEVEL", "6")),
+            interval=float(os.environ.get("RETENTION_INTERVAL", "300")),
+            default=RetentionPolicy(
+                max_age_days=float(os.environ.get("RETENTION_MAX_AGE_DAYS", "0")),
+                max_bytes=int(os.environ.get("RETENTION_MAX_BYTES", "0")),
+            ),
+        )
+
+    # --------------------------------------
+    # Öffentliche API
+    # --------------------------------------
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="archive-maintenance", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Beendet den Thread; nicht komprimierte Dateien folgen beim nächsten Start."""
+        self._stop.set()
+        self._queue.put(None)
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def apply(self, config: dict):
+        policies = retention_by_topic(config, self.default)
+        with self._lock:
+            self._policies = policies
+        # Manifeste der eigenen Topics laden, damit Liegengebliebenes komprimiert wird
+        for topic in policies:
+            self._manifest(topic)
+
+    def policy_for(self, topic: str) -> RetentionPolicy:
+        with self._lock:
+            policy = self._policies.get(topic)
+            if policy is None and "/" in topic:
+                # Abgeleitete Topics (<Topic>/agg) wie ihr Sensor-Topic
+                policy = self._policies.get(topic.rsplit("/", 1)[0])
+        return policy or self.default
+
+    def last_end(self, topic: str) -> int:
+        """Ende der jüngsten rotierten Datei des Topics in ms (0, falls keine)."""
+        manifest = self._manifest(topic)
+        with self._lock:
+            return max((f["end"] for f in manifest["files"]), default=0)
+
+    def rotate(self, topic: str, path: str, start_ms: int = None):
+        """
+        Verschiebt die (geschlossene) Datei path ins Archiv und trägt sie ins
+        Manifest ein. start_ms None = Beginn unbekannt, dann ab dem Ende der
+        letzten rotierten Datei. Liefert den neuen Pfad oder None.
+        """
+        # Manifest vor dem Verschieben laden, sonst nähme der Abgleich die Datei ein zweites Mal auf
+        manifest = self._manifest(topic)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        end_ms = int(st.st_mtime * 1000)
+        if start_ms is None:
+            start_ms = self.last_end(topic)
+        start_ms = min(start_ms, end_ms)
+        directory = os.path.join(self.base_dir, safe_topic_name(topic))
+        os.makedirs(directory, exist_ok=True)
+        name = f"{start_ms}-{end_ms}{TEXT_SUFFIX}"
+        while os.path.exists(os.path.join(directory, name)) or os.path.exists(os.path.join(directory, name + GZIP_SUFFIX)):
+            end_ms += 1
+            name = f"{start_ms}-{end_ms}{TEXT_SUFFIX}"
+        target = os.path.join(directory, name)
+        shutil.move(path, target)
+        with self._lock:
+            manifest["files"].append({
+                "file": name, "start": start_ms, "end": end_ms,
+                "bytes": st.st_size, "stored": st.st_size, "compressed": False,
+            })
+            manifest["files"].sort(key=lambda f: (f["start"], f["end"]))
+            self._write_manifest(topic, manifest)
+        ARCHIVE_FILES.labels("rotated").inc()
+        log.info(f"{path} rotiert nach {target} ({st.st_size} Bytes).")
+        if self.compress:
+            self._queue.put((topic, name))
+        return target
+
+    def files(self, topic: str, t_from_ms: int = None, t_to_ms: int = None) -> dict:
+        """Manifest des Topics, auf die Dateien eingeschränkt, die den Zeitbereich berühren."""
+        manifest = self._manifest(topic)
+        with self._lock:
+            files = [
+                dict(f, path=os.path.join(self.base_dir, safe_topic_name(topic), f["file"]))
+                for f in manifest["files"]
+                if (t_from_ms is None or f["end"] >= t_from_ms) and (t_to_ms is None or f["start"] <= t_to_ms)
+            ]
+        return {"topic": topic, "files": files}
+
+    def sweep(self, now: float = None):
+        """Löscht gemäss Aufbewahrung alte rotierte Dateien und Segment-Tage."""
+        now = time.time() if now is None else now
+        with self._lock:
+            topics = set(self._policies) | set(self._manifests)
+        for topic in sorted(topics):
+            policy = self.policy_for(topic)
+            if policy.max_age_days or policy.max_bytes:
+                self._sweep_archive(topic, policy, now)
+                if policy.max_age_days:
+                    self._sweep_segments(topic, now - policy.max_age_days * 86400)
+
+    # --------------------------------------
+    # Interna
+    # --------------------------------------
+    def _run(self):
+        _lower_priority()
+        next_sweep = time.monotonic()
+        while True:
+            try:
+                job = self._queue.get(timeout=max(0.0, next_sweep - time.monotonic()))
+            except queue.Empty:
+                job = None
+            if self._stop.is_set():
+                return
+            try:
+                if job is not None:
+                    self._compress(*job)
+                if time.monotonic() >= next_sweep:
+                    next_sweep = time.monotonic() + self.interval
+                    self.sweep()
+            except Exception as e:
+                log.error(f"Fehler bei der Archivpflege: {e}")
+
+    def _manifest(self, topic: str) -> dict:
+        with self._lock:
+            manifest = self._manifests.get(topic)
+            if manifest is None:
+                manifest = self._manifests[topic] = self._load_manifest(topic)
+            return manifest
+
+    def _load_manifest(self, topic: str) -> dict:
+        """Liest das Manifest und gleicht es mit dem Verzeichnis ab (Abbruch mitten in Rotation/Komprimierung)."""
+        directory = os.path.join(self.base_dir, safe_topic_name(topic))
+        manifest = {"topic": topic, "files": []}
+        try:
+            manifest["files"] = read_manifest(self.base_dir, topic)
+        except (OSError, ValueError) as e:
+            log.error(f"Manifest von {topic} unlesbar, baue es aus den Dateinamen neu auf: {e}")
+        if not os.path.isdir(directory):
+            return manifest
+
+        names = set(os.listdir(directory))
+        for name in names:
+            if name.endswith(".tmp"):
+                os.remove(os.path.join(directory, name))
+        # Komprimiert, aber das Original noch vorhanden: das .gz ist vollständig (fsync vor dem Umbenennen)
+        for name in sorted(names):
+            if name.endswith(TEXT_SUFFIX) and name + GZIP_SUFFIX in names:
+                os.remove(os.path.join(directory, name))
+                names.discard(name)
+
+        files = {}
+        for entry in manifest["files"]:
+            name = entry["file"]
+            if name not in names and name + GZIP_SUFFIX in names:
+                name = name + GZIP_SUFFIX
+                entry = dict(entry, file=name, compressed=True)
+            if name in names:
+                files[name] = entry
+        for name in names - set(files):
+            match = _ARCHIVED.match(name)
+            if match:
+                size = os.path.getsize(os.path.join(directory, name))
+                files[name] = {
+                    "file": name, "start": int(match.group(1)), "end": int(match.group(2)),
+                    "bytes": size, "stored": size, "compressed": bool(match.group(3)),
+                }
+        for entry in files.values():
+            if entry.get("compressed"):
+                continue
+            entry["stored"] = os.path.getsize(os.path.join(directory, entry["file"]))
+            if self.compress:
+                self._queue.put((topic, entry["file"]))
+        manifest["files"] = sorted(files.values(), key=lambda f: (f["start"], f["end"]))
+        self._write_manifest(topic, manifest)
+        return manifest
+
+    def _write_manifest(self, topic: str, manifest: dict):
+        directory = os.path.join(self.base_dir, safe_topic_name(topic))
+        if not manifest["files"] and not os.path.isdir(directory):
+            return
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, MANIFEST)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+        os.replace(path + ".tmp", path)
+
+    def _compress(self, topic: str, name: str):
+        directory = os.path.join(self.base_dir, safe_topic_name(topic))
+        source = os.path.join(directory, name)
+        target = source + GZIP_SUFFIX
+        if not os.path.exists(source):
+            return  # inzwischen gelöscht oder schon komprimiert
+        with open(source, "rb") as src, open(target + ".tmp", "wb") as raw:
+            with gzip.GzipFile(filename=name, mode="wb", compresslevel=self.compress_level, fileobj=raw) as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            raw.flush()
+            os.fsync(raw.fileno())
+        os.replace(target + ".tmp", target)
+        manifest = self._manifest(topic)
+        with self._lock:
+            for entry in manifest["files"]:
+                if entry["file"] == name:
+                    entry.update(file=name + GZIP_SUFFIX, stored=os.path.getsize(target), compressed=True)
+            self._write_manifest(topic, manifest)
+        os.remove(source)
+        ARCHIVE_FILES.labels("compressed").inc()
+
+    def _sweep_archive(self, topic: str, policy: RetentionPolicy, now: float):
+        manifest = self._manifest(topic)
+        with self._lock:
+            keep, expired = list(manifest["files"]), []
+            if policy.max_age_days:
+                cutoff_ms = int((now - policy.max_age_days * 86400) * 1000)
+                expired = [f for f in keep if f["end"] < cutoff_ms]
+                keep = [f for f in keep if f["end"] >= cutoff_ms]
+            if policy.max_bytes:
+                total = sum(f["stored"] for f in keep)
+                while keep and total > policy.max_bytes:
+                    oldest = keep.pop(0)
+                    total -= oldest["stored"]
+                    expired.append(oldest)
+            if not expired:
+                return
+            manifest["files"] = keep
+            # Erst das Manifest, damit Leser keine gelöschten Dateien mehr finden
+            self._write_manifest(topic, manifest)
+        directory = os.path.join(self.base_dir, safe_topic_name(topic))
+        for entry in expired:
+            try:
+                os.remove(os.path.join(directory, entry["file"]))
+            except FileNotFoundError:
+                pass
+            ARCHIVE_FILES.labels("deleted").inc()
+        log.info(f"{len(expired)} rotierte Datei(en) von {topic} gemäss Aufbewahrung gelöscht.")
+
+    def _sweep_segments(self, topic: str, cutoff: float):
+        if not self.segment_dir:
+            return
+        topic_dir = os.path.join(self.segment_dir, safe_topic_name(topic))
+        if not os.path.isdir(topic_dir):
+            return
+        # Tagesverzeichnisse (JJJJMMTT, UTC), die vollständig vor cutoff liegen
+        cutoff_day = time.strftime("%Y%m%d", time.gmtime(cutoff))
+        for day in sorted(os.listdir(topic_dir)):
+            if day.isdigit() and day < cutoff_day:
+                shutil.rmtree(os.path.join(topic_dir, day), ignore_errors=True)
+                ARCHIVE_FILES.labels("deleted").inc()
+                log.info(f"Segmente von {topic} vom {day} gemäss Aufbewahrung gelöscht.")
@@ -0,0 +1,405 @@
+"""
+Kompaktes, spaltenorientiertes Speicherformat für Sensorwerte.
+
+Layout auf dem PVC:
+
+    <DATA_DIR>/segments/<Topic>/<JJJJMMTT>/<start_ms>.active       (offenes Segment)
+    <DATA_DIR>/segments/<Topic>/<JJJJMMTT>/<start_ms>-<end_ms>.seg  (versiegelt)
+
+Offenes Segment (append-only, zeilenweise, little-endian):
+
+    b"IIOTROW1" | u32 Länge | JSON {"columns": [...]} | Zeilen: i64 ts_ms, n x f32
+
+Versiegeltes Segment (spaltenweise, in Blöcke zu block_rows Zeilen geteilt,
+jede Spalte eines Blocks einzeln zlib-komprimiert, Zeitstempel delta-codiert):
+
+    b"IIOTSEG1" | u32 Länge | JSON-Header | Blockdaten
+
+Der Header enthält pro Block t_min/t_max, Offset und Spaltengrössen sowie
+count/min/max/sum je Spalte, damit Abfragen ganze Blöcke überspringen oder
+ohne Dekomprimieren aggregieren können.
+"""
+import json
+import logging
+import math
+import os
+import queue
+import struct
+import sys
+import threading
+import time
+import zlib
+from array import array
+
+from sink import safe_topic_name
+
+log = logging.getLogger(__name__)
+
+ROW_MAGIC = b"IIOTROW1"
+SEG_MAGIC = b"IIOTSEG1"
+ACTIVE_SUFFIX = ".active"
+SEALED_SUFFIX = ".seg"
+
+_LITTLE = sys.byteorder == "little"
+
+
+def _to_le_bytes(arr: array) -> bytes:
+    if not _LITTLE:
+        arr = array(arr.typecode, arr)
+        arr.byteswap()
+    return arr.tobytes()
+
+
+def from_le_bytes(typecode: str, data) -> array:
+    arr = array(typecode)
+    arr.frombytes(data)
+    if not _LITTLE:
+        arr.byteswap()
+    return arr
+
+
+def parse_reading(payload_str: str, columns: list):
+    """
+    Ordnet die numerischen Felder einer Nachricht den Werten des Sensors zu.
+
+    CSV wie "0xBC,25.40,51.6,middle": nicht-numerische Felder (Adresse, Text)
+    werden übersprungen, die übrigen der Reihe nach den Spalten zugeordnet.
+    JSON-Objekte werden über die Spaltennamen zugeordnet. Fehlende Werte = NaN.
+    Liefert None, wenn die Nachricht keinen einzigen Wert enthält.
+    """
+    payload_str = payload_str.strip()
+    numbers = []
+    if payload_str.startswith("{"):
+        try:
+            data = json.loads(payload_str)
+            numbers = [data.get(name) for name in columns]
+        except ValueError:
+            return None
+    else:
+        for field in payload_str.split(","):
+            field = field.strip()
+            if field.lower().startswith("0x"):
+                continue
+            try:
+                numbers.append(float(field))
+            except ValueError:
+                continue
+
+    values = []
+    for i in range(len(columns)):
+        v = numbers[i] if i < len(numbers) else None
+        try:
+            values.append(float(v) if v is not None else math.nan)
+        except (TypeError, ValueError):
+            values.append(math.nan)
+    if all(math.isnan(v) for v in values):
+        return None
+    return values
+
+
+def read_active_rows(path: str):
+    """Liest ein offenes Segment; eine evtl. unvollständige letzte Zeile wird ignoriert."""
+    with open(path, "rb") as f:
+        data = f.read()
+    if data[:8] != ROW_MAGIC:
+        raise ValueError(f"{path} ist kein offenes Segment")
+    (hlen,) = struct.unpack_from("<I", data, 8)
+    columns = json.loads(data[12:12 + hlen].decode("utf-8"))["columns"]
+    row = struct.Struct("<q" + "f" * len(columns))
+    body = memoryview(data)[12 + hlen:]
+    rows = [row.unpack_from(body, off) for off in range(0, len(body) - row.size + 1, row.size)]
+    return columns, rows
+
+
+def seal_rows(path: str, topic: str, columns: list, rows: list, block_rows: int = 4096) -> dict:
+    """Schreibt Zeilen als versiegeltes, spaltenweises Segment und liefert den Header."""
+    # Abfragen setzen aufsteigende Zeitstempel innerhalb eines Blocks voraus
+    rows = sorted(rows, key=lambda r: r[0])
+    blocks = []
+    chunks = []
+    offset = 0
+    for start in range(0, len(rows), block_rows):
+        block = rows[start:start + block_rows]
+        ts = array("q", (r[0] for r in block))
+        deltas = array("q", [ts[0]] + [ts[i] - ts[i - 1] for i in range(1, len(ts))])
+        parts = [zlib.compress(_to_le_bytes(deltas), 6)]
+        stats = []
+        for c in range(len(columns)):
+            col = array("f", (r[c + 1] for r in block))
+            parts.append(zlib.compress(_to_le_bytes(col), 6))
+            valid = [v for v in col if not math.isnan(v)]
+            stats.append({
+                "count": len(valid),
+                "min": min(valid) if valid else None,
+                "max": max(valid) if valid else None,
+                "sum": sum(valid),
+            })
+        sizes = [len(p) for p in parts]
+        blocks.append({
+            "rows": len(block),
+            "t_min": min(ts),
+            "t_max": max(ts),
+            "offset": offset,
+            "sizes": sizes,
+            "stats": stats,
+        })
+        chunks.extend(parts)
+        offset += sum(sizes)
+
+    header = {
+        "version": 1,
+        "topic": topic,
+        "columns": columns,
+        "rows": len(rows),
+        "t_min": min((b["t_min"] for b in blocks), default=0),
+        "t_max": max((b["t_max"] for b in blocks), default=0),
+        "codec": "zlib",
+        "blocks": blocks,
+    }
+    raw_header = json.dumps(header).encode("utf-8")
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(SEG_MAGIC)
+        f.write(struct.pack("<I", len(raw_header)))
+        f.write(raw_header)
+        for chunk in chunks:
+            f.write(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return header
+
+
+def _fire(acks: list):
+    for ack in acks:
+        try:
+            ack()
+        except Exception as e:
+            log.error(f"Fehler beim Bestätigen einer Nachricht: {e}")
+
+
+class SegmentWriter:
+    """Offenes Segment eines Topics; rotiert nach Grösse, Alter und Tageswechsel."""
+
+    def __init__(self, store, topic: str, columns: list):
+        self.store = store
+        self.topic = topic
+        self.columns = columns
+        self._row = struct.Struct("<q" + "f" * len(columns))
+        self._file = None
+        self._path = None
+        self._day = None
+        self._opened_at = 0.0
+        self._bytes = 0
+
+    def append(self, ts: float, values: list):
+        ts_ms = int(ts * 1000)
+        day = time.strftime("%Y%m%d", time.gmtime(ts))
+        if self._file is not None and (
+            day != self._day
+            or self._bytes >= self.store.max_bytes
+            or time.monotonic() - self._opened_at >= self.store.max_age
+        ):
+            self.seal()
+        if self._file is None:
+            self._open(ts_ms, day)
+        self._file.write(self._row.pack(ts_ms, *values))
+        self._bytes += self._row.size
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def seal(self):
+        """Schliesst das offene Segment; das Umwandeln ins spaltenweise Format übernimmt der Sealer-Thread."""
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        self.store.schedule_seal(self._path, self.topic)
+
+    def _open(self, ts_ms: int, day: str):
+        directory = os.path.join(self.store.base_dir, safe_topic_name(self.topic), day)
+        os.makedirs(directory, exist_ok=True)
+        # Ein eben geschlossenes Segment derselben Millisekunde kann noch auf den Sealer warten
+        while os.path.exists(os.path.join(directory, f"{ts_ms}{ACTIVE_SUFFIX}")):
+            ts_ms += 1
+        self._path = os.path.join(directory, f"{ts_ms}{ACTIVE_SUFFIX}")
+        self._file = open(self._path, "ab")
+        raw_header = json.dumps({"columns": self.columns}).encode("utf-8")
+        self._file.write(ROW_MAGIC + struct.pack("<I", len(raw_header)) + raw_header)
+        self._day = day
+        self._opened_at = time.monotonic()
+        self._bytes = 0
+
+
+class SegmentStore:
+    """
+    Verwaltet die Segmente aller Topics.
+
+    columns_by_topic ordnet jedem Topic die Wertenamen aus spec.values des
+    Sensors zu; Nachrichten anderer Topics werden nicht spaltenweise gespeichert.
+    Mit decoders (DecoderRegistry) werden die Werte gemäss spec.format des
+    Sensors zerlegt, sonst mit parse_reading.
+    """
+
+    def __init__(
+        self,
+        base_dir: str,
+        columns_by_topic: dict,
+        max_bytes: int = 4 * 1024 * 1024,
+        max_age: float = 3600.0,
+        block_rows: int = 4096,
+        flush_interval: float = 1.0,
+        flush_pending_acks: int = 10,
+    ):
+        self.base_dir = base_dir
+        self.columns_by_topic = columns_by_topic
+        self.decoders = None
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.block_rows = block_rows
+        self.flush_interval = flush_interval
+        self.flush_pending_acks = max(1, flush_pending_acks)
+        self._writers = {}
+        self._acks = []  # on_durable-Callbacks bis zum nächsten Flush
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        # Geschlossene offene Segmente (Pfad, Topic); versiegelt wird ausserhalb des Ingest-Pfads
+        self._seal_queue = queue.Queue()
+        self._sealer = None
+        self._recovered = set()  # Topics, deren offene Segmente schon übergeben sind
+
+    @classmethod
+    def from_env(cls, data_dir: str):
+        """Erzeugt den Store anhand von TOPIC_VALUES und den SEGMENT_* Umgebungsvariablen."""
+        return cls(
+            base_dir=os.environ.get("SEGMENT_DIR", os.path.join(data_dir, "segments")),
+            columns_by_topic=json.loads(os.environ.get("TOPIC_VALUES", "{}") or "{}"),
+            max_bytes=int(os.environ.get("SEGMENT_MAX_BYTES", str(4 * 1024 * 1024))),
+            max_age=float(os.environ.get("SEGMENT_MAX_AGE", "3600")),
+            block_rows=int(os.environ.get("SEGMENT_BLOCK_ROWS", "4096")),
+            flush_pending_acks=int(os.environ.get("SEGMENT_FLUSH_PENDING_ACKS", "10")),
+        )
+
+    def start(self):
+        """Startet den Flush- und den Sealer-Thread; recover() folgt mit der Konfiguration."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="segment-flusher", daemon=True)
+            self._thread.start()
+        if self._sealer is None:
+            self._sealer = threading.Thread(target=self._seal_loop, name="segment-sealer", daemon=True)
+            self._sealer.start()
+
+    def accepts(self, topic: str) -> bool:
+        return topic in self.columns_by_topic
+
+    def append(self, topic: str, ts: float, payload_str: str, on_durable=None) -> bool:
+        """
+        Parst die Nachricht und hängt sie an; False, wenn sie keine Werte enthält
+        (on_durable wird dann nicht übernommen). Sonst wird on_durable nach dem
+        nächsten Flush aufgerufen.
+        """
+        columns = self.columns_by_topic.get(topic)
+        if not columns:
+            return False
+        decoder = self.decoders.get(topic) if self.decoders is not None else None
+        values = decoder.numbers(payload_str) if decoder is not None else parse_reading(payload_str, columns)
+        if values is None:
+            return False
+        with self._lock:
+            writer = self._writers.get(topic)
+            if writer is None:
+                writer = self._writers[topic] = SegmentWriter(self, topic, columns)
+            writer.append(ts, values)
+            if on_durable is not None:
+                self._acks.append(on_durable)
+            if len(self._acks) < self.flush_pending_acks:
+                return True
+            # Genug unbestätigte Nachrichten: sofort flushen statt auf den Timer zu warten
+            for w in self._writers.values():
+                w.flush()
+            acks, self._acks = self._acks, []
+        _fire(acks)
+        return True
+
+    def flush(self):
+        with self._lock:
+            for writer in self._writers.values():
+                writer.flush()
+            acks, self._acks = self._acks, []
+        _fire(acks)
+
+    def close(self):
+        """Beim Beenden alle offenen Segmente versiegeln."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            for writer in self._writers.values():
+                writer.seal()
+            self._writers = {}
+            acks, self._acks = self._acks, []
+        _fire(acks)
+        # Alle geschlossenen Segmente noch versiegeln, dann den Sealer beenden
+        self._seal_queue.put(None)
+        if self._sealer is not None:
+            self._sealer.join()
+            self._sealer = None
+        else:
+            self._seal_loop()
+
+    def schedule_seal(self, active_path: str, topic: str):
+        """Übergibt ein geschlossenes offenes Segment an den Sealer-Thread."""
+        self._seal_queue.put((active_path, topic))
+
+    def seal_file(self, active_path: str, topic: str):
+        try:
+            columns, rows = read_active_rows(active_path)
+            if rows:
+                # Zeilen sind nicht zwingend aufsteigend (z.B. Aggregate mit Fensterbeginn)
+                start_ms = min(r[0] for r in rows)
+                end_ms = max(r[0] for r in rows)
+                sealed_path = os.path.join(os.path.dirname(active_path), f"{start_ms}-{end_ms}{SEALED_SUFFIX}")
+                seal_rows(sealed_path, topic, columns, rows, self.block_rows)
+            os.remove(active_path)
+        except Exception as e:
+            log.error(f"Fehler beim Versiegeln von {active_path}: {e}")
+
+    def recover(self):
+        """
+        Offene Segmente eines abgebrochenen Laufs an den Sealer übergeben, je
+        Topic aus columns_by_topic nur beim ersten Aufruf, in dem es vorkommt.
+        Nach jeder Konfiguration aufrufen. Nur die Verzeichnisse der eigenen
+        Topics werden durchsucht: andere Listener auf demselben PVC schreiben
+        ihre offenen Segmente weiter. Segmente, in die dieser Lauf schon
+        schreibt, bleiben offen.
+        """
+        with self._lock:
+            topics = [t for t in self.columns_by_topic if t not in self._recovered]
+            self._recovered.update(topics)
+            own = {w._path for w in self._writers.values() if w._file is not None}
+        for topic in topics:
+            directory = os.path.join(self.base_dir, safe_topic_name(topic))
+            for root, _dirs, files in os.walk(directory):
+                for name in files:
+                    path = os.path.join(root, name)
+                    if name.endswith(ACTIVE_SUFFIX) and path not in own:
+                        self.schedule_seal(path, topic)
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                log.error(f"Fehler beim periodischen Flush der Segmente: {e}")
+
+    def _seal_loop(self):
+        # None beendet die Schleife (close)
+        while True:
+            item = self._seal_queue.get()
+            if item is None:
+                return
+            self.seal_file(*item)
@@ -0,0 +1,299 @@
+"""
+Gepufferter Datei-Sink für den MQTT-Listener.
+
+Statt pro Nachricht /data/<Topic>.txt zu öffnen, eine Zeile anzuhängen und
+die Datei wieder zu schliessen, hält der Sink pro Topic einen offenen
+Datei-Handle (LRU-begrenzt), sammelt die Zeilen im Speicher und schreibt sie
+gebündelt, sobald eine Grössen- oder Zeitschwelle erreicht ist oder der
+Listener beendet wird.
+
+Für QoS 1/2 kann write() ein on_durable-Callback mitgeben (Ack an den
+Broker). Er wird erst aufgerufen, wenn die Zeile gemäss fsync-Strategie
+dauerhaft geschrieben ist: bei "never" nach dem flush() ins OS, bei "batch"
+und "interval" nach dem fsync().
+
+Mit archive (retention.ArchiveManager) wird <Topic>.txt nach rotate_bytes
+Bytes bzw. rotate_age Sekunden geschlossen und ins Archiv verschoben; die
+nächste Zeile beginnt eine neue Datei.
+"""
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import SINK_FLUSH_SECONDS
+
+log = logging.getLogger(__name__)
+
+# fsync-Strategien
+FSYNC_NEVER = "never"        # nur flush() ins OS, fsync dem Kernel überlassen
+FSYNC_BATCH = "batch"        # nach jedem geschriebenen Batch fsync()
+FSYNC_INTERVAL = "interval"  # höchstens alle fsync_interval Sekunden fsync()
+FSYNC_POLICIES = (FSYNC_NEVER, FSYNC_BATCH, FSYNC_INTERVAL)
+
+
+def safe_topic_name(topic: str) -> str:
+    """Ersetzt evtl. verbotene Zeichen im Dateinamen."""
+    return topic.replace("/", "_")
+
+
+class FileSink:
+    """
+    Schreibt Nachrichten gepuffert nach <base_dir>/<Topic>.txt.
+
+    Thread-sicher: write() darf aus dem MQTT-Netzwerk-Thread aufgerufen werden,
+    ein Hintergrund-Thread sorgt für den zeitgesteuerten Flush.
+    """
+
+    def __init__(
+        self,
+        base_dir: str = "/data",
+        max_open_files: int = 64,
+        flush_bytes: int = 64 * 1024,
+        flush_interval: float = 1.0,
+        fsync_policy: str = FSYNC_NEVER,
+        fsync_interval: float = 5.0,
+        flush_pending_acks: int = 10,
+        rotate_bytes: int = 0,
+        rotate_age: float = 0.0,
+    ):
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError(f"Unbekannte fsync-Strategie '{fsync_policy}', erlaubt: {FSYNC_POLICIES}")
+        self.base_dir = base_dir
+        self.max_open_files = max(1, max_open_files)
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval
+        # Der Broker lässt nur wenige unbestätigte Nachrichten zu, deshalb
+        # früher schreiben, sobald so viele Acks warten
+        self.flush_pending_acks = max(1, flush_pending_acks)
+        self.rotate_bytes = rotate_bytes
+        self.rotate_age = rotate_age
+        self.archive = None
+
+        self._lock = threading.Lock()
+        self._files = OrderedDict()  # Topic -> offener Datei-Handle (LRU-Reihenfolge)
+        self._buffers = {}           # Topic -> Liste gepufferter Zeilen
+        self._buffered_bytes = 0
+        self._unsynced = set()       # Topics mit Daten, die noch nicht ge-fsync-t sind
+        self._last_fsync = time.monotonic()
+        self._acks = {}              # Topic -> Callbacks für gepufferte Zeilen
+        self._pending_acks = 0       # Anzahl Callbacks in _acks
+        self._unsynced_acks = {}     # Topic -> Callbacks für geschriebene, noch nicht ge-fsync-te Zeilen
+        self._ready_acks = []        # Callbacks, die ausserhalb des Locks aufgerufen werden
+        self._active = {}            # Topic -> [Beginn in ms (None = unbekannt), Bytes, geöffnet (monotonic)]
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_env(cls, base_dir: str = None):
+        """Erzeugt einen Sink anhand der SINK_* Umgebungsvariablen."""
+        return cls(
+            base_dir=base_dir or os.environ.get("DATA_DIR", "/data"),
+            max_open_files=int(os.environ.get("SINK_MAX_OPEN_FILES", "64")),
+            flush_bytes=int(os.environ.get("SINK_FLUSH_BYTES", str(64 * 1024))),
+            flush_interval=float(os.environ.get("SINK_FLUSH_INTERVAL", "1.0")),
+            fsync_policy=os.environ.get("SINK_FSYNC", FSYNC_NEVER),
+            fsync_interval=float(os.environ.get("SINK_FSYNC_INTERVAL", "5.0")),
+            flush_pending_acks=int(os.environ.get("SINK_FLUSH_PENDING_ACKS", "10")),
+            rotate_bytes=int(os.environ.get("SINK_ROTATE_BYTES", str(64 * 1024 * 1024))),
+            rotate_age=float(os.environ.get("SINK_ROTATE_AGE", "86400")),
+        )
+
+    def path_for(self, topic: str) -> str:
+        return os.path.join(self.base_dir, f"{safe_topic_name(topic)}.txt")
+
+    # --------------------------------------
+    # Öffentliche API
+    # --------------------------------------
+    def start(self):
+        """Startet den Hintergrund-Thread für den zeitgesteuerten Flush."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="file-sink-flusher", daemon=True)
+            self._thread.start()
+
+    def write(self, topic: str, line: str, on_durable=None):
+        """
+        Puffert eine Zeile für das Topic; schreibt, wenn flush_bytes (oder
+        flush_pending_acks) erreicht ist. on_durable wird aufgerufen, sobald
+        die Zeile dauerhaft geschrieben ist.
+        """
+        data = line + "\n"
+        with self._lock:
+            if self.archive is not None and topic not in self._active:
+                self._active[topic] = self._active_state(topic)
+            self._buffers.setdefault(topic, []).append(data)
+            self._buffered_bytes += len(data)
+            if on_durable is not None:
+                self._acks.setdefault(topic, []).append(on_durable)
+                self._pending_acks += 1
+            if self._buffered_bytes >= self.flush_bytes or self._pending_acks >= self.flush_pending_acks:
+                self._flush_locked()
+        self._fire_acks()
+
+    def flush(self):
+        """Schreibt alle gepufferten Zeilen (inkl. fsync gemäss Strategie)."""
+        with self._lock:
+            self._flush_locked()
+        self._fire_acks()
+
+    def close(self):
+        """Stoppt den Flush-Thread, schreibt alles weg und schliesst alle Dateien."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            self._flush_locked()
+            # Beim Beenden immer auf die Platte bringen, ausser explizit "never"
+            if self.fsync_policy != FSYNC_NEVER:
+                self._fsync_locked()
+            for topic in list(self._files):
+                self._close_handle_locked(topic)
+            # Was jetzt noch wartet, ist nicht sicher geschrieben: nicht bestätigen,
+            # der Broker liefert es nach dem Neustart erneut
+            withheld = self._pending_acks + sum(len(acks) for acks in self._unsynced_acks.values())
+            if withheld:
+                log.error(f"{withheld} Nachricht(en) nicht dauerhaft geschrieben und nicht bestätigt")
+        self._fire_acks()
+
+    # --------------------------------------
+    # Interna
+    # --------------------------------------
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                log.error(f"Fehler beim periodischen Flush: {e}")
+
+    def _flush_locked(self):
+        if self._buffers:
+            start = time.perf_counter()
+            buffers, self._buffers = self._buffers, {}
+            acks_by_topic, self._acks = self._acks, {}
+            self._buffered_bytes = 0
+            self._pending_acks = 0
+            for topic, lines in buffers.items():
+                acks = acks_by_topic.get(topic, [])
+                try:
+                    f = self._handle_locked(topic)
+                    chunk = "".join(lines)
+                    f.write(chunk)
+                    f.flush()
+                    self._unsynced.add(topic)
+                    if topic in self._active:
+                        self._active[topic][1] += len(chunk)
+                except Exception as e:
+                    log.error(f"Fehler beim Schreiben in {self.path_for(topic)}: {e}")
+                    self._close_handle_locked(topic)
+                    # Zeilen und Acks zurück in den Puffer, der nächste Flush versucht es erneut;
+                    # bis dahin bleiben die Nachrichten beim Broker unbestätigt
+                    self._buffers[topic] = lines + self._buffers.get(topic, [])
+                    self._buffered_bytes += sum(len(line) for line in lines)
+                    if acks:
+                        self._acks[topic] = acks + self._acks.get(topic, [])
+                        self._pending_acks += len(acks)
+                    continue
+                if self.fsync_policy == FSYNC_NEVER:
+                    self._ready_acks.extend(acks)
+                elif acks:
+                    self._unsynced_acks.setdefault(topic, []).extend(acks)
+            if self.fsync_policy == FSYNC_BATCH:
+                self._fsync_locked()
+            SINK_FLUSH_SECONDS.observe(time.perf_counter() - start)
+
+        if self.fsync_policy == FSYNC_INTERVAL and time.monotonic() - self._last_fsync >= self.fsync_interval:
+            self._fsync_locked()
+
+        if self.archive is not None:
+            self._rotate_due_locked()
+
+    def _active_state(self, topic: str) -> list:
+        """Zustand der laufenden Datei; eine schon vorhandene hat einen unbekannten Beginn."""
+        try:
+            size = os.path.getsize(self.path_for(topic))
+        except OSError:
+            size = 0
+        return [None if size else int(time.time() * 1000), size, time.monotonic()]
+
+    def _rotate_due_locked(self):
+        now = time.monotonic()
+        for topic, (start_ms, size, opened) in list(self._active.items()):
+            if not size:
+                continue
+            if (self.rotate_bytes and size >= self.rotate_bytes) or (self.rotate_age and now - opened >= self.rotate_age):
+                self._rotate_locked(topic, start_ms)
+
+    def _rotate_locked(self, topic: str, start_ms):
+        # Schliessen (inkl. fsync gemäss Strategie), dann verschieben; die nächste Zeile öffnet eine neue Datei
+        if not self._close_handle_locked(topic):
+            return
+        try:
+            self.archive.rotate(topic, self.path_for(topic), start_ms)
+            del self._active[topic]
+        except Exception as e:
+            log.error(f"Fehler beim Rotieren von {self.path_for(topic)}: {e}")
+            # Erst nach weiteren rotate_bytes bzw. rotate_age erneut versuchen
+            self._active[topic] = [start_ms, 0, time.monotonic()]
+
+    def _fsync_locked(self):
+        # Nur Topics mit erfolgreichem fsync bestätigen, die anderen beim nächsten Mal erneut
+        for topic in list(self._unsynced):
+            try:
+                f = self._handle_locked(topic)
+                os.fsync(f.fileno())
+            except Exception as e:
+                log.error(f"Fehler bei fsync von {self.path_for(topic)}: {e}")
+                continue
+            self._unsynced.discard(topic)
+            self._ready_acks.extend(self._unsynced_acks.pop(topic, []))
+        self._last_fsync = time.monotonic()
+
+    def _fire_acks(self):
+        # Ausserhalb des Locks, damit der MQTT-Client nicht auf den Sink wartet
+        with self._lock:
+            acks, self._ready_acks = self._ready_acks, []
+        for ack in acks:
+            try:
+                ack()
+            except Exception as e:
+                log.error(f"Fehler beim Bestätigen einer Nachricht: {e}")
+
+    def _handle_locked(self, topic: str):
+        f = self._files.get(topic)
+        if f is not None:
+            self._files.move_to_end(topic)
+            return f
+        # Ältesten Handle schliessen, falls das Limit erreicht ist
+        while len(self._files) >= self.max_open_files:
+            oldest = next(iter(self._files))
+            self._close_handle_locked(oldest)
+        f = open(self.path_for(topic), "a", encoding="utf-8")
+        self._files[topic] = f
+        return f
+
+    def _close_handle_locked(self, topic: str) -> bool:
+        """Schliesst den Handle; False, wenn die Daten nicht sicher geschrieben sind."""
+        f = self._files.pop(topic, None)
+        if f is None:
+            return topic not in self._unsynced or self.fsync_policy == FSYNC_NEVER
+        try:
+            f.flush()
+            if topic in self._unsynced and self.fsync_policy != FSYNC_NEVER:
+                os.fsync(f.fileno())
+                self._ready_acks.extend(self._unsynced_acks.pop(topic, []))
+            self._unsynced.discard(topic)
+            return True
+        except Exception as e:
+            # Topic bleibt in _unsynced, _fsync_locked öffnet die Datei erneut
+            log.error(f"Fehler beim Schliessen von {self.path_for(topic)}: {e}")
+            return False
+        finally:
+            try:
+                f.close()
+            except Exception:
+                pass
@@ -0,0 +1,355 @@
+"""
+Abonnements des Listeners: eine MQTT-Verbindung pro Broker, Topics werden
+bei Konfigurationsänderungen nur als Delta (subscribe/unsubscribe)
+nachgeführt, ohne den Listener neu zu starten.
+
+Die Konfiguration ist ein Dict MQTTDevice -> Eintrag:
+
+    {"broker": "mqtt://cloud.tbz.ch:11883",
+     "qos": 1,
+     "topics": ["au-u69/atom/env"],
+     "topic_values": {"au-u69/atom/env": ["Temperature", "Humidity", ...]},
+     "topic_schemas": {"au-u69/atom/env": {"format": {...}, "values": [...]}},
+     "aggregation": {"window": 60, "functions": ["mean", "max"], ...}}
+
+Pro Broker besteht genau eine Verbindung, egal wie viele MQTTDevices ihn
+verwenden. Ab MQTT_WILDCARD_MIN Topics, die sich nur in einer Ebene
+unterscheiden, wird statt der einzelnen Topics ein Filter mit "+"
+abonniert (siehe topics.collapse_topics); eingehende Nachrichten ordnet
+ein Trie der konfigurierten Topics den MQTTDevices zu (route()).
+
+Die Verbindungen verwenden eine stabile Client-ID und clean_session=False,
+damit der Broker QoS-1/2-Nachrichten während eines Neustarts vorhält. Acks
+werden manuell gesendet (manual_ack), erst wenn die Nachricht gespeichert ist.
+Die Session behält auch die Abos; die zuletzt abonnierten Filter liegen daher
+pro Client-ID in <state_dir>/<Client-ID>.json, und beim Verbinden mit einer
+fortgesetzten Session werden die nicht mehr konfigurierten abbestellt.
+
+Im geteilten Modus (Shard) liegt pro MQTTDevice eine Datei <name>.json im
+Verzeichnis LISTENER_CONFIG (gemountete ConfigMap), die periodisch auf
+Änderungen geprüft wird.
+"""
+import json
+import logging
+import os
+import threading
+
+import paho.mqtt.client as mqtt
+
+from sink import safe_topic_name
+from topics import TopicTrie, collapse_topics
+
+log = logging.getLogger(__name__)
+
+
+def parse_broker_url(url: str):
+    """Aus MQTT-URL Host & Port extrahieren, z.B. "mqtt://test-broker:1883"."""
+    if url.startswith("mqtt://"):
+        url = url.replace("mqtt://", "")
+    broker_parts = url.split(":")
+    broker_host = broker_parts[0]
+    broker_port = int(broker_parts[1]) if len(broker_parts) > 1 else 1883
+    return broker_host, broker_port
+
+
+def topics_by_broker(config: dict) -> dict:
+    """Broker-URL -> {Topic: QoS} aller MQTTDevices dieses Brokers (höchste QoS gewinnt)."""
+    result = {}
+    for entry in config.values():
+        qos = int(entry.get("qos", 0))
+        topics = result.setdefault(entry["broker"], {})
+        for topic in entry.get("topics", []):
+            topics[topic] = max(qos, topics.get(topic, 0))
+    return result
+
+
+def routes_by_broker(config: dict) -> dict:
+    """Broker-URL -> Trie der Topics mit den MQTTDevices, die sie abonnieren."""
+    result = {}
+    for name, entry in config.items():
+        trie = result.setdefault(entry["broker"], TopicTrie())
+        for topic in entry.get("topics", []):
+            trie.insert(topic, name)
+    return result
+
+
+def topic_values(config: dict) -> dict:
+    """Topic -> Wertenamen über alle MQTTDevices (für den SegmentStore)."""
+    result = {}
+    for entry in config.values():
+        result.update(entry.get("topic_values", {}))
+    return result
+
+
+def topic_schemas(config: dict) -> dict:
+    """Topic -> Schema (format und values des Sensors) über alle MQTTDevices (für die Decoder)."""
+    result = {}
+    for entry in config.values():
+        result.update(entry.get("topic_schemas", {}))
+    return result
+
+
+def aggregations(config: dict) -> dict:
+    """Sensor-Topic -> spec.aggregation des MQTTDevices (mit Broker und QoS für das abgeleitete Topic)."""
+    result = {}
+    for entry in config.values():
+        aggregation = entry.get("aggregation")
+        if not aggregation:
+            continue
+        spec = dict(aggregation, broker=entry["broker"], qos=int(entry.get("qos", 0)))
+        for topic in entry.get("topic_values") or entry.get("topics", []):
+            result[topic] = spec
+    return result
+
+
+def load_config_dir(config_dir: str) -> dict:
+    """Liest alle <MQTTDevice>.json Dateien einer gemounteten ConfigMap."""
+    config = {}
+    for name in sorted(os.listdir(config_dir)):
+        if not name.endswith(".json") or name.startswith(".."):
+            continue
+        try:
+            with open(os.path.join(config_dir, name), encoding="utf-8") as f:
+                config[name[:-len(".json")]] = json.load(f)
+        except (OSError, ValueError) as e:
+            log.error(f"Konfiguration {name} konnte nicht gelesen werden: {e}")
+    return config
+
+
+class BrokerConnections:
+    """Hält eine MQTT-Verbindung pro Broker und gleicht deren Abonnements ab."""
+
+    def __init__(
+        self,
+        client_id: str,
+        on_message,
+        userdata: dict,
+        clean_session: bool = False,
+        max_inflight: int = 100,
+        max_queued: int = 0,
+        wildcard_min: int = 0,
+        state_dir: str = None,
+    ):
+        self.client_id = client_id
+        self.on_message = on_message
+        self.userdata = userdata
+        self.clean_session = clean_session
+        self.max_inflight = max_inflight
+        self.max_queued = max_queued
+        self.wildcard_min = wildcard_min
+        self._clients = {}  # Broker-URL -> mqtt.Client
+        self._topics = {}   # Broker-URL -> abonnierte Filter {Topic: QoS}
+        self._routes = {}   # Broker-URL -> TopicTrie der konfigurierten Topics
+        self._lock = threading.Lock()
+        # Broker-URL -> Filter {Topic: QoS}, die die Session beim Broker vermutlich hält;
+        # eigener Lock, da _on_connect im Netzwerk-Thread läuft (loop_stop() wartet darauf)
+        self._state_path = None
+        self._session = {}
+        self._session_lock = threading.Lock()
+        if state_dir:
+            os.makedirs(state_dir, exist_ok=True)
+            self._state_path = os.path.join(state_dir, f"{safe_topic_name(client_id)}.json")
+            self._session = self._load_session()
+
+    @classmethod
+    def from_env(cls, client_id: str, on_message, userdata: dict, data_dir: str = None):
+        """Erzeugt die Verbindungen anhand der MQTT_* Umgebungsvariablen."""
+        state_dir = os.environ.get("MQTT_STATE_DIR") or (data_dir and os.path.join(data_dir, ".mqtt"))
+        return cls(
+            client_id=os.environ.get("MQTT_CLIENT_ID") or client_id,
+            on_message=on_message,
+            userdata=userdata,
+            clean_session=os.environ.get("MQTT_CLEAN_SESSION", "false").lower() == "true",
+            max_inflight=int(os.environ.get("MQTT_MAX_INFLIGHT", "100")),
+            max_queued=int(os.environ.get("MQTT_MAX_QUEUED", "0")),
+            wildcard_min=int(os.environ.get("MQTT_WILDCARD_MIN", "3")),
+            state_dir=state_dir,
+        )
+
+    def apply(self, desired: dict, routes: dict = None):
+        """
+        Gleicht die Abonnements mit desired (Broker-URL -> {Topic: QoS}) ab.
+        routes (Broker-URL -> TopicTrie) ordnet Nachrichten den MQTTDevices zu,
+        ohne routes gilt das Topic selbst als Ziel.
+        """
+        if routes is None:
+            routes = {}
+            for broker, topics in desired.items():
+                trie = routes[broker] = TopicTrie()
+                for topic in topics:
+                    trie.insert(topic, topic)
+        desired = {broker: collapse_topics(topics, self.wildcard_min) for broker, topics in desired.items()}
+        with self._lock:
+            # Zuordnung vor den neuen Abos ersetzen, damit deren erste Nachrichten ein Ziel finden
+            self._routes = routes
+            for broker in list(self._clients):
+                if broker not in desired or not desired[broker]:
+                    self._disconnect(broker)
+            for broker, topics in desired.items():
+                if not topics:
+                    continue
+                if broker not in self._clients:
+                    self._connect(broker, dict(topics))
+                    continue
+                current = self._topics[broker]
+                removed = set(current) - set(topics)
+                # Neue Topics und solche mit geänderter QoS (neu) abonnieren
+                changed = {t: q for t, q in topics.items() if current.get(t) != q}
+                client = self._clients[broker]
+                unsubscribed = []
+                for topic in sorted(removed):
+                    # Ohne Verbindung wird nichts gesendet; dann erledigt es _on_connect
+                    if client.unsubscribe(topic)[0] == mqtt.MQTT_ERR_SUCCESS:
+                        unsubscribed.append(topic)
+                    log.info(f"Abo beendet: {topic}")
+                for topic, qos in sorted(changed.items()):
+                    client.subscribe(topic, qos)
+                    log.info(f"Abonniere Topic: {topic} (QoS {qos})")
+                self._topics[broker] = dict(topics)
+                self._update_session(broker, changed, unsubscribed)
+
+    def route(self, broker: str, topic: str) -> set:
+        """Ziele (MQTTDevices) einer eingehenden Nachricht; leer, wenn sie nur über einen Filter kam."""
+        trie = self._routes.get(broker)
+        return trie.match(topic) if trie is not None else set()
+
+    def publish(self, broker: str, topic: str, payload: str, qos: int = 0, retain: bool = False) -> bool:
+        """Publiziert über die Verbindung zum Broker; False, wenn keine besteht."""
+        client = self._clients.get(broker)
+        if client is None:
+            return False
+        return client.publish(topic, payload, qos=qos, retain=retain).rc == mqtt.MQTT_ERR_SUCCESS
+
+    def subscriptions(self) -> dict:
+        """Aktuell abonnierte Topics mit QoS pro Broker."""
+        with self._lock:
+            return {broker: dict(sorted(topics.items())) for broker, topics in self._topics.items()}
+
+    def close(self):
+        with self._lock:
+            for broker in list(self._clients):
+                self._disconnect(broker)
+
+    def _connect(self, broker: str, topics: dict):
+        host, port = parse_broker_url(broker)
+        # Stabile ID: nur so findet der Broker die persistente Session wieder
+        log.info(f"MQTT-Client-ID: {self.client_id} ({broker}, clean_session={self.clean_session})")
+        userdata = dict(self.userdata, broker=broker, connections=self)
+        client = mqtt.Client(
+            mqtt.CallbackAPIVersion.VERSION2,
+            client_id=self.client_id,
+            clean_session=self.clean_session,
+            userdata=userdata,
+            manual_ack=True,
+        )
+        client.max_inflight_messages_set(self.max_inflight)
+        client.max_queued_messages_set(self.max_queued)
+        client.on_connect = self._on_connect
+        client.on_message = self.on_message
+        # Falls Username/Passwort notwendig, hier client.username_pw_set(...) aufrufen
+        self._clients[broker] = client
+        self._topics[broker] = topics
+        client.connect_async(host, port, 60)
+        client.loop_start()
+
+    def _disconnect(self, broker: str):
+        client = self._clients.pop(broker)
+        topics = self._topics.pop(broker, None) or {}
+        # Die Session bleibt beim Broker bestehen; ihre Abos nicht weiter füllen lassen
+        unsubscribed = [t for t in sorted(topics) if client.unsubscribe(t)[0] == mqtt.MQTT_ERR_SUCCESS]
+        self._update_session(broker, {}, unsubscribed)
+        client.disconnect()
+        client.loop_stop()
+        log.info(f"Verbindung zu {broker} getrennt.")
+
+    def _on_connect(self, client, userdata, flags, reason_code, properties):
+        if not reason_code.is_failure:
+            broker = userdata["broker"]
+            session = "fortgesetzt" if flags.session_present else "neu"
+            log.info(f"Verbindung zum MQTT-Broker {broker} erfolgreich hergestellt (Session {session}).")
+            # Nach jedem (Re-)Connect alle aktuellen Topics abonnieren
+            # (ohne Lock: apply() ersetzt die Dicts nur, verändert sie nicht)
+            topics = self._topics.get(broker, {})
+            with self._session_lock:
+                previous = self._session.get(broker, {}) if flags.session_present else {}
+                # Filter der fortgesetzten Session, die nicht mehr konfiguriert sind
+                for topic in sorted(set(previous) - set(topics)):
+                    client.unsubscribe(topic)
+                    log.info(f"Abo aus der Session beendet: {topic}")
+                for topic, qos in sorted(topics.items()):
+                    client.subscribe(topic, qos)
+                    log.info(f"Abonniere Topic: {topic} (QoS {qos})")
+                self._session[broker] = dict(topics)
+                self._save_session()
+        else:
+            log.error(f"Fehler bei der MQTT-Verbindung. Return-Code: {reason_code}")
+
+
+    def _update_session(self, broker: str, subscribed: dict, unsubscribed: list):
+        """Führt die Filter der Session nach (neu abonniert bzw. erfolgreich abbestellt)."""
+        if not subscribed and not unsubscribed:
+            return
+        with self._session_lock:
+            topics = self._session.setdefault(broker, {})
+            topics.update(subscribed)
+            for topic in unsubscribed:
+                topics.pop(topic, None)
+            if not topics:
+                del self._session[broker]
+            self._save_session()
+
+    def _load_session(self) -> dict:
+        try:
+            with open(self._state_path, encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            log.error(f"Abos der letzten Session konnten nicht gelesen werden: {e}")
+            return {}
+
+    def _save_session(self):
+        if self._state_path is None:
+            return
+        tmp = self._state_path + ".tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self._session, f, sort_keys=True)
+            os.replace(tmp, self._state_path)
+        except OSError as e:
+            log.error(f"Abos der Session konnten nicht gespeichert werden: {e}")
+
+
+class ConfigWatcher:
+    """Prüft ein ConfigMap-Verzeichnis periodisch und meldet geänderte Konfigurationen."""
+
+    def __init__(self, config_dir: str, on_change, interval: float = 5.0):
+        self.config_dir = config_dir
+        self.on_change = on_change
+        self.interval = interval
+        self._last = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def check(self):
+        config = load_config_dir(self.config_dir)
+        if config != self._last:
+            self._last = config
+            self.on_change(config)
+
+    def start(self):
+        self.check()
+        self._thread = threading.Thread(target=self._run, name="config-watcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.check()
+            except Exception as e:
+                log.error(f"Fehler beim Neuladen der Konfiguration: {e}")
@@ -0,0 +1,95 @@
+"""
+MQTT-Topic-Filter: Zuordnung eingehender Nachrichten über einen Trie und
+Zusammenfassen vieler exakter Topics zu Wildcard-Abos.
+
+Abonniert ein Listener statt N exakten Topics einen Filter wie
+"au-u69/+/env", liefert der Broker auch Topics, die zu keinem MQTTDevice
+gehören. Jede Nachricht wird darum über den Trie der konfigurierten
+Topics (pro Broker) den MQTTDevices zugeordnet; ohne Treffer wird sie nur
+bestätigt und verworfen.
+"""
+
+
+class _Node:
+    __slots__ = ("children", "values")
+
+    def __init__(self):
+        self.children = {}
+        self.values = set()
+
+
+class TopicTrie:
+    """Topic-Filter (auch mit + und #) -> Werte; match() liefert die Werte aller passenden Filter."""
+
+    def __init__(self):
+        self._root = _Node()
+        self._size = 0
+
+    def insert(self, topic_filter: str, value):
+        node = self._root
+        for level in topic_filter.split("/"):
+            node = node.children.setdefault(level, _Node())
+        if value not in node.values:
+            node.values.add(value)
+            self._size += 1
+
+    def match(self, topic: str) -> set:
+        levels = topic.split("/")
+        result = set()
+        nodes = [(self._root, 0)]
+        while nodes:
+            node, i = nodes.pop()
+            # Wildcards auf der ersten Ebene passen nicht auf $-Topics ($SYS, ...)
+            wildcards = i > 0 or not topic.startswith("$")
+            multi = node.children.get("#") if wildcards else None
+            if multi is not None:
+                result |= multi.values  # "a/#" passt auch auf "a"
+            if i == len(levels):
+                result |= node.values
+                continue
+            child = node.children.get(levels[i])
+            if child is not None:
+                nodes.append((child, i + 1))
+            single = node.children.get("+") if wildcards else None
+            if single is not None:
+                nodes.append((single, i + 1))
+        return result
+
+    def __len__(self):
+        return self._size
+
+
+def is_filter(topic: str) -> bool:
+    return "+" in topic.split("/") or topic.endswith("#")
+
+
+def collapse_topics(topics: dict, min_group: int) -> dict:
+    """
+    Fasst exakte Topics ({Topic: QoS}), die sich nur in einer Ebene (nicht der
+    ersten) unterscheiden, ab min_group Stück zu einem Filter mit "+" zusammen:
+
+        au-u69/atom/env, au-u69/core/env, au-u69/stick/env -> au-u69/+/env
+
+    Die QoS des Filters ist die höchste der enthaltenen Topics. Die grössten
+    Gruppen werden zuerst gebildet, jedes Topic landet in höchstens einem Filter.
+    """
+    if min_group < 2:
+        return dict(topics)
+    exact = {t: q for t, q in topics.items() if not is_filter(t) and not t.startswith("$")}
+    result = {t: q for t, q in topics.items() if t not in exact}
+    groups = {}  # (Ebene, Ebenen davor, Ebenen danach) -> Topics
+    for topic in exact:
+        levels = tuple(topic.split("/"))
+        for i in range(1, len(levels)):
+            groups.setdefault((i, levels[:i], levels[i + 1:]), []).append(topic)
+    covered = set()
+    for (i, head, tail), members in sorted(groups.items(), key=lambda item: (-len(item[1]), item[0])):
+        members = [t for t in members if t not in covered]
+        if len(members) < min_group:
+            continue
+        result["/".join(head + ("+",) + tail)] = max(exact[t] for t in members)
+        covered.update(members)
+    for topic, qos in exact.items():
+        if topic not in covered:
+            result[topic] = qos
+    return result
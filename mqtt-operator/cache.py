@@ -0,0 +1,83 @@
+"""
+Informer-Cache des Operators für die clusterweiten Device-, Sensor- und
+Actor-CRs.
+
+Der Cache wird von kopf-Watch-Events (list+watch) gefüllt und aktuell
+gehalten, so dass die Topic-Auflösung eine lokale Abfrage ist. Zusätzlich
+wird pro MQTTDevice festgehalten, von welchen Devices, Sensoren und Aktoren
+es abhängt; ändert sich z.B. das Topic des Sensors "enviii", werden nur die
+betroffenen MQTTDevices neu aufgelöst.
+"""
+import copy
+import threading
+
+PLURALS = ("devices", "sensors", "actors")
+
+
+class ObjectCache:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._objects = {plural: {} for plural in PLURALS}   # plural -> name -> spec
+        self._dependents = {plural: {} for plural in PLURALS}  # plural -> name -> {(ns, MQTTDevice)}
+        self._tracked = {}  # (ns, MQTTDevice) -> {"spec": ..., "refs": {plural: set(names)}}
+
+    # --------------------------------------
+    # Objekte
+    # --------------------------------------
+    def get(self, plural: str, name: str):
+        """Spec eines Objekts oder None, falls (noch) nicht im Cache."""
+        with self._lock:
+            spec = self._objects[plural].get(name)
+        return copy.deepcopy(spec) if spec is not None else None
+
+    def put(self, plural: str, name: str, spec: dict) -> bool:
+        """
+        Speichert die Spec; liefert True, wenn sie neu ist oder sich gegenüber dem
+        Cache geändert hat (ein MQTTDevice kann sie schon vorher referenziert haben).
+        """
+        spec = copy.deepcopy(dict(spec or {}))
+        with self._lock:
+            previous = self._objects[plural].get(name)
+            self._objects[plural][name] = spec
+        return previous != spec
+
+    def remove(self, plural: str, name: str) -> bool:
+        """Entfernt das Objekt; True, wenn es im Cache war."""
+        with self._lock:
+            return self._objects[plural].pop(name, None) is not None
+
+    # --------------------------------------
+    # Abhängigkeiten MQTTDevice -> Device/Sensor/Actor
+    # --------------------------------------
+    def track(self, namespace: str, name: str, spec: dict, refs: dict):
+        """Merkt sich Spec und referenzierte Objekte (plural -> Namen) eines MQTTDevices."""
+        key = (namespace, name)
+        with self._lock:
+            self._untrack_locked(key)
+            self._tracked[key] = {"spec": copy.deepcopy(dict(spec or {})), "refs": refs}
+            for plural, names in refs.items():
+                for ref in names:
+                    self._dependents[plural].setdefault(ref, set()).add(key)
+
+    def untrack(self, namespace: str, name: str):
+        with self._lock:
+            self._untrack_locked((namespace, name))
+
+    def dependents(self, plural: str, name: str) -> list:
+        """MQTTDevices (namespace, name, spec), die vom Objekt abhängen."""
+        with self._lock:
+            keys = sorted(self._dependents[plural].get(name, ()))
+            return [(ns, n, copy.deepcopy(self._tracked[(ns, n)]["spec"])) for ns, n in keys]
+
+    def _untrack_locked(self, key):
+        entry = self._tracked.pop(key, None)
+        if entry is None:
+            return
+        for plural, names in entry["refs"].items():
+            for ref in names:
+                keys = self._dependents[plural].get(ref)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self._dependents[plural][ref]
@@ -0,0 +1,59 @@
+"""
+Prometheus-Metriken des Operators, abrufbar über GET /metrics auf METRICS_PORT.
+
+Die Aufrufe an den API-Server werden am REST-Client des gemeinsamen
+ApiClient gemessen, so dass jede API-Klasse (Core, Apps, CustomObjects)
+ohne weiteren Code erfasst wird.
+"""
+import functools
+import time
+from urllib.parse import urlparse
+
+from prometheus_client import Counter, Histogram
+
+API_CALLS = Counter(
+    "mqtt_operator_api_calls_total", "Aufrufe an den API-Server (outcome: ok oder HTTP-Status)",
+    ["method", "resource", "outcome"])
+API_SECONDS = Histogram(
+    "mqtt_operator_api_call_seconds", "Dauer eines Aufrufs an den API-Server", ["method", "resource"])
+RECONCILE_SECONDS = Histogram(
+    "mqtt_operator_reconcile_seconds", "Dauer eines Reconciles eines MQTTDevices")
+RECONCILE_ERRORS = Counter(
+    "mqtt_operator_reconcile_errors_total", "Reconciles, die mit einer Exception abgebrochen sind")
+CACHE_LOOKUPS = Counter(
+    "mqtt_operator_cache_lookups_total", "Abfragen des Informer-Caches (result: hit oder miss)",
+    ["plural", "result"])
+
+
+def api_resource(url: str) -> str:
+    """Ressource eines API-Pfads, z.B. /api/v1/namespaces/ns/pods/x -> pods."""
+    parts = [p for p in urlparse(url).path.split("/") if p]
+    if parts[:1] == ["api"]:
+        parts = parts[2:]
+    elif parts[:1] == ["apis"]:
+        parts = parts[3:]
+    if len(parts) > 2 and parts[0] == "namespaces":
+        parts = parts[2:]
+    return parts[0] if parts else "-"
+
+
+def meter_rest_client(rest_client):
+    """Misst jeden Request des REST-Clients (Anzahl, Ergebnis, Dauer)."""
+    request = rest_client.request
+
+    @functools.wraps(request)
+    def metered(method, url, *args, **kwargs):
+        resource = api_resource(url)
+        start = time.perf_counter()
+        outcome = "ok"
+        try:
+            return request(method, url, *args, **kwargs)
+        except Exception as e:
+            outcome = str(getattr(e, "status", None) or "error")
+            raise
+        finally:
+            API_SECONDS.labels(method, resource).observe(time.perf_counter() - start)
+            API_CALLS.labels(method, resource, outcome).inc()
+
+    rest_client.request = metered
+    return rest_client
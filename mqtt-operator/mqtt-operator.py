@@ -1,8 +1,130 @@
 import kopf
 from kubernetes import client, config
+import asyncio
+import functools
 import os
 import json
-import requests
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from prometheus_client import start_http_server
+
+from cloudevent import send_cloudevent
+from metrics import CACHE_LOOKUPS, RECONCILE_ERRORS, RECONCILE_SECONDS, meter_rest_client
+from sharding import shard_for, shard_names
+from cache import PLURALS, ObjectCache
+
+# MQTT Listener
+LISTENER_IMAGE = "registry.gitlab.com/ch-mc-b/autoshop-ms/infra/iiot/mqtt-listener:1.0.3"
+
+# "dedicated": ein Listener-Pod pro MQTTDevice
+# "shared":    feste Anzahl Listener-Deployments (Shards), die je viele MQTTDevices bedienen
+LISTENER_MODE = os.environ.get("LISTENER_MODE", "dedicated")
+LISTENER_SHARDS = int(os.environ.get("LISTENER_SHARDS", "4"))
+SHARD_PVC_NAME = os.environ.get("SHARD_PVC_NAME", "data-claim")
+SHARD_MOUNT_PATH = os.environ.get("SHARD_MOUNT_PATH", "/data")
+SHARD_STORAGE_MODE = os.environ.get("SHARD_STORAGE_MODE", "text")
+# "device": Shard nach Broker + MQTTDevice (Lastverteilung), "broker": ein Shard pro Broker (eine Verbindung)
+SHARD_KEY = os.environ.get("SHARD_KEY", "device")
+
+# ServiceAccount der Listener, der status.lastValues der MQTTDevices schreiben darf
+# (siehe mqtt-listener-rbac.yaml); leer = Default-ServiceAccount, nur GET /values
+LISTENER_SERVICE_ACCOUNT = os.environ.get("LISTENER_SERVICE_ACCOUNT", "")
+
+# Prometheus-Metriken (GET /metrics), 0 schaltet den Endpunkt ab
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9090"))
+
+# Höchstzahl gleichzeitiger Reconciles (Threads und Verbindungen zum API-Server)
+RECONCILE_CONCURRENCY = int(os.environ.get("RECONCILE_CONCURRENCY", "16"))
+
+# Field-Manager für Server-Side Apply der Listener-Ressourcen
+FIELD_MANAGER = "mqtt-operator"
+
+# Annotation am Listener-Pod mit den Speicher-Einstellungen, mit welchen er erstellt wurde
+STORAGE_ANNOTATION = "iiot.mc-b.ch/storage"
+
+# Informer-Cache für Device, Sensor und Actor (gefüllt über die Watch-Handler unten)
+object_cache = ObjectCache()
+
+# Geteilter Modus: angeglichene Shards ((ns, Shard) -> Manifeste) und Shard pro MQTTDevice
+# ((ns, Name) -> Shard), damit ein Reconcile nur noch den eigenen Eintrag schreibt.
+# Nach resync_shards ist die Zuordnung vollständig, ein fehlendes MQTTDevice also neu.
+_shard_lock = threading.Lock()
+_ensured_shards = {}
+_device_shards = {}
+_device_shards_complete = False
+
+# Gemeinsamer ApiClient, dessen Requests gemessen werden (erst nach dem Login von kopf erstellt)
+_api_client = None
+
+# Threads für die (blockierenden) Aufrufe des kubernetes-Clients aus den async-Handlern
+reconcile_executor = ThreadPoolExecutor(max_workers=RECONCILE_CONCURRENCY, thread_name_prefix="reconcile")
+
+#
+# Hilfsfunktion: ApiClient für alle API-Klassen (CoreV1Api, AppsV1Api, CustomObjectsApi)
+#
+def api_client() -> client.ApiClient:
+    global _api_client
+    if _api_client is None:
+        configuration = client.Configuration.get_default_copy()
+        # eine Verbindung pro Reconcile-Thread, sonst verwirft urllib3 die überzähligen
+        configuration.connection_pool_maxsize = RECONCILE_CONCURRENCY
+        _api_client = client.ApiClient(configuration)
+        meter_rest_client(_api_client.rest_client)
+    return _api_client
+
+#
+# Hilfsfunktion: Blockierende Funktion im Reconcile-Pool ausführen (höchstens
+# RECONCILE_CONCURRENCY gleichzeitig), damit die async-Handler von kopf parallel laufen.
+#
+async def run_blocking(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(reconcile_executor, functools.partial(fn, *args, **kwargs))
+
+#
+# Hilfsfunktion: Server-Side Apply eines Manifests über die patch_namespaced_*-Methode.
+# Legt das Objekt an oder gleicht es an, ein erneuter Aufruf ändert nichts (kein 409).
+#
+def server_side_apply(patch, name: str, namespace: str, body: dict):
+    return patch(
+        name=name,
+        namespace=namespace,
+        body=body,
+        field_manager=FIELD_MANAGER,
+        force=True,
+        _content_type="application/apply-patch+yaml"
+    )
+
+#
+# Hilfsfunktion: Container- und Volume-Definition des Listeners (Pod und Shard-Deployment)
+#
+def listener_container(env_vars: list, mount_path: str, extra_mounts: list = None) -> dict:
+    return {
+        "name": "mqtt-listener",
+        "image": LISTENER_IMAGE,
+        "imagePullPolicy": "Always",
+        "env": env_vars + [
+            # Teil der stabilen MQTT-Client-ID (persistente Session)
+            {"name": "POD_NAMESPACE", "valueFrom": {"fieldRef": {"fieldPath": "metadata.namespace"}}}
+        ],
+        "ports": [
+            {"name": "api", "containerPort": 8080}
+        ],
+        "volumeMounts": [
+            {
+                "name": "data-volume",
+                "mountPath": mount_path  # z. B. "/data"
+            }
+        ] + (extra_mounts or [])
+    }
+
+def data_volume(pvc_name: str) -> dict:
+    return {
+        "name": "data-volume",
+        "persistentVolumeClaim": {
+            "claimName": pvc_name
+        }
+    }
 
 #
 # Hilfsfunktion: Erzeugt den zweiten Pod, der MQTT-Nachrichten empfängt.
@@ -10,26 +132,23 @@ import requests
 def create_mqtt_listener_pod(
     namespace: str,
     mqtt_device_name: str,
-    mqtt_broker_url: str,
-    topics: list,
-    pvc_name,
-    mount_path    
+    storage: dict
 ):
     """
     Erzeugt ein Pod-Manifest für den "zweiten Pod", 
     der sich mit dem Broker verbindet und auf die angegebenen Topics lauscht.
-    """
-    
-    # MQTT Listener
-    container_image = "registry.gitlab.com/ch-mc-b/autoshop-ms/infra/iiot/mqtt-listener:1.0.3"
 
-    # Wir übergeben die nötigen Informationen als Umgebungsvariablen.
-    # Du könntest alternativ ein ConfigMap/Secret verwenden.
+    Broker und Topics liest der Listener aus der ConfigMap mqtt-listener-<Name>
+    und übernimmt Änderungen daran ohne Neustart. Nur die Speicher-Einstellungen
+    (storage) sind fest im Pod und werden als Annotation für den Vergleich abgelegt.
+    """
     env_vars = [
-        {"name": "MQTT_BROKER_URL", "value": mqtt_broker_url},
         {"name": "MQTTDEVICE_NAME", "value": mqtt_device_name},
-        {"name": "TOPICS", "value": ",".join(topics)},
+        {"name": "LISTENER_CONFIG", "value": "/config"},
+        {"name": "DATA_DIR", "value": storage["mountPath"]},
+        {"name": "STORAGE_MODE", "value": storage["mode"]},
     ]
+    config_mount = {"name": "listener-config", "mountPath": "/config", "readOnly": True}
 
     pod_manifest = {
         "apiVersion": "v1",
@@ -40,112 +159,213 @@ def create_mqtt_listener_pod(
                 "app": "mqtt-listener",
                 "mqtt-device": mqtt_device_name
             },
+            "annotations": {
+                STORAGE_ANNOTATION: json.dumps(storage, sort_keys=True)
+            },
         },
         "spec": {
-            "containers": [
-                {
-                    "name": "mqtt-listener",
-                    "image": container_image,
-                    "imagePullPolicy": "Always",
-                    "env": env_vars,
-                    "volumeMounts": [
-                        {
-                            "name": "data-volume",
-                            "mountPath": mount_path  # z. B. "/data"
-                        }
-                    ]
-                }
-            ],
+            "containers": [listener_container(env_vars, storage["mountPath"], [config_mount])],
             "volumes": [
-                {
-                    "name": "data-volume",
-                    "persistentVolumeClaim": {
-                        "claimName": pvc_name
-                    }
-                }
+                data_volume(storage["pvcName"]),
+                {"name": "listener-config", "configMap": {"name": f"mqtt-listener-{mqtt_device_name}"}}
             ],
             "restartPolicy": "Always"
         }
     }
+    if LISTENER_SERVICE_ACCOUNT:
+        pod_manifest["spec"]["serviceAccountName"] = LISTENER_SERVICE_ACCOUNT
 
-    # Den Pod via Kubernetes API erstellen.
-    core_api = client.CoreV1Api()
-    core_api.create_namespaced_pod(namespace=namespace, body=pod_manifest)
+    # Den Pod via Kubernetes API erstellen (Server-Side Apply: besteht er bereits
+    # unverändert, ist das ein No-op statt 409).
+    core_api = client.CoreV1Api(api_client())
+    server_side_apply(core_api.patch_namespaced_pod, pod_manifest["metadata"]["name"], namespace, pod_manifest)
 
 #
-# Beispiel-Funktion: Senden der Daten als JSON mit CloudEvents-Headern
+# Hilfsfunktion: Schreibt die Listener-Konfiguration (Broker, Topics) eines MQTTDevices
+# in die ConfigMap mqtt-listener-<Name>. Liefert True, wenn sich etwas geändert hat.
+# Ist der aktuelle Inhalt bekannt (current, z.B. aus dem Resync beim Start), wird nur
+# bei einer Abweichung geschrieben, sonst ohne vorheriges Lesen per Server-Side Apply.
 #
-def send_cloudevent_data(url: str, data: dict, source: str, event_type: str):
+def apply_listener_config(namespace: str, mqtt_device_name: str, entry: dict, current: dict = None) -> bool:
+    core_api = client.CoreV1Api(api_client())
+    cm_name = f"mqtt-listener-{mqtt_device_name}"
+    data = {f"{mqtt_device_name}.json": json.dumps(entry, sort_keys=True)}
+    if current == data:
+        return False
+    server_side_apply(core_api.patch_namespaced_config_map, cm_name, namespace, {
+        "apiVersion": "v1",
+        "kind": "ConfigMap",
+        "metadata": {"name": cm_name, "labels": {"app": "mqtt-listener", "mqtt-device": mqtt_device_name}},
+        "data": data
+    })
+    return True
+
+#
+# Hilfsfunktionen für den geteilten Modus (LISTENER_MODE=shared):
+# pro Shard ein Deployment und eine ConfigMap mit einem Eintrag <MQTTDevice>.json,
+# welche der Listener als Verzeichnis mountet und live nachlädt.
+#
+def ensure_listener_shard(namespace: str, shard_name: str):
     """
-    Sende Daten per HTTP POST mit CloudEvents-Headern.
+    Legt ConfigMap und Deployment eines Shards an bzw. gleicht sie per Server-Side Apply an;
+    nur beim ersten Aufruf und wenn sich die Manifeste seither geändert haben.
     """
-    headers = {
-        "Content-Type": "application/json",
-        "Ce-Specversion": "1.0",
-        "Ce-Type": event_type,
-        "Ce-Source": source,
-        "Ce-Id": "some-unique-id",  # Evtl. generieren oder aus data
+    # Ohne data: die Einträge der MQTTDevices setzt set_shard_entry, Apply lässt sie stehen
+    config_map = {
+        "apiVersion": "v1",
+        "kind": "ConfigMap",
+        "metadata": {"name": shard_name, "labels": {"app": "mqtt-listener", "mqtt-shard": shard_name}},
     }
 
-    response = requests.post(url, headers=headers, data=json.dumps(data))
-    response.raise_for_status()  # Löst eine Exception aus, falls ein Fehler zurück kommt
+    env_vars = [
+        {"name": "SHARD_NAME", "value": shard_name},
+        {"name": "LISTENER_CONFIG", "value": "/config"},
+        {"name": "DATA_DIR", "value": SHARD_MOUNT_PATH},
+        {"name": "STORAGE_MODE", "value": SHARD_STORAGE_MODE},
+    ]
+    config_mount = {"name": "listener-config", "mountPath": "/config", "readOnly": True}
+    pod_spec = {
+        "containers": [listener_container(env_vars, SHARD_MOUNT_PATH, [config_mount])],
+        "volumes": [
+            data_volume(SHARD_PVC_NAME),
+            {"name": "listener-config", "configMap": {"name": shard_name}}
+        ]
+    }
+    if LISTENER_SERVICE_ACCOUNT:
+        pod_spec["serviceAccountName"] = LISTENER_SERVICE_ACCOUNT
+    deployment = {
+        "apiVersion": "apps/v1",
+        "kind": "Deployment",
+        "metadata": {"name": shard_name, "labels": {"app": "mqtt-listener", "mqtt-shard": shard_name}},
+        "spec": {
+            "replicas": 1,
+            "strategy": {"type": "Recreate"},
+            "selector": {"matchLabels": {"app": "mqtt-listener", "mqtt-shard": shard_name}},
+            "template": {
+                "metadata": {"labels": {"app": "mqtt-listener", "mqtt-shard": shard_name}},
+                "spec": pod_spec
+            }
+        }
+    }
+    manifests = json.dumps([config_map, deployment], sort_keys=True)
+    with _shard_lock:
+        if _ensured_shards.get((namespace, shard_name)) == manifests:
+            return
+    core_api = client.CoreV1Api(api_client())
+    apps_api = client.AppsV1Api(api_client())
+    server_side_apply(core_api.patch_namespaced_config_map, shard_name, namespace, config_map)
+    server_side_apply(apps_api.patch_namespaced_deployment, shard_name, namespace, deployment)
+    with _shard_lock:
+        _ensured_shards[(namespace, shard_name)] = manifests
 
-#
-# Operator-Funktionen
-#
+def set_shard_entry(namespace: str, shard_name: str, mqtt_device_name: str, entry):
+    """Setzt (oder entfernt bei entry=None) den Eintrag eines MQTTDevices in der Shard-ConfigMap."""
+    core_api = client.CoreV1Api(api_client())
+    value = json.dumps(entry, sort_keys=True) if entry is not None else None
+    try:
+        core_api.patch_namespaced_config_map(
+            name=shard_name,
+            namespace=namespace,
+            body={"data": {f"{mqtt_device_name}.json": value}}
+        )
+    except client.exceptions.ApiException as e:
+        if e.status != 404 or entry is not None:
+            raise
 
-@kopf.on.create('iiot.mc-b.ch', 'v1alpha1', 'mqttdevice')
-def on_create_mqttdevice(body, spec, name, namespace, logger, **kwargs):
-    logger.info(f"MQTTDevice '{name}' wurde erstellt. Lese Device, Sensoren und Aktoren ...")
+def previous_shards(namespace: str, mqtt_device_name: str) -> list:
+    """Shards, die noch einen Eintrag des MQTTDevices haben können (alle, solange die Zuordnung unbekannt ist)."""
+    with _shard_lock:
+        previous = _device_shards.get((namespace, mqtt_device_name))
+        if previous is not None:
+            return [previous]
+        return [] if _device_shards_complete else shard_names(LISTENER_SHARDS)
 
-    mqtt_settings = spec.get("mqttSettings", {})
-    mqtt_broker_url = mqtt_settings.get("broker", "mqtt://cloud.tbz.ch:1883")
-    mqtt_root_topic = mqtt_settings.get("topic", "devices")
-    
-    # Speicher-Config auslesen
-    storage_spec = spec.get("storage", {})
-    pvc_name = storage_spec.get("pvcName", "data-claim")   # fallback
-    mount_path = storage_spec.get("mountPath", "/data")   # fallback    
+def assign_to_shard(namespace: str, mqtt_device_name: str, entry: dict, logger) -> str:
+    """Ordnet ein MQTTDevice per Consistent Hashing (SHARD_KEY) einem Shard zu und entfernt es aus dem bisherigen."""
+    shard_name = shard_for(mqtt_device_name, entry["broker"], LISTENER_SHARDS, SHARD_KEY == "broker")
+    ensure_listener_shard(namespace, shard_name)
+    try:
+        set_shard_entry(namespace, shard_name, mqtt_device_name, entry)
+    except client.exceptions.ApiException as e:
+        if e.status != 404:
+            raise
+        # ConfigMap von aussen gelöscht: Shard neu anlegen
+        with _shard_lock:
+            _ensured_shards.pop((namespace, shard_name), None)
+        ensure_listener_shard(namespace, shard_name)
+        set_shard_entry(namespace, shard_name, mqtt_device_name, entry)
+    for other in previous_shards(namespace, mqtt_device_name):
+        if other != shard_name:
+            set_shard_entry(namespace, other, mqtt_device_name, None)
+    with _shard_lock:
+        _device_shards[(namespace, mqtt_device_name)] = shard_name
+    logger.info(f"MQTTDevice '{mqtt_device_name}' dem Shard {shard_name} zugeordnet.")
+    return shard_name
 
-    device_ref = spec.get("deviceRef")
-    if not device_ref:
-        logger.error("Kein deviceRef in MQTTDevice angegeben.")
-        return {"message": f"Fehlender deviceRef in MQTTDevice '{name}'."}
+def remove_from_shards(namespace: str, mqtt_device_name: str):
+    for shard_name in previous_shards(namespace, mqtt_device_name):
+        set_shard_entry(namespace, shard_name, mqtt_device_name, None)
+    with _shard_lock:
+        _device_shards.pop((namespace, mqtt_device_name), None)
 
-    # CustomObjectsApi für clusterweite CRDs
-    custom_api = client.CustomObjectsApi()
+#
+# Hilfsfunktion: Clusterweites Objekt (Device, Sensor, Actor) lesen.
+# Zuerst aus dem Informer-Cache, nur bei einem Cache-Miss über die API.
+#
+def get_cluster_spec(plural: str, name: str) -> dict:
+    spec = object_cache.get(plural, name)
+    if spec is not None:
+        CACHE_LOOKUPS.labels(plural, "hit").inc()
+        return spec
+    CACHE_LOOKUPS.labels(plural, "miss").inc()
 
     # get_cluster_custom_object statt get_namespaced_custom_object, 
-    # da Device NICHT namespaced ist
-    try:
-        device_cr = custom_api.get_cluster_custom_object(
-            group="iiot.mc-b.ch",
-            version="v1alpha1",
-            plural="devices",
-            name=device_ref
-        )
-    except client.exceptions.ApiException as e:
-        logger.error(f"Device '{device_ref}' konnte nicht geladen werden: {e}")
-        return {"message": f"Fehler beim Laden der Device-Ressource '{device_ref}'."}
+    # da Device, Sensor und Actor NICHT namespaced sind
+    custom_api = client.CustomObjectsApi(api_client())
+    obj = custom_api.get_cluster_custom_object(
+        group="iiot.mc-b.ch",
+        version="v1alpha1",
+        plural=plural,
+        name=name
+    )
+    spec = obj.get("spec", {})
+    object_cache.put(plural, name, spec)
+    return spec
 
-    device_spec = device_cr.get("spec", {})
+#
+# Hilfsfunktion: Topics eines Devices aus Device-, Sensor- und Actor-CRs auflösen.
+# Wirft ApiException, falls das Device selbst nicht geladen werden kann.
+# Liefert zusätzlich die referenzierten Objekte (plural -> Namen) für den Abhängigkeits-Index.
+#
+def resolve_topics(device_ref: str, mqtt_root_topic: str, logger):
+    device_spec = get_cluster_spec("devices", device_ref)
     device_topic = device_spec.get("topic", device_ref)
+    refs = {"devices": {device_ref}, "sensors": set(), "actors": set()}
 
-    # Sensoren
+    # Sensoren (inkl. Wertenamen aus spec.values für die spaltenweise Ablage
+    # und dem Wire-Format aus spec.format für die Decoder des Listeners)
     sensor_topics = []
+    topic_values = {}
+    topic_schemas = {}
+    topic_sensors = {}
     for sensor_entry in device_spec.get("sensors", []):
         sensor_ref = sensor_entry.get("sensorRef")
         if sensor_ref:
+            refs["sensors"].add(sensor_ref)
             try:
-                sensor_cr = custom_api.get_cluster_custom_object(
-                    group="iiot.mc-b.ch",
-                    version="v1alpha1",
-                    plural="sensors",
-                    name=sensor_ref
-                )
-                sensor_topic = sensor_cr.get("spec", {}).get("topic", sensor_ref)
+                sensor_spec = get_cluster_spec("sensors", sensor_ref)
+                sensor_topic = sensor_spec.get("topic", sensor_ref)
                 full_topic = f"{mqtt_root_topic}/{device_topic}/{sensor_topic}"
                 sensor_topics.append(full_topic)
+                topic_sensors[full_topic] = sensor_ref
+                topic_values[full_topic] = [
+                    v.get("name") for v in sensor_spec.get("values", []) if v.get("name")
+                ]
+                if sensor_spec.get("format"):
+                    topic_schemas[full_topic] = {
+                        "format": sensor_spec["format"],
+                        "values": sensor_spec.get("values", []),
+                    }
                 logger.info(f"Sensor-Topic: {full_topic}")
             except client.exceptions.ApiException as e:
                 logger.error(f"Sensor '{sensor_ref}' konnte nicht geladen werden: {e}")
@@ -155,91 +375,362 @@ def on_create_mqttdevice(body, spec, name, namespace, logger, **kwargs):
     for actor_entry in device_spec.get("actors", []):
         actor_ref = actor_entry.get("actorRef")
         if actor_ref:
+            refs["actors"].add(actor_ref)
             try:
-                actor_cr = custom_api.get_cluster_custom_object(
-                    group="iiot.mc-b.ch",
-                    version="v1alpha1",
-                    plural="actors",
-                    name=actor_ref
-                )
-                actor_topic = actor_cr.get("spec", {}).get("topic", actor_ref)
+                actor_spec = get_cluster_spec("actors", actor_ref)
+                actor_topic = actor_spec.get("topic", actor_ref)
                 full_topic = f"{mqtt_root_topic}/{device_topic}/{actor_topic}"
                 actor_topics.append(full_topic)
                 logger.info(f"Actor-Topic: {full_topic}")
             except client.exceptions.ApiException as e:
                 logger.error(f"Actor '{actor_ref}' konnte nicht geladen werden: {e}")
 
-    all_topics = sensor_topics + actor_topics
+    return sensor_topics, actor_topics, topic_values, topic_schemas, topic_sensors, refs
+
+#
+# Beispiel-Funktion: Senden der Daten als JSON mit CloudEvents-Headern
+# (gleiche Implementierung wie im Listener, siehe mqtt-listener/cloudevent.py)
+#
+def send_cloudevent_data(url: str, data: dict, source: str, event_type: str):
+    """
+    Sende Daten per HTTP POST mit CloudEvents-Headern.
+    """
+    send_cloudevent(url, data, source, event_type)  # Löst eine Exception aus, falls ein Fehler zurück kommt
+
+#
+# Hilfsfunktion: Listener-Pod löschen und warten, bis er weg ist
+# (sonst schlägt das Neuanlegen mit 409 fehl).
+#
+def delete_listener_pod_and_wait(namespace: str, name: str, logger, timeout: float = 60.0):
+    core_api = client.CoreV1Api(api_client())
+    pod_name = f"mqtt-listener-{name}"
+    try:
+        core_api.delete_namespaced_pod(name=pod_name, namespace=namespace)
+    except client.exceptions.ApiException as e:
+        if e.status != 404:
+            raise
+        return
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            core_api.read_namespaced_pod(name=pod_name, namespace=namespace)
+        except client.exceptions.ApiException as e:
+            if e.status == 404:
+                return
+            raise
+        time.sleep(1)
+    logger.warning(f"Pod {pod_name} ist nach {timeout}s noch nicht gelöscht.")
+
+#
+# Hilfsfunktion: Soll-Zustand eines MQTTDevices (Eintrag für den Listener und
+# Speicher-Einstellungen). Liefert (entry, storage, None) oder (None, None, Meldung).
+#
+def desired_listener(spec, name: str, namespace: str, logger):
+    mqtt_settings = spec.get("mqttSettings", {})
+    mqtt_broker_url = mqtt_settings.get("broker", "mqtt://cloud.tbz.ch:1883")
+    mqtt_root_topic = mqtt_settings.get("topic", "devices")
+    
+    # Speicher-Config auslesen
+    storage_spec = spec.get("storage", {})
+    storage = {
+        "pvcName": storage_spec.get("pvcName", "data-claim"),   # fallback
+        "mountPath": storage_spec.get("mountPath", "/data"),    # fallback
+        "mode": storage_spec.get("mode", "text"),               # text, columnar oder both
+    }
+
+    device_ref = spec.get("deviceRef")
+    if not device_ref:
+        logger.error("Kein deviceRef in MQTTDevice angegeben.")
+        return None, None, f"Fehlender deviceRef in MQTTDevice '{name}'."
+
+    try:
+        sensor_topics, actor_topics, topic_values, topic_schemas, topic_sensors, refs = resolve_topics(
+            device_ref, mqtt_root_topic, logger
+        )
+    except client.exceptions.ApiException as e:
+        logger.error(f"Device '{device_ref}' konnte nicht geladen werden: {e}")
+        return None, None, f"Fehler beim Laden der Device-Ressource '{device_ref}'."
+    object_cache.track(namespace, name, spec, refs)
+
+    entry = {
+        "broker": mqtt_broker_url,
+        "qos": int(mqtt_settings.get("qos", 0)),
+        "topics": sensor_topics + actor_topics,
+        "topic_values": topic_values,
+        "topic_schemas": topic_schemas,
+        # Sensor-Topic -> Sensor, für status.lastValues
+        "topic_sensors": topic_sensors,
+    }
+    # Aufbewahrung der Dateien gehört zum Eintrag, nicht zu storage: Änderungen ohne Neustart
+    if storage_spec.get("retention"):
+        entry["retention"] = dict(storage_spec["retention"])
+    # Optionale Aggregation der Sensorwerte im Listener (Fenster, Deadband, abgeleitetes Topic)
+    if spec.get("aggregation"):
+        entry["aggregation"] = dict(spec["aggregation"])
+    return entry, storage, None
+
+#
+# Reconcile: gewünschten Zustand eines MQTTDevices berechnen und nur das Nötige ändern.
+# Wird von create, update, dem Resync beim Start und bei Änderungen an Device/Sensor/Actor verwendet.
+# observed: (Speicher-Annotation des Pods, Daten der ConfigMap) aus dem Listing beim Start,
+# je None, falls nicht vorhanden; ohne observed werden Pod und ConfigMap einzeln gelesen.
+#
+@RECONCILE_ERRORS.count_exceptions()
+@RECONCILE_SECONDS.time()
+def reconcile_mqttdevice(spec, name: str, namespace: str, logger, observed: tuple = None) -> dict:
+    entry, storage, error = desired_listener(spec, name, namespace, logger)
+    if error:
+        return {"message": error}
+    all_topics = entry["topics"]
+
+    if LISTENER_MODE == "shared":
+        shard_name = assign_to_shard(namespace, name, entry, logger)
+        return {"message": f"MQTTDevice '{name}' verarbeitet (Shard {shard_name}), Topics: {all_topics}"}
+
+    # Broker und Topics: der laufende Listener übernimmt die ConfigMap als Delta
+    config_changed = apply_listener_config(namespace, name, entry, observed[1] if observed else None)
+
+    # Pod nur neu erstellen, wenn er fehlt oder sich die Speicher-Einstellungen geändert haben
+    if observed is not None:
+        annotation = observed[0]
+    else:
+        core_api = client.CoreV1Api(api_client())
+        try:
+            pod = core_api.read_namespaced_pod(name=f"mqtt-listener-{name}", namespace=namespace)
+            annotation = (pod.metadata.annotations or {}).get(STORAGE_ANNOTATION, "")
+        except client.exceptions.ApiException as e:
+            if e.status != 404:
+                raise
+            annotation = None
+
+    if annotation is not None:
+        if annotation == json.dumps(storage, sort_keys=True):
+            if config_changed:
+                logger.info(f"Listener mqtt-listener-{name} übernimmt die neuen Topics ohne Neustart.")
+            return {"message": f"MQTTDevice '{name}' verarbeitet, Topics: {all_topics}"}
+        logger.info(f"Speicher-Einstellungen von '{name}' geändert, erstelle Pod neu.")
+        delete_listener_pod_and_wait(namespace, name, logger)
 
     create_mqtt_listener_pod(
         namespace=namespace, 
         mqtt_device_name=name,
-        mqtt_broker_url=mqtt_broker_url,
-        topics=all_topics,
-        pvc_name=pvc_name,
-        mount_path=mount_path
+        storage=storage
     )
     return {"message": f"MQTTDevice '{name}' verarbeitet, Topics: {all_topics}"}
 
+#
+# Resync beim Start: Devices, Sensoren, Aktoren, MQTTDevices sowie alle Listener-Pods
+# und -ConfigMaps je einmal clusterweit listen und nur fehlende oder abweichende
+# Listener anlegen bzw. anpassen (statt pro MQTTDevice mehrere GETs).
+#
+def list_cluster_objects(plural: str) -> list:
+    custom_api = client.CustomObjectsApi(api_client())
+    return custom_api.list_cluster_custom_object(group="iiot.mc-b.ch", version="v1alpha1", plural=plural)["items"]
+
+def resync_shards(devices: list, config_maps: list, logger):
+    """
+    Shared-Modus: pro Shard-ConfigMap höchstens ein Patch mit allen Abweichungen;
+    danach ist die Zuordnung MQTTDevice -> Shard für assign_to_shard bekannt.
+    """
+    global _device_shards_complete
+    current = {}  # (ns, Shard) -> data
+    for cm in config_maps:
+        shard_name = (cm.metadata.labels or {}).get("mqtt-shard")
+        if shard_name:
+            current[(cm.metadata.namespace, shard_name)] = dict(cm.data or {})
+
+    desired = {}  # (ns, Shard) -> data
+    for namespace, name, spec in devices:
+        entry, _, error = desired_listener(spec, name, namespace, logger)
+        if error:
+            logger.error(f"MQTTDevice '{namespace}/{name}': {error}")
+            continue
+        shard_name = shard_for(name, entry["broker"], LISTENER_SHARDS, SHARD_KEY == "broker")
+        desired.setdefault((namespace, shard_name), {})[f"{name}.json"] = json.dumps(entry, sort_keys=True)
+
+    core_api = client.CoreV1Api(api_client())
+    for key in sorted(set(current) | set(desired)):
+        namespace, shard_name = key
+        want, have = desired.get(key, {}), current.get(key)
+        if want:
+            # Einmal pro Start (z.B. neues Image), danach nur bei geänderten Manifesten
+            ensure_listener_shard(namespace, shard_name)
+        if have is None:
+            if not want:
+                continue
+            have = {}
+        patch = {k: v for k, v in want.items() if have.get(k) != v}
+        patch.update({k: None for k in have if k.endswith(".json") and k not in want})
+        if patch:
+            core_api.patch_namespaced_config_map(name=shard_name, namespace=namespace, body={"data": patch})
+            logger.info(f"Shard {namespace}/{shard_name}: {len(patch)} Einträge angeglichen.")
+
+    with _shard_lock:
+        for (namespace, shard_name), data in desired.items():
+            for key in data:
+                _device_shards[(namespace, key[:-len(".json")])] = shard_name
+        _device_shards_complete = True
+
+async def resync_listeners(logger):
+    for plural in PLURALS:
+        for obj in await run_blocking(list_cluster_objects, plural):
+            object_cache.put(plural, obj["metadata"]["name"], obj.get("spec", {}))
+
+    devices = [
+        (obj["metadata"]["namespace"], obj["metadata"]["name"], obj.get("spec", {}))
+        for obj in await run_blocking(list_cluster_objects, "mqttdevices")
+        if not obj["metadata"].get("deletionTimestamp")
+    ]
+    core_api = client.CoreV1Api(api_client())
+    pods = await run_blocking(core_api.list_pod_for_all_namespaces, label_selector="app=mqtt-listener")
+    config_maps = await run_blocking(core_api.list_config_map_for_all_namespaces, label_selector="app=mqtt-listener")
+
+    if LISTENER_MODE == "shared":
+        await run_blocking(resync_shards, devices, config_maps.items, logger)
+        logger.info(f"Resync: {len(devices)} MQTTDevices mit den Shards abgeglichen.")
+        return
+
+    annotations = {}
+    for pod in pods.items:
+        device = (pod.metadata.labels or {}).get("mqtt-device")
+        if device and pod.metadata.deletion_timestamp is None:
+            annotations[(pod.metadata.namespace, device)] = (pod.metadata.annotations or {}).get(STORAGE_ANNOTATION, "")
+    configs = {}
+    for cm in config_maps.items:
+        device = (cm.metadata.labels or {}).get("mqtt-device")
+        if device:
+            configs[(cm.metadata.namespace, device)] = dict(cm.data or {})
+
+    async def resync(namespace, name, spec):
+        observed = (annotations.get((namespace, name)), configs.get((namespace, name)))
+        try:
+            await run_blocking(reconcile_mqttdevice, spec, name, namespace, logger, observed)
+        except Exception as e:
+            logger.error(f"MQTTDevice '{namespace}/{name}' konnte nicht abgeglichen werden: {e}")
+
+    await asyncio.gather(*(resync(ns, name, spec) for ns, name, spec in devices))
+    orphans = sorted(set(annotations) - {(ns, name) for ns, name, _ in devices})
+    for namespace, name in orphans:
+        logger.warning(f"Listener mqtt-listener-{name} in {namespace} gehört zu keinem MQTTDevice.")
+    logger.info(f"Resync: {len(devices)} MQTTDevices, {len(pods.items)} Listener-Pods abgeglichen.")
+
+#
+# Operator-Funktionen
+#
+# Die Handler sind async; die Aufrufe des kubernetes-Clients laufen über run_blocking
+# im Reconcile-Pool, so dass bis zu RECONCILE_CONCURRENCY MQTTDevices parallel verarbeitet werden.
+#
+
+@kopf.on.startup()
+async def on_startup(logger, **kwargs):
+    if METRICS_PORT:
+        start_http_server(METRICS_PORT)
+        logger.info(f"Metriken unter :{METRICS_PORT}/metrics")
+    try:
+        await resync_listeners(logger)
+    except Exception as e:
+        # Kein Abbruch: create/update gleichen die MQTTDevices weiterhin einzeln ab
+        logger.error(f"Resync beim Start fehlgeschlagen: {e}")
+
+@kopf.on.create('iiot.mc-b.ch', 'v1alpha1', 'mqttdevice')
+async def on_create_mqttdevice(body, spec, name, namespace, logger, **kwargs):
+    logger.info(f"MQTTDevice '{name}' wurde erstellt. Lese Device, Sensoren und Aktoren ...")
+    return await run_blocking(reconcile_mqttdevice, spec, name, namespace, logger)
+
 @kopf.on.update('iiot.mc-b.ch', 'v1alpha1', 'mqttdevice')
-def on_update_mqttdevice(spec, name, namespace, logger, **kwargs):
+async def on_update_mqttdevice(spec, name, namespace, logger, **kwargs):
     """
     Reagiert auf Änderungen an einem MQTTDevice-Objekt.
-    Beispiel: Wir könnten den vorhandenen Pod löschen/neu starten oder
-    nur die geänderten Werte aktualisieren.
+    Die Topics werden gleich wie bei on_create berechnet; der laufende Listener
+    übernimmt geänderte Topics/Broker ohne Neustart (Subscribe/Unsubscribe),
+    der Pod wird nur bei geänderten Speicher-Einstellungen neu erstellt.
     """
-    logger.info(f"MQTTDevice '{name}' wurde aktualisiert. Aktualisiere zweiten Pod...")
+    logger.info(f"MQTTDevice '{name}' wurde aktualisiert. Gleiche Listener ab ...")
+    return await run_blocking(reconcile_mqttdevice, spec, name, namespace, logger)
+
+
+def delete_mqttdevice(name: str, namespace: str, logger) -> dict:
+    object_cache.untrack(namespace, name)
 
-    # Als einfaches Beispiel: Vorhandenen Pod löschen und neu anlegen.
-    core_api = client.CoreV1Api()
+    if LISTENER_MODE == "shared":
+        remove_from_shards(namespace, name)
+        return {"message": f"MQTTDevice '{name}' wurde aus den Shards entfernt."}
 
+    core_api = client.CoreV1Api(api_client())
     try:
         core_api.delete_namespaced_pod(name=f"mqtt-listener-{name}", namespace=namespace)
-        logger.info(f"Alter Pod mqtt-listener-{name} gelöscht.")
+        logger.info(f"Pod mqtt-listener-{name} gelöscht.")
     except client.exceptions.ApiException as e:
         if e.status == 404:
-            logger.warning("Zu aktualisierender Pod war nicht vorhanden.")
+            logger.warning("Pod war bereits weg.")
         else:
             raise
+    try:
+        core_api.delete_namespaced_config_map(name=f"mqtt-listener-{name}", namespace=namespace)
+    except client.exceptions.ApiException as e:
+        if e.status != 404:
+            raise
 
-    # Anschließend analog zu on_create erneut anlegen.
-    mqtt_broker_url = spec.get("mqttBrokerUrl", "mqtt://test-broker:1883")
-    device_topic = spec.get("deviceTopic", "device1")
-    sensors = spec.get("sensors", [])
-    mqtt_device_topic = spec.get("topic", name)
-
-    topic_list = []
-    for sensor in sensors:
-        sensor_topic = sensor.get("topic", "sensorX")
-        full_topic = f"{mqtt_device_topic}/{device_topic}/{sensor_topic}"
-        topic_list.append(full_topic)
-
-    create_mqtt_listener_pod(
-        namespace=namespace,
-        mqtt_device_name=name,
-        mqtt_broker_url=mqtt_broker_url,
-        topics=topic_list
-    )
-
-    return {"message": f"MQTTDevice '{name}' wurde erfolgreich aktualisiert."}
-
+    return {"message": f"MQTTDevice '{name}' wurde erfolgreich entfernt."}
 
 @kopf.on.delete('iiot.mc-b.ch', 'v1alpha1', 'mqttdevice')
-def on_delete_mqttdevice(name, namespace, logger, **kwargs):
+async def on_delete_mqttdevice(name, namespace, logger, **kwargs):
     """
     Reagiert auf das Löschen eines MQTTDevice-Objekts.
     Beispiel: Lösche den zugehörigen Pod.
     """
     logger.info(f"MQTTDevice '{name}' wird gelöscht. Lösche zweiten Pod...")
+    return await run_blocking(delete_mqttdevice, name, namespace, logger)
 
-    core_api = client.CoreV1Api()
+
+@kopf.on.resume('iiot.mc-b.ch', 'v1alpha1', 'mqttdevice')
+async def on_resume_mqttdevice(spec, name, namespace, logger, **kwargs):
+    """
+    Beim Start des Operators: Abhängigkeiten bestehender MQTTDevices
+    in den Cache aufnehmen, damit Änderungen an Sensoren & Co. sie finden.
+    Pods und ConfigMaps hat bereits der Resync in on_startup abgeglichen.
+    """
+    device_ref = spec.get("deviceRef")
+    if not device_ref:
+        return
+    mqtt_root_topic = spec.get("mqttSettings", {}).get("topic", "devices")
     try:
-        core_api.delete_namespaced_pod(name=f"mqtt-listener-{name}", namespace=namespace)
-        logger.info(f"Pod mqtt-listener-{name} gelöscht.")
+        *_, refs = await run_blocking(resolve_topics, device_ref, mqtt_root_topic, logger)
+        object_cache.track(namespace, name, spec, refs)
     except client.exceptions.ApiException as e:
-        if e.status == 404:
-            logger.warning("Pod war bereits weg.")
-        else:
-            raise
+        logger.error(f"Device '{device_ref}' konnte nicht geladen werden: {e}")
 
-    return {"message": f"MQTTDevice '{name}' wurde erfolgreich entfernt."}
+#
+# Informer: Device, Sensor und Actor per list+watch im Cache halten.
+# Ändert sich eine Spec, werden nur die davon abhängigen MQTTDevices neu aufgelöst (parallel).
+#
+async def reresolve_dependents(plural: str, obj_name: str, logger):
+    async def reresolve(namespace, name, spec):
+        logger.info(f"'{obj_name}' ({plural}) geändert, löse MQTTDevice '{namespace}/{name}' neu auf.")
+        try:
+            await run_blocking(reconcile_mqttdevice, spec, name, namespace, logger)
+        except Exception as e:
+            logger.error(f"MQTTDevice '{namespace}/{name}' konnte nicht neu aufgelöst werden: {e}")
+
+    await asyncio.gather(*(reresolve(*dependent) for dependent in object_cache.dependents(plural, obj_name)))
+
+async def on_cluster_object_event(plural: str, event: dict, name: str, spec, logger):
+    if event.get("type") == "DELETED":
+        changed = object_cache.remove(plural, name)
+    else:
+        # Auch ein neues Objekt: MQTTDevices können es schon vor dem Anlegen referenziert haben
+        changed = object_cache.put(plural, name, spec)
+    if changed:
+        await reresolve_dependents(plural, name, logger)
+
+@kopf.on.event('iiot.mc-b.ch', 'v1alpha1', 'device')
+async def on_device_event(event, name, spec, logger, **kwargs):
+    await on_cluster_object_event("devices", event, name, spec, logger)
+
+@kopf.on.event('iiot.mc-b.ch', 'v1alpha1', 'sensor')
+async def on_sensor_event(event, name, spec, logger, **kwargs):
+    await on_cluster_object_event("sensors", event, name, spec, logger)
+
+@kopf.on.event('iiot.mc-b.ch', 'v1alpha1', 'actor')
+async def on_actor_event(event, name, spec, logger, **kwargs):
+    await on_cluster_object_event("actors", event, name, spec, logger)
@@ -0,0 +1,46 @@
+"""
+Consistent Hashing für die Zuordnung von MQTTDevices zu Listener-Shards.
+
+Jeder Shard erhält mehrere virtuelle Knoten auf einem Hash-Ring; ein
+MQTTDevice gehört dem ersten Knoten im Uhrzeigersinn nach seinem Hash.
+Ändert sich die Anzahl Shards, wandert so nur etwa 1/N der MQTTDevices.
+"""
+import hashlib
+from bisect import bisect
+from functools import lru_cache
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+
+    def __init__(self, nodes: list, replicas: int = 100):
+        self.nodes = list(nodes)
+        self._ring = sorted((_hash(f"{node}#{i}"), node) for node in self.nodes for i in range(replicas))
+        self._keys = [h for h, _node in self._ring]
+
+    def node_for(self, key: str) -> str:
+        if not self._ring:
+            raise ValueError("Hash-Ring ohne Knoten")
+        i = bisect(self._keys, _hash(key)) % len(self._keys)
+        return self._ring[i][1]
+
+
+def shard_names(count: int) -> list:
+    return [f"mqtt-listener-shard-{i}" for i in range(count)]
+
+
+@lru_cache(maxsize=8)
+def _ring(count: int) -> HashRing:
+    return HashRing(shard_names(count))
+
+
+def shard_for(mqtt_device_name: str, broker: str, count: int, by_broker: bool = False) -> str:
+    """
+    Shard eines MQTTDevices, gehasht über Broker und Name. Mit by_broker nur
+    über den Broker: alle MQTTDevices eines Brokers teilen sich einen Shard
+    und damit eine Verbindung (dafür keine Lastverteilung innerhalb eines Brokers).
+    """
+    return _ring(count).node_for(broker if by_broker else f"{broker}|{mqtt_device_name}")